@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+# Не чаще чем раз в столько секунд отвечаем и пишем в лог о попытках доступа одного пользователя
+UNAUTHORIZED_REPLY_INTERVAL = 60
+# Длина окна для подсчета обновлений от пользователя, в секундах
+RATE_LIMIT_WINDOW = 60
+# Порог числа запомненных посторонних пользователей, после которого устаревшие записи удаляются
+MAX_TRACKED_STRANGERS = 10_000
+
+
+class ReplyThrottle:
+    """Разрешает ответ одному пользователю не чаще раза в interval секунд."""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._last_reply: dict[int, float] = {}
+
+    def should_reply(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if len(self._last_reply) >= MAX_TRACKED_STRANGERS:
+            self._last_reply = {
+                key: value for key, value in self._last_reply.items()
+                if now - value < self._interval
+            }
+        last = self._last_reply.get(user_id)
+        if last is not None and now - last < self._interval:
+            return False
+        self._last_reply[user_id] = now
+        return True
+
+
+async def _answer(update: Update, text: str, user_id: int):
+    """Отвечает на сообщение или нажатие кнопки из обновления, не прерывая обработку при ошибке API."""
+    event = update.event
+    try:
+        if isinstance(event, Message):
+            await event.answer(text)
+        elif isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=True)
+    except TelegramAPIError as e:
+        logging.warning(f"Не удалось ответить пользователю {user_id}: {e}")
+
+
+class AccessMiddleware(BaseMiddleware):
+    """
+    Внешний middleware обновлений: пропускает дальше только пользователей из списка разрешенных.
+    Если задан loader, список дополняется пользователями из базы и перечитывается раз в ttl секунд.
+    Должен быть зарегистрирован раньше FSM, чтобы обновления посторонних отбрасывались
+    до чтения состояния из Redis и любых запросов к базе данных.
+    Посторонним отвечает отказом не чаще раза в UNAUTHORIZED_REPLY_INTERVAL секунд.
+    """
+
+    def __init__(self, allowed_user_ids, loader=None, ttl: float = 60):
+        self._static_user_ids = set(allowed_user_ids)
+        self.allowed_user_ids = set(allowed_user_ids)
+        # loader - корутина, возвращающая актуальный список пользователей (или None при ошибке)
+        self._loader = loader
+        self._ttl = ttl
+        self._loaded_at = None
+        self._refresh_lock = asyncio.Lock()
+        self._throttle = ReplyThrottle(UNAUTHORIZED_REPLY_INTERVAL)
+
+    def invalidate(self):
+        """Перечитать список пользователей при следующем обновлении (например, после его изменения)."""
+        self._loaded_at = None
+
+    async def _refresh(self):
+        if self._loader is None:
+            return
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self._ttl:
+            return
+        async with self._refresh_lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self._ttl:
+                return
+            user_ids = await self._loader()
+            # При ошибке чтения остается прежний список, повторная попытка - через ttl
+            if user_ids is not None:
+                self.allowed_user_ids = self._static_user_ids | set(user_ids)
+            self._loaded_at = time.monotonic()
+
+    async def is_allowed(self, user_id: int) -> bool:
+        if user_id in self._static_user_ids:
+            return True
+        await self._refresh()
+        return user_id in self.allowed_user_ids
+
+    async def _reject(self, update: Update, user_id: int):
+        if not self._throttle.should_reply(user_id):
+            return
+        logging.warning(f"Unauthorized access attempt by user {user_id}")
+        await _answer(update, "Извините, у вас нет доступа к этому боту.", user_id)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            # Обновления без пользователя (посты в каналах и т.п.) боту не нужны
+            return None
+        if not await self.is_allowed(user.id):
+            await self._reject(event, user.id)
+            return None
+        return await handler(event, data)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает число обновлений от одного пользователя: не больше limit за RATE_LIMIT_WINDOW секунд.
+    Счетчик окна хранится в Redis, поэтому лимит общий для всех экземпляров бота; проверка стоит
+    одного конвейерного запроса. Если Redis недоступен, обновления пропускаются без ограничений.
+    """
+
+    def __init__(self, redis, limit: int):
+        self._redis = redis
+        self._limit = limit
+        self._throttle = ReplyThrottle(RATE_LIMIT_WINDOW)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        window = int(time.time()) // RATE_LIMIT_WINDOW
+        key = f"rate:{user.id}:{window}"
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, RATE_LIMIT_WINDOW * 2)
+                count, _ = await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Не удалось проверить лимит запросов пользователя {user.id}: {e}")
+            return await handler(event, data)
+        if count > self._limit:
+            if self._throttle.should_reply(user.id):
+                logging.warning(f"Пользователь {user.id} превысил лимит запросов ({self._limit} в минуту)")
+                await _answer(event, "⏳ Слишком много запросов. Подождите минуту и попробуйте снова.", user.id)
+            return None
+        return await handler(event, data)
@@ -0,0 +1,807 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import asyncpg
+
+import database
+from config_reader import config
+from gdrive_uploader import upload_backup_stream, find_backup_chain, download_file_stream
+from metrics import TimedAcquire, observe_backup_stage
+
+# Размер блока чтения из stdout pg_dump
+READ_BLOCK_SIZE = 256 * 1024
+# Уровень сжатия gzip: 6 - стандартный компромисс между скоростью и размером
+COMPRESSION_LEVEL = 6
+
+# Расширение и MIME-тип файла бекапа для каждого формата
+BACKUP_FORMATS = {
+    'plain': ('.sql.gz', 'application/gzip'),
+    'custom': ('.dump', 'application/octet-stream'),
+    'directory': ('.dir.tar', 'application/x-tar'),
+}
+
+# Инкрементальные бекапы: NDJSON с изменениями записей, сжатый gzip
+INCREMENTAL_EXTENSION = '.ndjson.gz'
+INCREMENTAL_FORMAT = 'savelink-incremental-v1'
+# Запас при выборке изменений: транзакция, начатая до предыдущего бекапа и зафиксированная после него,
+# несет более ранний updated_at. Повторное применение одних и тех же изменений безопасно.
+INCREMENTAL_OVERLAP = timedelta(minutes=5)
+# До этого размера инкремент собирается в памяти, дальше - во временном файле
+INCREMENTAL_SPOOL_SIZE = 8 * 1024 * 1024
+# Сколько записей применяется одним запросом при восстановлении инкремента
+REPLAY_BATCH_SIZE = 1000
+# Не чаще чем раз в столько секунд сообщаем о ходе восстановления
+RESTORE_PROGRESS_INTERVAL = 3
+# Схема, в которую загружается бекап при горячем восстановлении перед заменой рабочей таблицы
+SHADOW_SCHEMA = 'restore_shadow'
+# Начало блока с данными таблицы messages в SQL-дампе (старые версии pg_dump не указывают схему)
+COPY_MESSAGES_PREFIXES = (b'COPY public.messages ', b'COPY messages ')
+
+
+class BackupError(Exception):
+    """Ошибка создания или восстановления резервной копии; текст предназначен для показа пользователю."""
+
+
+class DumpStreamReader:
+    """
+    Файлоподобный объект, который читает данные из source и при compress=True отдает их сжатыми в gzip.
+    По окончании source вызывает on_eof: он может выбросить исключение, чтобы прервать
+    загрузку до отправки последней части (например, если pg_dump завершился с ошибкой).
+    Считает время ожидания source и время сжатия, чтобы отделить их от времени загрузки.
+    """
+
+    def __init__(self, source, on_eof=None, compress=True, level=COMPRESSION_LEVEL):
+        self._source = source
+        self._on_eof = on_eof
+        # wbits=31 - формат gzip с заголовком и контрольной суммой
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if compress else None
+        self._buffer = bytearray()
+        self._finished = False
+        self.raw_bytes = 0
+        self.output_bytes = 0
+        self.source_seconds = 0.0
+        self.compress_seconds = 0.0
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            started = time.perf_counter()
+            chunk = self._source.read(READ_BLOCK_SIZE)
+            self.source_seconds += time.perf_counter() - started
+            if chunk:
+                self.raw_bytes += len(chunk)
+                if self._compressor:
+                    started = time.perf_counter()
+                    self._buffer += self._compressor.compress(chunk)
+                    self.compress_seconds += time.perf_counter() - started
+                else:
+                    self._buffer += chunk
+            else:
+                if self._compressor:
+                    self._buffer += self._compressor.flush()
+                self._finished = True
+                if self._on_eof:
+                    self._on_eof()
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.output_bytes += len(data)
+        return data
+
+
+def _run_checked(command, tool):
+    """Запускает команду и выбрасывает BackupError с текстом stderr, если она завершилась с ошибкой."""
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error_message = result.stderr.decode(errors='replace').strip()
+        logging.error(f"{tool} завершился с ошибкой: {error_message}")
+        raise BackupError(error_message)
+
+
+def _stream_backup(file_name, backup_format):
+    """
+    Запускает pg_dump и передает его вывод прямо в загрузку на Google Drive.
+    Формат plain сжимается gzip на лету, custom уже сжат самим pg_dump.
+    Формат directory сначала выгружается параллельно во временный каталог и передается как tar.
+    """
+    work_dir = None
+    if backup_format == 'directory':
+        work_dir = tempfile.mkdtemp(prefix='backup_')
+        dump_dir = os.path.join(work_dir, 'dump')
+        started = time.perf_counter()
+        _run_checked([
+            'pg_dump',
+            '--dbname', config.db_dsn,
+            '--format', 'directory',
+            '--jobs', str(config.backup_jobs),
+            '--file', dump_dir
+        ], 'pg_dump')
+        observe_backup_stage('dump_directory', time.perf_counter() - started)
+        command, tool = ['tar', '-C', dump_dir, '-cf', '-', '.'], 'tar'
+    elif backup_format == 'custom':
+        command, tool = ['pg_dump', '--dbname', config.db_dsn, '--format', 'custom'], 'pg_dump'
+    else:
+        command, tool = [
+            'pg_dump',
+            '--dbname', config.db_dsn,
+            '--format', 'plain',
+            '--clean' # Добавляет команды DROP TABLE для чистого восстановления
+        ], 'pg_dump'
+
+    try:
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+
+            def check_dump_result():
+                if process.wait() != 0:
+                    stderr_file.seek(0)
+                    error_message = stderr_file.read().decode(errors='replace').strip()
+                    logging.error(f"{tool} завершился с ошибкой: {error_message}")
+                    raise BackupError(error_message)
+
+            reader = DumpStreamReader(process.stdout, on_eof=check_dump_result, compress=backup_format == 'plain')
+            started = time.perf_counter()
+            try:
+                file_link = upload_backup_stream(reader, file_name, BACKUP_FORMATS[backup_format][1])
+                elapsed = time.perf_counter() - started
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                process.stdout.close()
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if file_link:
+        # Дамп, сжатие и загрузка идут одновременно: время загрузки - это остаток после ожидания дампа и сжатия
+        # Для формата directory источник потока - tar уже готового каталога, сам pg_dump учтен в dump_directory
+        source_stage = 'archive' if backup_format == 'directory' else 'dump'
+        observe_backup_stage(source_stage, reader.source_seconds, reader.raw_bytes)
+        if backup_format == 'plain':
+            observe_backup_stage('compress', reader.compress_seconds)
+        upload_seconds = elapsed - reader.source_seconds - reader.compress_seconds
+        observe_backup_stage('upload', max(upload_seconds, 0.0), reader.output_bytes)
+        logging.info(f"Бекап '{file_name}': выгружено {reader.raw_bytes} байт, загружено {reader.output_bytes} байт.")
+    return file_link
+
+
+async def create_backup(prefix: str):
+    """
+    Создает полный дамп базы данных в формате из настроек и потоково загружает его на Google Drive.
+    После успешной загрузки отмечает момент дампа как точку отсчета для инкрементальных бекапов.
+    Возвращает ссылку на файл или None, если не удалась загрузка.
+    Выбрасывает BackupError при ошибке pg_dump и FileNotFoundError, если pg_dump не установлен.
+    """
+    async with TimedAcquire(database.pool) as connection:
+        started_at = await connection.fetchval('SELECT now()')
+
+    extension = BACKUP_FORMATS[config.backup_format][0]
+    file_name = f"{prefix}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}{extension}"
+    file_link = await asyncio.to_thread(_stream_backup, file_name, config.backup_format)
+
+    if file_link:
+        await database.save_backup_state(started_at, 0)
+        await database.prune_tombstones(started_at - INCREMENTAL_OVERLAP)
+    return file_link
+
+
+async def _message_columns(connection, schema: str = 'public') -> list[str]:
+    """Возвращает обычные (не вычисляемые) столбцы таблицы messages."""
+    rows = await connection.fetch(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = $1 AND table_name = 'messages' AND is_generated = 'NEVER' "
+        "ORDER BY ordinal_position",
+        schema
+    )
+    return [row['column_name'] for row in rows]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+
+async def create_incremental_backup(prefix: str, since: datetime):
+    """
+    Выгружает записи, измененные после since, и удаления в сжатый NDJSON и загружает его на Google Drive.
+    Данные читаются из одного снимка базы серверным курсором, поэтому память не зависит от объема изменений.
+    Возвращает (ссылка на файл или None, число изменений). Если изменений нет, файл не загружается.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=INCREMENTAL_SPOOL_SIZE)
+    changes = 0
+    started = time.perf_counter()
+    try:
+        async with TimedAcquire(database.pool) as connection:
+            async with connection.transaction(isolation='repeatable_read', readonly=True):
+                snapshot_at = await connection.fetchval('SELECT now()')
+                columns = await _message_columns(connection)
+                since_with_overlap = since - INCREMENTAL_OVERLAP
+                with gzip.GzipFile(fileobj=spool, mode='wb') as out:
+                    header = {"format": INCREMENTAL_FORMAT, "since": since, "until": snapshot_at, "columns": columns}
+                    out.write(json.dumps(header, default=_json_default).encode() + b'\n')
+                    # Удаления идут первыми: при восстановлении они должны освободить ключи уникальности
+                    async for row in connection.cursor(
+                        'SELECT id FROM deleted_messages WHERE deleted_at > $1 ORDER BY id', since_with_overlap
+                    ):
+                        out.write(json.dumps({"op": "delete", "id": row['id']}).encode() + b'\n')
+                        changes += 1
+                    column_list = ', '.join(f'"{column}"' for column in columns)
+                    async for row in connection.cursor(
+                        f'SELECT {column_list} FROM messages WHERE updated_at > $1 ORDER BY id', since_with_overlap
+                    ):
+                        line = {"op": "upsert", "row": dict(row)}
+                        out.write(json.dumps(line, default=_json_default, ensure_ascii=False).encode() + b'\n')
+                        changes += 1
+
+        size = spool.tell()
+        observe_backup_stage('incremental_dump', time.perf_counter() - started, size)
+        if changes:
+            spool.seek(0)
+            file_name = f"{prefix}_incremental_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}{INCREMENTAL_EXTENSION}"
+            started = time.perf_counter()
+            file_link = await asyncio.to_thread(upload_backup_stream, spool, file_name, 'application/gzip')
+            if not file_link:
+                return None, changes
+            observe_backup_stage('incremental_upload', time.perf_counter() - started, size)
+        else:
+            file_link = None
+    finally:
+        spool.close()
+
+    state = await database.get_backup_state()
+    await database.save_backup_state(snapshot_at, (state['cycles_since_full'] if state else 0) + 1)
+    logging.info(f"Инкрементальный бекап: {changes} изменений с {since.isoformat()}.")
+    return file_link, changes
+
+
+async def apply_incremental_backup(connection, path, schema: str = 'public'):
+    """
+    Применяет инкрементальный бекап к таблице messages в схеме schema: удаления, затем вставки/обновления.
+    path - путь к файлу или открытый бинарный файлоподобный объект со сжатым NDJSON.
+    """
+    table_columns = await _message_columns(connection, schema)
+    table = f'"{schema}".messages'
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        header = json.loads(next(source))
+        if header.get('format') != INCREMENTAL_FORMAT:
+            name = path if isinstance(path, str) else getattr(path, 'name', 'поток')
+            raise BackupError(f"Неизвестный формат инкрементального бекапа: {os.path.basename(str(name))}")
+        # Столбцы, которых нет в текущей схеме (или в бекапе), пропускаются
+        columns = [column for column in header['columns'] if column in table_columns]
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in columns if column != 'id')
+        upsert_query = (
+            f'INSERT INTO {table} ({column_list}) '
+            f'SELECT {column_list} FROM jsonb_populate_recordset(NULL::{table}, $1::jsonb) '
+            f'ON CONFLICT (id) DO UPDATE SET {updates}'
+        )
+
+        deleted_ids, rows = [], []
+        for line in source:
+            change = json.loads(line)
+            if change['op'] == 'delete':
+                deleted_ids.append(change['id'])
+                if len(deleted_ids) >= REPLAY_BATCH_SIZE:
+                    await connection.execute(f'DELETE FROM {table} WHERE id = ANY($1::int[])', deleted_ids)
+                    deleted_ids = []
+            else:
+                if deleted_ids:
+                    await connection.execute(f'DELETE FROM {table} WHERE id = ANY($1::int[])', deleted_ids)
+                    deleted_ids = []
+                rows.append(change['row'])
+                if len(rows) >= REPLAY_BATCH_SIZE:
+                    await connection.execute(upsert_query, json.dumps(rows))
+                    rows = []
+        if deleted_ids:
+            await connection.execute(f'DELETE FROM {table} WHERE id = ANY($1::int[])', deleted_ids)
+        if rows:
+            await connection.execute(upsert_query, json.dumps(rows))
+
+    # Записи вставлялись с явными id - сдвигаем последовательность за максимальный id
+    await connection.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), GREATEST((SELECT MAX(id) FROM {table}), 1))"
+    )
+
+
+def _pg_restore_command(jobs: int | None = None):
+    # --clean удаляет таблицы до загрузки данных. Архив из stdin восстанавливается одной транзакцией:
+    # если скачивание оборвется и процесс будет убит, база останется прежней.
+    # Формат directory к началу восстановления уже полностью распакован, поэтому оборванного потока
+    # быть не может и он восстанавливается параллельно (--jobs несовместим с --single-transaction).
+    command = [
+        'pg_restore',
+        '--dbname', config.db_dsn,
+        '--clean', '--if-exists',
+        '--no-owner',
+        '--exit-on-error'
+    ]
+    if jobs:
+        return command + ['--jobs', str(jobs)]
+    return command + ['--single-transaction']
+
+
+class RestoreStreamWriter:
+    """
+    Файлоподобный приемник скачиваемого бекапа: при decompress=True распаковывает gzip на лету
+    и пишет данные в target (stdin процесса восстановления). Считает время распаковки
+    и время ожидания target, чтобы отделить их от времени скачивания.
+    """
+
+    def __init__(self, target, decompress=False):
+        self._target = target
+        # wbits=31 - формат gzip с заголовком и контрольной суммой
+        self._decompressor = zlib.decompressobj(31) if decompress else None
+        self.received_bytes = 0
+        self.written_bytes = 0
+        self.decompress_seconds = 0.0
+        self.target_seconds = 0.0
+
+    def write(self, data):
+        self.received_bytes += len(data)
+        if self._decompressor:
+            started = time.perf_counter()
+            data = self._decompressor.decompress(data)
+            self.decompress_seconds += time.perf_counter() - started
+        if data:
+            started = time.perf_counter()
+            self._target.write(data)
+            self.target_seconds += time.perf_counter() - started
+            self.written_bytes += len(data)
+        return len(data)
+
+    def observe(self, elapsed: float):
+        """Записывает в метрики этапы скачивания, распаковки и применения за elapsed секунд работы."""
+        download_seconds = elapsed - self.decompress_seconds - self.target_seconds
+        observe_backup_stage('download', max(download_seconds, 0.0), self.received_bytes)
+        if self._decompressor:
+            observe_backup_stage('decompress', self.decompress_seconds)
+        observe_backup_stage('restore_apply', self.target_seconds, self.written_bytes)
+
+    def finish(self):
+        """Дописывает остаток распакованных данных и проверяет, что архив не оборван."""
+        if self._decompressor:
+            data = self._decompressor.flush()
+            if data:
+                self._target.write(data)
+                self.written_bytes += len(data)
+            if not self._decompressor.eof:
+                raise BackupError("Архив резервной копии оборван.")
+
+
+def _progress_reporter(loop, progress, stage):
+    """
+    Возвращает функцию для вызова из рабочего потока, которая не чаще раза в RESTORE_PROGRESS_INTERVAL
+    секунд передает ход операции в корутину progress(stage, done, total) в цикле событий loop.
+    """
+    last_report = 0.0
+
+    def report(done, total):
+        nonlocal last_report
+        now = time.monotonic()
+        if progress is None or (now - last_report < RESTORE_PROGRESS_INTERVAL and done != total):
+            return
+        last_report = now
+        asyncio.run_coroutine_threadsafe(progress(stage, done, total), loop)
+
+    return report
+
+
+def _stream_restore(file_info, report):
+    """
+    Скачивает полный бекап с Google Drive и одновременно передает его в stdin утилиты восстановления:
+    SQL-дамп распаковывается на лету и исполняется psql, custom-архив читается pg_restore из stdin.
+    Формат directory на лету распаковывается tar во временный каталог и затем восстанавливается pg_restore.
+    psql и pg_restore из stdin работают в одной транзакции, поэтому убитый при оборванном скачивании процесс
+    ничего не меняет; распакованный каталог восстанавливается pg_restore --jobs.
+    """
+    name = file_info['name']
+    extract_dir = None
+    if name.endswith('.tar'):
+        extract_dir = tempfile.mkdtemp(prefix='restore_')
+        command, tool = ['tar', '-x', '--no-same-owner', '-C', extract_dir, '-f', '-'], 'tar'
+    elif name.endswith('.dump'):
+        command, tool = _pg_restore_command(), 'pg_restore'
+    else:
+        # Одна транзакция: DROP из дампа откатится, если поток оборвется или psql будет убит
+        command, tool = [
+            'psql', '--dbname', config.db_dsn, '--single-transaction', '-v', 'ON_ERROR_STOP=1', '-f', '-'
+        ], 'psql'
+
+    try:
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            writer = RestoreStreamWriter(process.stdin, decompress=name.endswith('.gz'))
+            downloaded = False
+            started = time.perf_counter()
+            try:
+                downloaded = download_file_stream(file_info['id'], writer, on_progress=report)
+                if downloaded:
+                    writer.finish()
+            except BrokenPipeError:
+                # Утилита завершилась раньше времени, причина будет в stderr
+                downloaded = True
+            finally:
+                if not downloaded and process.poll() is None:
+                    # Не даем утилите применить оборванный поток
+                    process.kill()
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = process.wait()
+
+            if not downloaded:
+                raise BackupError("Не удалось скачать резервную копию с Google Drive.")
+            if returncode != 0:
+                stderr_file.seek(0)
+                error_message = stderr_file.read().decode(errors='replace').strip()
+                logging.error(f"{tool} завершился с ошибкой: {error_message}")
+                raise BackupError(error_message)
+        writer.observe(time.perf_counter() - started)
+        logging.info(f"Бекап '{name}': скачано {writer.received_bytes} байт, передано в {tool} {writer.written_bytes} байт.")
+
+        if extract_dir:
+            started = time.perf_counter()
+            _run_checked(
+                _pg_restore_command(jobs=config.backup_jobs) + ['--format', 'directory', extract_dir], 'pg_restore'
+            )
+            observe_backup_stage('restore_directory', time.perf_counter() - started)
+    finally:
+        if extract_dir:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+async def _apply_incremental_chain(connection, delta_sources, schema: str = 'public', loop=None, progress=None):
+    """
+    Применяет цепочку инкрементальных бекапов к таблице messages в схеме schema.
+    delta_sources - пути к файлам или файлы на Google Drive (словари с id и name), которые скачиваются в память.
+    """
+    for index, delta in enumerate(delta_sources, start=1):
+        if isinstance(delta, dict):
+            buffer = io.BytesIO()
+            report = _progress_reporter(loop, progress, f"инкремент {index} из {len(delta_sources)}")
+            started = time.perf_counter()
+            if not await asyncio.to_thread(download_file_stream, delta['id'], buffer, report):
+                raise BackupError(f"Не удалось скачать инкрементальный бекап {delta['name']}.")
+            observe_backup_stage('incremental_download', time.perf_counter() - started, buffer.tell())
+            buffer.seek(0)
+            buffer.name = delta['name']
+            delta = buffer
+        started = time.perf_counter()
+        await apply_incremental_backup(connection, delta, schema)
+        observe_backup_stage('incremental_apply', time.perf_counter() - started)
+
+
+class MessagesCopyFilter:
+    """
+    Файлоподобный фильтр SQL-дампа: передает в target только блок COPY с данными таблицы messages,
+    перенаправив его в схему schema, и считает переданные строки. Остальные команды дампа
+    (DROP, CREATE, данные служебных таблиц) отбрасываются.
+    """
+
+    def __init__(self, target, schema=SHADOW_SCHEMA):
+        self._target = target
+        self._schema = schema.encode()
+        self._pending = b''
+        self._in_copy = False
+        self.copy_found = False
+        self.rows = 0
+
+    def write(self, data):
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._process_line(line)
+        return len(data)
+
+    def _process_line(self, line):
+        if self._in_copy:
+            self._target.write(line + b'\n')
+            if line == b'\\.':
+                self._in_copy = False
+            else:
+                self.rows += 1
+            return
+        for prefix in COPY_MESSAGES_PREFIXES:
+            if line.startswith(prefix):
+                self._in_copy = True
+                self.copy_found = True
+                self._target.write(b'COPY "' + self._schema + b'".messages ' + line[len(prefix):] + b'\n')
+                return
+        if line.startswith(b'SET client_encoding'):
+            self._target.write(line + b'\n')
+
+    def finish(self):
+        """Обрабатывает последнюю строку и проверяет, что данные таблицы messages найдены целиком."""
+        if self._pending:
+            self._process_line(self._pending)
+            self._pending = b''
+        if self._in_copy:
+            raise BackupError("Данные таблицы messages в резервной копии оборваны.")
+        if not self.copy_found:
+            raise BackupError("В резервной копии нет данных таблицы messages.")
+
+
+def _pump(source, sink):
+    """Переписывает данные из source в sink блоками до конца source."""
+    while chunk := source.read(READ_BLOCK_SIZE):
+        sink.write(chunk)
+
+
+def _raise_for_process(process, stderr_file, tool):
+    """Ждет завершения процесса и выбрасывает BackupError с текстом stderr, если он завершился с ошибкой."""
+    if process.wait() != 0:
+        stderr_file.seek(0)
+        error_message = stderr_file.read().decode(errors='replace').strip()
+        logging.error(f"{tool} завершился с ошибкой: {error_message}")
+        raise BackupError(error_message)
+
+
+def _download_backup(file_info, sink, report):
+    if not download_file_stream(file_info['id'], sink, on_progress=report):
+        raise BackupError("Не удалось скачать резервную копию с Google Drive.")
+
+
+def _feed_process(process, file_info, report):
+    """Скачивает бекап в stdin процесса. Если процесс завершился раньше времени, причина будет в его stderr."""
+    try:
+        _download_backup(file_info, process.stdin, report)
+    except BrokenPipeError:
+        pass
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _stream_shadow_load(file_info, report):
+    """
+    Скачивает полный бекап с Google Drive и загружает данные таблицы messages в теневую схему через psql.
+    SQL-дамп фильтруется на лету, из custom-архива данные таблицы извлекает pg_restore из stdin,
+    формат directory распаковывается tar во временный каталог и читается pg_restore оттуда.
+    Возвращает число строк messages в бекапе.
+    """
+    name = file_info['name']
+    psql_command = ['psql', '--dbname', config.db_dsn, '--quiet', '-v', 'ON_ERROR_STOP=1', '-f', '-']
+    # Из бекапа извлекаются только данные таблицы messages в виде SQL
+    data_command = ['pg_restore', '--data-only', '--schema', 'public', '--table', 'messages', '--file', '-']
+    extract_dir = None
+    try:
+        with tempfile.TemporaryFile() as psql_stderr, tempfile.TemporaryFile() as tool_stderr:
+            psql = subprocess.Popen(psql_command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=psql_stderr)
+            copy_filter = MessagesCopyFilter(psql.stdin)
+            interrupted = False
+            try:
+                if name.endswith('.tar'):
+                    extract_dir = tempfile.mkdtemp(prefix='restore_')
+                    tar = subprocess.Popen(
+                        ['tar', '-x', '--no-same-owner', '-C', extract_dir, '-f', '-'],
+                        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=tool_stderr
+                    )
+                    _feed_process(tar, file_info, report)
+                    _raise_for_process(tar, tool_stderr, 'tar')
+                    dump = subprocess.Popen(
+                        data_command + ['--format', 'directory', extract_dir],
+                        stdout=subprocess.PIPE, stderr=tool_stderr
+                    )
+                    with dump.stdout:
+                        _pump(dump.stdout, copy_filter)
+                    _raise_for_process(dump, tool_stderr, 'pg_restore')
+                elif name.endswith('.dump'):
+                    dump = subprocess.Popen(data_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=tool_stderr)
+
+                    def pump_output():
+                        try:
+                            _pump(dump.stdout, copy_filter)
+                        except BaseException:
+                            # Иначе pg_restore и скачивание заблокируются на заполненных каналах
+                            dump.kill()
+                            raise
+
+                    # Вывод pg_restore разбирается в отдельном потоке, пока в его stdin пишется скачиваемый архив
+                    with ThreadPoolExecutor(max_workers=1) as executor, dump.stdout:
+                        pumping = executor.submit(pump_output)
+                        _feed_process(dump, file_info, report)
+                        pumping.result()
+                    _raise_for_process(dump, tool_stderr, 'pg_restore')
+                else:
+                    writer = RestoreStreamWriter(copy_filter, decompress=name.endswith('.gz'))
+                    started = time.perf_counter()
+                    _download_backup(file_info, writer, report)
+                    writer.finish()
+                    writer.observe(time.perf_counter() - started)
+                copy_filter.finish()
+            except BrokenPipeError:
+                # psql завершился раньше времени, причина будет в stderr
+                interrupted = True
+            except BaseException:
+                # Не даем psql применить оборванный поток
+                psql.kill()
+                raise
+            finally:
+                try:
+                    psql.stdin.close()
+                except BrokenPipeError:
+                    pass
+            _raise_for_process(psql, psql_stderr, 'psql')
+            if interrupted:
+                raise BackupError("psql завершился раньше, чем получил все данные резервной копии.")
+    finally:
+        if extract_dir:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+    logging.info(f"Бекап '{name}': в теневую схему загружено {copy_filter.rows} записей.")
+    return copy_filter.rows
+
+
+def _retarget(definition: str) -> str:
+    """Переносит определение индекса или триггера с таблицы public.messages на таблицу теневой схемы."""
+    return re.sub(r' ON (?:public\.)?messages ', f' ON {SHADOW_SCHEMA}.messages ', definition, count=1)
+
+
+async def _create_shadow_table(connection):
+    """Создает в теневой схеме пустую таблицу messages со структурой рабочей таблицы, но без индексов."""
+    await connection.execute(f'DROP SCHEMA IF EXISTS {SHADOW_SCHEMA} CASCADE')
+    await connection.execute(f'CREATE SCHEMA {SHADOW_SCHEMA}')
+    await connection.execute(
+        f'CREATE TABLE {SHADOW_SCHEMA}.messages '
+        f'(LIKE public.messages INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE)'
+    )
+
+
+async def _index_shadow_table(connection, jobs: int = 1):
+    """
+    Строит на загруженной теневой таблице те же ограничения и индексы с теми же именами, что у рабочей.
+    Индексы, как и pg_restore --jobs, строятся параллельно в jobs отдельных соединениях.
+    """
+    constraints = await connection.fetch(
+        "SELECT conname, pg_get_constraintdef(oid) AS definition FROM pg_constraint "
+        "WHERE conrelid = 'public.messages'::regclass AND contype IN ('p', 'u', 'c', 'x')"
+    )
+    for row in constraints:
+        await connection.execute(
+            f'ALTER TABLE {SHADOW_SCHEMA}.messages ADD CONSTRAINT "{row["conname"]}" {row["definition"]}'
+        )
+    indexes = await connection.fetch(
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = 'public.messages'::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)"
+    )
+    pending = [_retarget(definition) for (definition,) in indexes]
+
+    async def build_indexes():
+        worker = await asyncpg.connect(dsn=config.db_dsn)
+        try:
+            while pending:
+                await worker.execute(pending.pop())
+        finally:
+            await worker.close()
+
+    if pending:
+        await asyncio.gather(*(build_indexes() for _ in range(max(1, min(jobs, len(pending))))))
+    await connection.execute(f'ANALYZE {SHADOW_SCHEMA}.messages')
+
+
+async def _swap_shadow_table(connection):
+    """
+    Подменяет рабочую таблицу messages теневой: переносит триггеры и последовательность id,
+    пересчитывает счетчики статистики и сбрасывает журнал удалений и состояние бекапов.
+    Вызывается внутри транзакции, поэтому обработчики видят либо старые, либо новые данные.
+    """
+    await connection.execute('LOCK TABLE public.messages IN ACCESS EXCLUSIVE MODE')
+    triggers = await connection.fetch(
+        "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = 'public.messages'::regclass AND NOT tgisinternal"
+    )
+    for (definition,) in triggers:
+        await connection.execute(_retarget(definition))
+    sequence = await connection.fetchval("SELECT pg_get_serial_sequence('public.messages', 'id')")
+    # Иначе последовательность удалится вместе со старой таблицей
+    await connection.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+    await connection.execute('DROP TABLE public.messages')
+    await connection.execute(f'ALTER TABLE {SHADOW_SCHEMA}.messages SET SCHEMA public')
+    await connection.execute(f'ALTER SEQUENCE {sequence} OWNED BY public.messages.id')
+    await connection.execute(f"SELECT setval('{sequence}', GREATEST((SELECT MAX(id) FROM public.messages), 1))")
+    await connection.execute('SELECT rebuild_message_stats(NULL)')
+    await connection.execute('TRUNCATE deleted_messages')
+    # После восстановления следующий плановый бекап должен быть полным
+    await connection.execute('UPDATE backup_state SET last_backup_at = NULL, cycles_since_full = 0')
+
+
+async def _hot_restore(full_file, delta_files, loop, progress):
+    """
+    Восстанавливает таблицу messages без остановки бота: бекап и инкременты загружаются в теневую схему,
+    число загруженных записей сверяется с бекапом, и таблица подменяется в одной транзакции.
+    Рабочая схема (триггеры, индексы, миграции) остается текущей, даже если бекап снят со старой версии.
+    Атомарность обеспечивает подмена таблицы, поэтому загрузка идет без --single-transaction,
+    а индексы теневой таблицы строятся в config.backup_jobs соединений.
+    """
+    connection = await asyncpg.connect(dsn=config.db_dsn)
+    try:
+        await _create_shadow_table(connection)
+        report = _progress_reporter(loop, progress, "полный бекап")
+        started = time.perf_counter()
+        expected_rows = await asyncio.to_thread(_stream_shadow_load, full_file, report)
+        observe_backup_stage('shadow_load', time.perf_counter() - started)
+        loaded_rows = await connection.fetchval(f'SELECT COUNT(*) FROM {SHADOW_SCHEMA}.messages')
+        if loaded_rows != expected_rows:
+            raise BackupError(f"В теневую схему загружено {loaded_rows} записей из {expected_rows}, восстановление прервано.")
+        started = time.perf_counter()
+        await _index_shadow_table(connection, config.backup_jobs)
+        observe_backup_stage('shadow_index', time.perf_counter() - started)
+        await _apply_incremental_chain(connection, delta_files, SHADOW_SCHEMA, loop, progress)
+        started = time.perf_counter()
+        async with connection.transaction():
+            await _swap_shadow_table(connection)
+        observe_backup_stage('swap', time.perf_counter() - started)
+    except asyncpg.PostgresError as e:
+        logging.error(f"Не удалось восстановить бекап через теневую схему: {e}")
+        raise BackupError(str(e))
+    finally:
+        try:
+            await connection.execute(f'DROP SCHEMA IF EXISTS {SHADOW_SCHEMA} CASCADE')
+        except Exception as e:
+            logging.warning(f"Не удалось удалить теневую схему {SHADOW_SCHEMA}: {e}")
+        await connection.close()
+    logging.info(f"Горячее восстановление завершено: {loaded_rows} записей из полного бекапа, инкрементов: {len(delta_files)}.")
+
+
+async def _replay_incremental_backups(delta_sources, loop=None, progress=None):
+    """
+    Применяет цепочку инкрементальных бекапов в одной транзакции и сбрасывает состояние бекапов.
+    """
+    # Отдельное соединение: кешированные запросы пула могут ссылаться на пересозданные таблицы
+    connection = await asyncpg.connect(dsn=config.db_dsn)
+    try:
+        async with connection.transaction():
+            await _apply_incremental_chain(connection, delta_sources, loop=loop, progress=progress)
+            # После восстановления следующий плановый бекап должен быть полным
+            await connection.execute('UPDATE backup_state SET last_backup_at = NULL, cycles_since_full = 0')
+    except asyncpg.PostgresError as e:
+        logging.error(f"Не удалось применить инкрементальные бекапы: {e}")
+        raise BackupError(str(e))
+    finally:
+        await connection.close()
+
+
+async def restore_latest_backup(progress=None):
+    """
+    Восстанавливает базу данных из последнего полного бекапа на Google Drive и инкрементов после него.
+    Бекап не сохраняется на диск: скачивание и восстановление идут одновременно. В режиме hot
+    данные загружаются в теневую схему и подменяют рабочую таблицу атомарно, затем обновляются
+    соединения пула, так что перезапуск бота не нужен.
+    progress - необязательная корутина progress(этап, скачано байт, размер), вызывается по ходу скачивания.
+    Возвращает False, если бекап не найден. Выбрасывает BackupError при ошибке скачивания или
+    восстановления и FileNotFoundError, если утилита не установлена.
+    """
+    chain = await asyncio.to_thread(find_backup_chain)
+    if not chain:
+        return False
+    full_file, delta_files = chain
+
+    loop = asyncio.get_running_loop()
+    if config.restore_mode == 'hot':
+        await _hot_restore(full_file, delta_files, loop, progress)
+    else:
+        await asyncio.to_thread(_stream_restore, full_file, _progress_reporter(loop, progress, "полный бекап"))
+        await _replay_incremental_backups(delta_files, loop, progress)
+    # Кешированные подготовленные запросы пула ссылаются на замененные таблицы
+    await database.reload_pool()
+    return True
@@ -0,0 +1,439 @@
+import asyncio
+import codecs
+import csv
+import html
+import io
+import json
+import itertools
+import re
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+
+# Ограничения полей записи (совпадают с проверками validate_text/validate_name/validate_tag)
+MAX_MESSAGE_LENGTH = 4096
+MAX_NAME_LENGTH = 1000
+MAX_TAG_LENGTH = 100
+DEFAULT_TAG = 'no_tag'
+
+# Размер блока при чтении загруженного файла
+READ_BLOCK_SIZE = 64 * 1024
+# Сколько записей разбирается в отдельном потоке за один раз при потоковом импорте
+PARSE_BATCH_SIZE = 1000
+
+# Ссылки в обычном тексте: схема http/https и все символы до пробела
+URL_PATTERN = re.compile(r'https?://[^\s<>"\']+', re.IGNORECASE)
+# Знаки препинания, которые обычно завершают предложение, а не ссылку
+URL_TRAILING_PUNCTUATION = '.,;:!?)]}»'
+
+# Названия столбцов CSV и ключей JSON, из которых берутся поля записи
+URL_FIELDS = ('url', 'link', 'href', 'message', 'uri')
+NAME_FIELDS = ('name', 'title')
+TAG_FIELDS = ('tag', 'tags', 'folder', 'category')
+TIMESTAMP_FIELDS = ('timestamp', 'date', 'created', 'created_at', 'add_date', 'added')
+
+
+class ImportStats:
+    """Счетчики разбора файла: сколько записей найдено и сколько пропущено как некорректные."""
+
+    def __init__(self):
+        self.parsed = 0
+        self.skipped = 0
+
+
+def detect_import_format(file_name: str, head: bytes) -> str:
+    """Определяет формат файла закладок (html, csv, json, ndjson, text) по расширению и началу файла."""
+    name = (file_name or '').lower()
+    for extensions, file_format in (
+        (('.html', '.htm'), 'html'),
+        (('.csv',), 'csv'),
+        (('.ndjson', '.jsonl'), 'ndjson'),
+        (('.json',), 'json'),
+        (('.txt', '.list'), 'text'),
+    ):
+        if name.endswith(extensions):
+            return file_format
+    start = head.lstrip(codecs.BOM_UTF8 + b' \t\r\n')[:64].lower()
+    if start.startswith(b'<'):
+        return 'html'
+    if start.startswith(b'['):
+        return 'json'
+    if start.startswith(b'{'):
+        return 'ndjson'
+    return 'text'
+
+
+def _clean(value, limit: int) -> str | None:
+    if value is None:
+        return None
+    value = ' '.join(str(value).split())
+    return value[:limit] if value else None
+
+
+def _parse_timestamp(value) -> datetime | None:
+    """Понимает секунды/миллисекунды/микросекунды от начала эпохи и даты в формате ISO 8601."""
+    if value in (None, ''):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        try:
+            parsed = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    # Chrome и Firefox пишут время в микросекундах или миллисекундах
+    while number > 1e11:
+        number /= 1000
+    try:
+        return datetime.fromtimestamp(number, tz=timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def _make_record(stats: ImportStats, url, name=None, tag=None, timestamp=None):
+    """Приводит поля к ограничениям таблицы messages. Возвращает None для записи без ссылки."""
+    message = str(url).strip() if url is not None else ''
+    if not message or len(message) > MAX_MESSAGE_LENGTH:
+        stats.skipped += 1
+        return None
+    if isinstance(tag, (list, tuple)):
+        tag = tag[0] if tag else None
+    elif isinstance(tag, str) and ',' in tag:
+        tag = tag.split(',')[0]
+    stats.parsed += 1
+    return (
+        message,
+        _clean(name, MAX_NAME_LENGTH),
+        _clean(tag, MAX_TAG_LENGTH) or DEFAULT_TAG,
+        _parse_timestamp(timestamp),
+    )
+
+
+def _text_lines(source):
+    """Построчно читает бинарный поток как UTF-8 (с BOM или без)."""
+    return io.TextIOWrapper(source, encoding='utf-8-sig', errors='replace', newline='')
+
+
+def extract_urls(text: str) -> list[str]:
+    """Возвращает ссылки из текста в порядке появления, без повторов."""
+    urls = []
+    for match in URL_PATTERN.finditer(text or ''):
+        url = match.group(0).rstrip(URL_TRAILING_PUNCTUATION)
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def _parse_text(source, stats):
+    for line in _text_lines(source):
+        for url in extract_urls(line):
+            record = _make_record(stats, url)
+            if record:
+                yield record
+
+
+def _pick(row: dict, fields):
+    for field in fields:
+        if row.get(field) not in (None, ''):
+            return row[field]
+    return None
+
+
+def _record_from_mapping(stats, row: dict):
+    row = {str(key).strip().lower(): value for key, value in row.items()}
+    return _make_record(
+        stats, _pick(row, URL_FIELDS), _pick(row, NAME_FIELDS), _pick(row, TAG_FIELDS), _pick(row, TIMESTAMP_FIELDS)
+    )
+
+
+def _parse_csv(source, stats):
+    try:
+        yield from _parse_csv_rows(source, stats)
+    except csv.Error as e:
+        # Ошибка разбора для вызывающего кода - всегда ValueError, как у остальных форматов
+        raise ValueError(f"Некорректный CSV: {e}") from e
+
+
+def _parse_csv_rows(source, stats):
+    reader = csv.reader(_text_lines(source))
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [column.strip().lower() for column in header]
+    if not any(column in URL_FIELDS for column in columns):
+        # Файл без заголовка: ссылка, название, тег, дата
+        columns = ['url', 'name', 'tag', 'timestamp'][:len(header)]
+        record = _record_from_mapping(stats, dict(zip(columns, header)))
+        if record:
+            yield record
+    for row in reader:
+        if not any(row):
+            continue
+        record = _record_from_mapping(stats, dict(zip(columns, row)))
+        if record:
+            yield record
+
+
+def _record_from_json(stats, item):
+    if isinstance(item, str):
+        return _make_record(stats, item)
+    if isinstance(item, dict):
+        return _record_from_mapping(stats, item)
+    stats.skipped += 1
+    return None
+
+
+def _parse_ndjson(source, stats):
+    for line in _text_lines(source):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            stats.skipped += 1
+            continue
+        record = _record_from_json(stats, item)
+        if record:
+            yield record
+
+
+class _JsonStream:
+    """Поблочно читает JSON-документ из текстового потока и разбирает его по одному значению."""
+
+    def __init__(self, text):
+        self._text = text
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+
+    def _refill(self) -> bool:
+        chunk = self._text.read(READ_BLOCK_SIZE)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def peek(self, separators: str = '') -> str | None:
+        """Пропускает пробелы и символы separators; возвращает следующий символ или None в конце файла."""
+        while True:
+            while self._position < len(self._buffer) and (
+                self._buffer[self._position].isspace() or self._buffer[self._position] in separators
+            ):
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._refill():
+                return None
+
+    def advance(self):
+        self._position += 1
+
+    def decode(self):
+        """Разбирает одно значение JSON, начинающееся с текущей позиции, дочитывая файл по мере надобности."""
+        while True:
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, self._position)
+            except ValueError:
+                if not self._refill():
+                    raise
+                continue
+            # Значение могло оборваться на границе блока так, что остаток тоже корректен (например, число)
+            if end == len(self._buffer) and self._refill():
+                continue
+            self._position = end
+            return item
+
+
+def _json_array_records(stream: _JsonStream, stats):
+    """Отдает записи из элементов JSON-массива, открывающая скобка которого - текущий символ потока."""
+    stream.advance()
+    while stream.peek(',') not in (None, ']'):
+        record = _record_from_json(stats, stream.decode())
+        if record:
+            yield record
+
+
+def _parse_json(source, stats):
+    """
+    Разбирает JSON-массив или объект по одному элементу, не загружая в память весь документ целиком.
+    В объекте (например, экспорте с полем-списком закладок) записями становятся элементы первого
+    поля-списка, а объект без списков считается одной записью.
+    """
+    stream = _JsonStream(_text_lines(source))
+    char = stream.peek()
+    if char == '[':
+        yield from _json_array_records(stream, stats)
+    elif char == '{':
+        stream.advance()
+        fields = {}
+        while (char := stream.peek(',')) != '}':
+            if char is None:
+                raise ValueError("JSON-объект не завершен")
+            key = stream.decode()
+            if stream.peek() != ':':
+                raise ValueError("В JSON-объекте после ключа ожидается двоеточие")
+            stream.advance()
+            if stream.peek() == '[':
+                yield from _json_array_records(stream, stats)
+                return
+            fields[key] = stream.decode()
+        record = _record_from_json(stats, fields)
+        if record:
+            yield record
+    elif char is not None:
+        record = _record_from_json(stats, stream.decode())
+        if record:
+            yield record
+
+
+class _NetscapeBookmarksParser(HTMLParser):
+    """
+    Разбирает экспорт закладок браузера (формат Netscape Bookmark File).
+    Тегом записи становится первый тег из атрибута TAGS или название ближайшей папки.
+    """
+
+    def __init__(self, stats):
+        super().__init__(convert_charrefs=True)
+        self._stats = stats
+        self._folders = []
+        self._pending_folder = None
+        self._folder_name = None
+        self._link = None
+        self._text = []
+        self.records = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and attrs.get('href'):
+            self._link = attrs
+            self._text = []
+        elif tag == 'h3':
+            self._pending_folder = []
+        elif tag == 'dl':
+            # Список внутри папки: название берется из предшествующего H3
+            self._folders.append(self._folder_name)
+            self._folder_name = None
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._link is not None:
+            link, self._link = self._link, None
+            folder = next((name for name in reversed(self._folders) if name), None)
+            record = _make_record(
+                self._stats, link['href'], ''.join(self._text), link.get('tags') or folder, link.get('add_date')
+            )
+            if record:
+                self.records.append(record)
+        elif tag == 'h3' and self._pending_folder is not None:
+            self._folder_name = ''.join(self._pending_folder)
+            self._pending_folder = None
+        elif tag == 'dl' and self._folders:
+            self._folders.pop()
+
+    def handle_data(self, data):
+        if self._link is not None:
+            self._text.append(data)
+        elif self._pending_folder is not None:
+            self._pending_folder.append(data)
+
+
+def _parse_html(source, stats):
+    parser = _NetscapeBookmarksParser(stats)
+    text = _text_lines(source)
+    while chunk := text.read(READ_BLOCK_SIZE):
+        parser.feed(chunk)
+        yield from parser.records
+        parser.records.clear()
+    parser.close()
+    yield from parser.records
+
+
+IMPORT_PARSERS = {
+    'html': _parse_html,
+    'csv': _parse_csv,
+    'json': _parse_json,
+    'ndjson': _parse_ndjson,
+    'text': _parse_text,
+}
+
+
+def parse_bookmarks(source, file_format: str, stats: ImportStats):
+    """
+    Построчно (или поблочно) разбирает бинарный поток source в формате file_format и отдает записи
+    (message, name, tag, timestamp). timestamp равен None, если дата в файле не указана.
+    Если файл не удается разобрать, выбрасывает ValueError.
+    """
+    return IMPORT_PARSERS[file_format](source, stats)
+
+
+async def iter_bookmarks(source, file_format: str, stats: ImportStats, batch_size: int = PARSE_BATCH_SIZE):
+    """
+    Асинхронно отдает записи parse_bookmarks. Файл разбирается пачками по batch_size записей
+    в отдельном потоке, поэтому в памяти не бывает больше одной пачки, а цикл событий не блокируется.
+    """
+    records = parse_bookmarks(source, file_format, stats)
+    while batch := await asyncio.to_thread(lambda: list(itertools.islice(records, batch_size))):
+        for record in batch:
+            yield record
+
+
+EXPORT_FORMATS = {
+    # формат: (расширение, MIME-тип)
+    'csv': ('.csv', 'text/csv'),
+    'json': ('.ndjson', 'application/x-ndjson'),
+    'html': ('.html', 'text/html'),
+}
+EXPORT_COLUMNS = ('url', 'name', 'tag', 'timestamp')
+
+
+class BookmarkExporter:
+    """
+    Пишет записи по одной в текстовый поток out в формате CSV, NDJSON или Netscape Bookmark File
+    (его понимают браузеры и импорт бота). Для HTML записи должны идти сгруппированными по тегу:
+    каждый тег становится папкой закладок.
+    """
+
+    def __init__(self, out, file_format: str):
+        self._out = out
+        self._format = file_format
+        self._csv = csv.writer(out) if file_format == 'csv' else None
+        self._folder = None
+
+    def write_header(self):
+        if self._format == 'csv':
+            self._csv.writerow(EXPORT_COLUMNS)
+        elif self._format == 'html':
+            self._out.write(
+                '<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+                '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+                '<TITLE>Bookmarks</TITLE>\n<H1>SaveLink</H1>\n<DL><p>\n'
+            )
+
+    def write_record(self, record):
+        tag = record['tag'] if record['tag'] != DEFAULT_TAG else None
+        if self._format == 'csv':
+            self._csv.writerow((record['message'], record['name'] or '', tag or '', record['timestamp'].isoformat()))
+        elif self._format == 'json':
+            line = {"url": record['message'], "name": record['name'], "tag": tag, "timestamp": record['timestamp'].isoformat()}
+            self._out.write(json.dumps(line, ensure_ascii=False) + '\n')
+        else:
+            if tag != self._folder:
+                if self._folder is not None:
+                    self._out.write('    </DL><p>\n')
+                if tag is not None:
+                    self._out.write(f'    <DT><H3>{html.escape(tag)}</H3>\n    <DL><p>\n')
+                self._folder = tag
+            indent = '        ' if tag is not None else '    '
+            tags = f' TAGS="{html.escape(tag)}"' if tag is not None else ''
+            self._out.write(
+                f'{indent}<DT><A HREF="{html.escape(record["message"])}" '
+                f'ADD_DATE="{int(record["timestamp"].timestamp())}"{tags}>'
+                f'{html.escape(record["name"] or record["message"])}</A>\n'
+            )
+
+    def write_footer(self):
+        if self._format == 'html':
+            if self._folder is not None:
+                self._out.write('    </DL><p>\n')
+            self._out.write('</DL><p>\n')
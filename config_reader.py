@@ -1,12 +1,66 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr
+from typing import Literal
 
 class Settings(BaseSettings):
     bot_token: SecretStr
+    # Владелец бота; в многопользовательском режиме - администратор, управляющий списком пользователей
     allowed_user_id: int
+    # Многопользовательский режим: список пользователей хранится в таблице bot_users
+    multi_user: bool = False
+    # Как часто (в секундах) перечитывать список пользователей из базы
+    allowlist_ttl: int = 60
+    # Лимит записей на пользователя по умолчанию (0 - без ограничений); переопределяется в bot_users
+    user_max_records: int = 0
+    # Лимит обновлений от одного пользователя в минуту (0 - без ограничений)
+    user_requests_per_minute: int = 0
     db_dsn: str
     redis_host: str
     redis_port: int
+    # Способ получения обновлений: polling - long polling, webhook - встроенный aiohttp-сервер
+    bot_mode: Literal['polling', 'webhook'] = 'polling'
+    # Публичный адрес (https://host), по которому Telegram доступен вебхук; к нему добавляется webhook_path
+    webhook_url: str | None = None
+    webhook_path: str = '/webhook'
+    webhook_host: str = '0.0.0.0'
+    webhook_port: int = 8080
+    # Секрет, который Telegram передает в каждом запросе к вебхуку
+    webhook_secret: SecretStr | None = None
+    # Максимальное число одновременно обрабатываемых обновлений в режиме webhook
+    webhook_max_concurrency: int = 32
+    # Порт HTTP-сервера с метриками Prometheus (/metrics); 0 - сервер не запускается
+    metrics_port: int = 0
+    # По умолчанию метрики доступны только локально; в контейнере задайте адрес внутренней сети
+    metrics_host: str = '127.0.0.1'
+    # Плановые бекапы; при нескольких экземплярах бота за балансировщиком включаются только на одном
+    run_scheduler: bool = True
+    # Подставлять название страницы (title/og:title) в записи со ссылкой, сохраненные без названия
+    fetch_titles: bool = True
+    # Фоновая проверка доступности сохраненных ссылок со сводкой нерабочих ссылок владельцу записей
+    check_links: bool = True
+    # Как часто (в часах) запускать проверку; каждая ссылка проверяется по своему расписанию
+    link_check_interval_hours: int = 24
+    # Формат резервных копий: plain (SQL + gzip), custom или directory (pg_dump -Fc / -Fd)
+    backup_format: Literal['plain', 'custom', 'directory'] = 'plain'
+    # Число параллельных процессов pg_dump и pg_restore для формата directory;
+    # при горячем восстановлении - число соединений, которые строят индексы теневой таблицы
+    backup_jobs: int = 4
+    # Способ восстановления: hot - загрузка в теневую схему и атомарная замена таблицы без остановки бота,
+    # replace - восстановление дампа поверх рабочих таблиц
+    restore_mode: Literal['hot', 'replace'] = 'hot'
+    # Интервал плановых бекапов в часах (по умолчанию раз в две недели)
+    backup_interval_hours: int = 336
+    # Инкрементальные бекапы: между полными дампами выгружаются только изменившиеся записи
+    incremental_backups: bool = False
+    # Каждый N-й плановый бекап в инкрементальном режиме делается полным
+    full_backup_every: int = 24
+    # Хранение бекапов на Google Drive: после каждого успешного планового бекапа остаются
+    # backup_keep_last последних полных бекапов и по одному за последние дни, недели и месяцы
+    backup_retention: bool = True
+    backup_keep_last: int = 3
+    backup_keep_daily: int = 7
+    backup_keep_weekly: int = 4
+    backup_keep_monthly: int = 6
     
     model_config = SettingsConfigDict(
         secrets_dir='/run/secrets'
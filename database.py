@@ -2,31 +2,74 @@ import asyncpg
 import logging
 from datetime import datetime
 from config_reader import config
+from metrics import TimedAcquire, register_pool_collector, timed_query
+from migrations import run_migrations
+from url_normalizer import url_hash
 
 # Глобальная переменная для хранения пула соединений
 pool = None
+# Клиент Redis для кеша счетчиков тегов (None - кеш отключен)
+cache = None
 
-async def init_db():
-    """Инициализирует пул соединений с PostgreSQL и создает таблицы."""
-    global pool
+# Время жизни закешированной карты тег -> количество записей, в секундах
+TAG_CACHE_TTL = 3600
+# Сколько строк серверный курсор выбирает за один запрос при выгрузке записей
+EXPORT_PREFETCH = 500
+# Размер пачки при заполнении хешей ссылок для записей, сохраненных до их появления
+URL_HASH_BACKFILL_BATCH = 1000
+# Служебное поле хеша: отличает закешированный пустой набор тегов от отсутствия кеша.
+# Тег не может быть пустой строкой, поэтому коллизий с реальными тегами нет.
+_TAG_CACHE_MARKER = ""
+# Каждое изменение тегов увеличивает версию кеша пользователя. get_tags запоминает версию до чтения
+# из базы и записывает карту, только если версия не изменилась: иначе снимок мог устареть
+# (запись сохранена между чтением и записью кеша, а ее HINCRBY пришелся на пустой кеш).
+# KEYS: карта тегов, версия; ARGV: ожидаемая версия, TTL, затем пары тег-количество
+_TAG_CACHE_SET_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+# Увеличивает версию и счетчик тега, если карта тегов пользователя уже есть в кеше.
+# KEYS: карта тегов, версия; ARGV: тег, изменение, TTL
+_TAG_CACHE_INCR_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+"""
+# Увеличивает версию и удаляет карту тегов. KEYS: карта тегов, версия; ARGV: TTL
+_TAG_CACHE_INVALIDATE_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[1])
+"""
+
+# Размеры пула отдаются в метрики Prometheus при каждом запросе /metrics
+register_pool_collector(lambda: pool)
+
+class QuotaExceededError(Exception):
+    """Пользователь исчерпал лимит числа записей."""
+
+
+async def init_db(redis_client=None):
+    """Инициализирует пул соединений с PostgreSQL, применяет миграции схемы и подключает кеш тегов."""
+    global pool, cache
     if pool:
         return
         
+    cache = redis_client
     try:
         pool = await asyncpg.create_pool(dsn=config.db_dsn)
-        async with pool.acquire() as connection:
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    message TEXT NOT NULL,
-                    name TEXT,
-                    tag TEXT DEFAULT 'no_tag',
-                    timestamp TIMESTAMPTZ NOT NULL,
-                    UNIQUE(user_id, message, tag)
-                )
-            ''')
-        logging.info("Пул соединений с PostgreSQL успешно создан и таблица проверена.")
+        async with TimedAcquire(pool) as connection:
+            await run_migrations(connection)
+        logging.info("Пул соединений с PostgreSQL успешно создан и миграции схемы применены.")
+        await backfill_url_hashes()
     except Exception as e:
         logging.error(f"Не удалось инициализировать пул соединений с базой данных: {e}")
         raise
@@ -50,15 +93,40 @@ async def validate_tag(tag: str) -> tuple[bool, str]:
         return False, "Тег не должен превышать 100 символов!"
     return True, ""
 
+@timed_query
 async def save_message(user_id: int, message: str, tag: str = "no_tag", name: str = None, timestamp: datetime = None):
+    """
+    Сохраняет запись, если пользователь не исчерпал лимит записей.
+    Ссылка считается дубликатом, если у пользователя уже есть запись с той же канонической формой
+    под любым тегом. Возвращает id новой записи, False для дубликата или при ошибке;
+    выбрасывает QuotaExceededError, если лимит исчерпан.
+    """
     ts = timestamp or datetime.now()
     try:
-        async with pool.acquire() as connection:
-            await connection.execute(
-                'INSERT INTO messages (user_id, message, tag, name, timestamp) VALUES ($1, $2, $3, $4, $5)',
-                user_id, message, tag.strip(), name, ts
+        async with TimedAcquire(pool) as connection:
+            # Лимит и дубликат ссылки проверяются тем же запросом по индексам, без отдельных обращений к базе
+            row = await connection.fetchrow(
+                'WITH duplicate AS ('
+                'SELECT 1 FROM messages WHERE user_id = $1 AND url_hash = $7 LIMIT 1'
+                '), inserted AS ('
+                'INSERT INTO messages (user_id, message, tag, name, timestamp, url_hash) '
+                'SELECT $1, $2, $3, $4, $5, $7 WHERE NOT EXISTS (SELECT 1 FROM duplicate) AND COALESCE('
+                '(SELECT total_records FROM user_stats WHERE user_id = $1), 0'
+                ') < COALESCE((SELECT max_records FROM bot_users WHERE user_id = $1), $6, 2147483647) '
+                'RETURNING id'
+                ') SELECT (SELECT id FROM inserted) AS id, EXISTS (SELECT 1 FROM duplicate) AS duplicate',
+                user_id, message, tag.strip(), name, ts, config.user_max_records or None, url_hash(message)
             )
-        return True
+        if row['duplicate']:
+            logging.warning(f"Попытка сохранить дублирующуюся ссылку для пользователя {user_id}.")
+            return False
+        if row['id'] is None:
+            raise QuotaExceededError(user_id)
+        await _incr_cached_tag(user_id, tag.strip(), 1)
+        return row['id']
+    except QuotaExceededError:
+        logging.info(f"Пользователь {user_id} исчерпал лимит записей.")
+        raise
     except asyncpg.UniqueViolationError:
         logging.warning(f"Попытка сохранить дублирующуюся запись для пользователя {user_id}.")
         return False
@@ -66,108 +134,652 @@ async def save_message(user_id: int, message: str, tag: str = "no_tag", name: st
         logging.error(f"Не удалось сохранить сообщение для пользователя {user_id}: {e}")
         return False
 
-async def get_messages(user_id: int):
+@timed_query
+async def save_messages(user_id: int, messages: list[str], tag: str = "no_tag", timestamp: datetime = None):
+    """
+    Сохраняет несколько записей одним запросом (unnest), соблюдая лимит записей пользователя.
+    messages не должен содержать повторов; ссылки, совпадающие по канонической форме с сохраненными
+    или с ссылками раньше в списке, считаются дубликатами. Возвращает список (запись, статус, id) в исходном порядке,
+    где статус - 'saved', 'duplicate' или 'over_quota', а id задан только для сохраненных записей,
+    либо None в случае ошибки.
+    """
+    ts = timestamp or datetime.now()
+    tag = tag.strip()
     try:
-        async with pool.acquire() as connection:
-            rows = await connection.fetch('SELECT id, message, tag, name, timestamp FROM messages WHERE user_id = $1 ORDER BY timestamp DESC', user_id)
-            return rows
+        async with TimedAcquire(pool) as connection:
+            rows = await connection.fetch(
+                'WITH input AS ('
+                'SELECT message, url_hash, ord FROM unnest($2::text[], $6::bigint[]) '
+                'WITH ORDINALITY AS u(message, url_hash, ord)'
+                '), new_records AS ('
+                'SELECT message, url_hash, ord FROM input i WHERE NOT EXISTS ('
+                'SELECT 1 FROM messages m WHERE m.user_id = $1 AND m.tag = $3 '
+                'AND m.message_hash = decode(md5(i.message), \'hex\')'
+                ') AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.user_id = $1 AND m.url_hash = i.url_hash'
+                ') AND NOT EXISTS (SELECT 1 FROM input j WHERE j.url_hash = i.url_hash AND j.ord < i.ord)'
+                '), inserted AS ('
+                'INSERT INTO messages (user_id, message, tag, timestamp, url_hash) '
+                'SELECT $1, message, $3, $4, url_hash FROM new_records ORDER BY ord '
+                'LIMIT GREATEST(COALESCE((SELECT max_records FROM bot_users WHERE user_id = $1), $5, 2147483647) '
+                '- COALESCE((SELECT total_records FROM user_stats WHERE user_id = $1), 0), 0) '
+                'ON CONFLICT DO NOTHING RETURNING id, message'
+                ') SELECT i.message, s.id, s.message IS NOT NULL AS saved, n.message IS NOT NULL AS is_new '
+                'FROM input i LEFT JOIN inserted s USING (message) LEFT JOIN new_records n USING (message) '
+                'ORDER BY i.ord',
+                user_id, messages, tag, ts, config.user_max_records or None,
+                [url_hash(message) for message in messages]
+            )
     except Exception as e:
-        logging.error(f"Не удалось получить сообщения для пользователя {user_id}: {e}")
-        return []
+        logging.error(f"Не удалось сохранить {len(messages)} записей для пользователя {user_id}: {e}")
+        return None
+
+    saved = sum(row['saved'] for row in rows)
+    if saved:
+        await _incr_cached_tag(user_id, tag, saved)
+    return [
+        (row['message'], 'saved' if row['saved'] else 'over_quota' if row['is_new'] else 'duplicate', row['id'])
+        for row in rows
+    ]
+
+@timed_query
+async def import_messages(user_id: int, records):
+    """
+    Массово загружает записи (message, name, tag, timestamp) из асинхронного итератора records
+    через COPY во временную таблицу (записи не собираются в памяти)
+    и переносит в messages одним запросом: повторы внутри файла и уже сохраненные записи
+    пропускаются по тому же ключу, что и уникальный индекс (user_id, tag, message_hash),
+    а ссылки - также по хешу канонической формы независимо от тега.
+    Лимит записей пользователя соблюдается: лишние записи не добавляются.
+    Возвращает словарь со счетчиками total, inserted, duplicates, over_quota или None в случае ошибки.
+    """
+    try:
+        async with TimedAcquire(pool) as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    'CREATE TEMP TABLE import_staging ('
+                    'ord BIGSERIAL, message TEXT NOT NULL, name TEXT, tag TEXT NOT NULL, timestamp TIMESTAMPTZ, '
+                    'url_hash BIGINT'
+                    ') ON COMMIT DROP'
+                )
+                await connection.copy_records_to_table(
+                    'import_staging',
+                    records=((message, name, tag, ts, url_hash(message)) async for message, name, tag, ts in records),
+                    columns=['message', 'name', 'tag', 'timestamp', 'url_hash']
+                )
+                await connection.execute('CREATE INDEX ON import_staging (url_hash, ord)')
+                remaining = await connection.fetchval(
+                    'SELECT COALESCE((SELECT max_records FROM bot_users WHERE user_id = $1), $2) '
+                    '- COALESCE((SELECT total_records FROM user_stats WHERE user_id = $1), 0)',
+                    user_id, config.user_max_records or None
+                )
+                row = await connection.fetchrow(
+                    'WITH new_records AS ('
+                    'SELECT DISTINCT ON (tag, decode(md5(message), \'hex\')) ord, message, name, tag, timestamp, url_hash '
+                    'FROM import_staging s WHERE NOT EXISTS ('
+                    'SELECT 1 FROM messages m WHERE m.user_id = $1 AND m.tag = s.tag '
+                    'AND m.message_hash = decode(md5(s.message), \'hex\')'
+                    ') AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.user_id = $1 AND m.url_hash = s.url_hash'
+                    ') AND NOT EXISTS (SELECT 1 FROM import_staging t WHERE t.url_hash = s.url_hash AND t.ord < s.ord'
+                    ') ORDER BY tag, decode(md5(message), \'hex\'), ord'
+                    '), inserted AS ('
+                    'INSERT INTO messages (user_id, message, name, tag, timestamp, url_hash) '
+                    'SELECT $1, message, name, tag, COALESCE(timestamp, now()), url_hash FROM new_records '
+                    'ORDER BY ord LIMIT $2 ON CONFLICT DO NOTHING RETURNING 1'
+                    ') SELECT (SELECT COUNT(*) FROM import_staging) AS total, '
+                    '(SELECT COUNT(*) FROM new_records) AS new, (SELECT COUNT(*) FROM inserted) AS inserted',
+                    user_id, max(remaining, 0) if remaining is not None else None
+                )
+        await invalidate_tag_cache(user_id)
+    except Exception as e:
+        logging.error(f"Не удалось импортировать записи для пользователя {user_id}: {e}")
+        return None
+
+    logging.info(f"Импорт для пользователя {user_id}: {row['inserted']} из {row['total']} записей добавлено.")
+    return {
+        "total": row['total'],
+        "inserted": row['inserted'],
+        "duplicates": row['total'] - row['new'],
+        "over_quota": row['new'] - row['inserted'],
+    }
+
+@timed_query
+async def get_messages_page(user_id: int, limit: int, cursor: tuple[datetime, int] | None = None, backward: bool = False, tag: str = None):
+    """
+    Возвращает одну страницу записей пользователя (от новых к старым) с keyset-пагинацией.
+    cursor - пара (timestamp, id) граничной записи: при backward=False берутся записи
+    старше курсора, при backward=True - новее. Если указан tag, выборка ограничена этим тегом.
+    Возвращает (rows, has_more), где has_more показывает, есть ли еще записи дальше
+    в направлении выборки.
+    """
+    conditions = ['user_id = $1']
+    args = [user_id]
+    if tag is not None:
+        args.append(tag)
+        conditions.append(f'tag = ${len(args)}')
+    if cursor is not None:
+        args.extend(cursor)
+        comparison = '>' if backward else '<'
+        conditions.append(f'(timestamp, id) {comparison} (${len(args) - 1}, ${len(args)})')
+    order = 'ASC' if backward else 'DESC'
+    args.append(limit + 1)
+    query = (
+        f"SELECT id, message, tag, name, timestamp FROM messages WHERE {' AND '.join(conditions)} "
+        f"ORDER BY timestamp {order}, id {order} LIMIT ${len(args)}"
+    )
+    try:
+        async with TimedAcquire(pool) as connection:
+            rows = await connection.fetch(query, *args)
+    except Exception as e:
+        logging.error(f"Не удалось получить страницу записей для пользователя {user_id}: {e}")
+        return [], False
 
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+@timed_query
+async def search_messages(user_id: int, query: str, limit: int, offset: int = 0):
+    """
+    Ищет записи пользователя по ссылке и названию: полнотекстово (tsvector) и нечетко
+    по триграммам (подстроки и опечатки). Результаты упорядочены по релевантности.
+    Возвращает (rows, has_more) для страницы, начинающейся с offset.
+    """
+    # Экранируем спецсимволы LIKE, чтобы запрос искался как обычная подстрока
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    try:
+        async with TimedAcquire(pool) as connection:
+            rows = await connection.fetch(
+                "SELECT id, message, tag, name, timestamp, "
+                "ts_rank(search_vector, q) + GREATEST(word_similarity($2, message), word_similarity($2, coalesce(name, ''))) AS rank "
+                "FROM messages, websearch_to_tsquery('simple', $2) q "
+                "WHERE user_id = $1 AND ("
+                "search_vector @@ q OR message ILIKE $3 OR name ILIKE $3 OR $2 <% message OR $2 <% name"
+                ") ORDER BY rank DESC, id DESC LIMIT $4 OFFSET $5",
+                user_id, query, pattern, limit + 1, offset
+            )
+    except Exception as e:
+        logging.error(f"Не удалось выполнить поиск '{query}' для пользователя {user_id}: {e}")
+        return [], False
+    return rows[:limit], len(rows) > limit
+
+async def iter_messages(user_id: int, by_tag: bool = False):
+    """
+    Асинхронно перебирает все записи пользователя серверным курсором, не загружая их в память целиком.
+    Записи идут от новых к старым, при by_tag=True - сгруппированными по тегу.
+    Ошибки базы данных не перехватываются: прерванный перебор должен быть виден вызывающему.
+    """
+    order = 'tag, timestamp DESC, id DESC' if by_tag else 'timestamp DESC, id DESC'
+    async with TimedAcquire(pool) as connection:
+        async with connection.transaction(readonly=True):
+            async for row in connection.cursor(
+                f'SELECT id, message, tag, name, timestamp FROM messages WHERE user_id = $1 ORDER BY {order}',
+                user_id, prefetch=EXPORT_PREFETCH
+            ):
+                yield row
+
+@timed_query
 async def get_message_by_id(user_id: int, message_id: int):
     try:
-        async with pool.acquire() as connection:
+        async with TimedAcquire(pool) as connection:
             row = await connection.fetchrow('SELECT id, message, tag, name, timestamp FROM messages WHERE id = $1 AND user_id = $2', message_id, user_id)
             return row
     except Exception as e:
         logging.error(f"Не удалось получить сообщение по id {message_id} для пользователя {user_id}: {e}")
         return None
 
-async def get_tags(user_id: int):
+@timed_query
+async def find_record_by_url(user_id: int, url: str):
+    """
+    Ищет запись пользователя с той же ссылкой в канонической форме под любым тегом.
+    Проверка стоит одного обращения к индексу (user_id, url_hash). Возвращает запись или None.
+    """
+    hash_value = url_hash(url)
+    if hash_value is None:
+        return None
     try:
-        async with pool.acquire() as connection:
-            rows = await connection.fetch('SELECT tag, COUNT(*) as count FROM messages WHERE user_id = $1 GROUP BY tag ORDER BY tag', user_id)
-            return rows
+        async with TimedAcquire(pool) as connection:
+            return await connection.fetchrow(
+                'SELECT id, message, tag, name FROM messages WHERE user_id = $1 AND url_hash = $2 '
+                'ORDER BY id LIMIT 1',
+                user_id, hash_value
+            )
     except Exception as e:
-        logging.error(f"Не удалось получить теги для пользователя {user_id}: {e}")
-        return []
+        logging.error(f"Не удалось проверить ссылку на дубликат для пользователя {user_id}: {e}")
+        return None
+
+@timed_query
+async def backfill_url_hashes():
+    """
+    Заполняет хеши ссылок для записей, у которых их еще нет (сохраненных до появления хешей
+    или восстановленных из старого бекапа). Записи перебираются пачками по возрастанию id.
+    """
+    last_id = 0
+    updated = 0
+    try:
+        async with TimedAcquire(pool) as connection:
+            while True:
+                rows = await connection.fetch(
+                    # Условие совпадает с частичным индексом idx_messages_url_hash_pending:
+                    # заметки, которые не являются одной ссылкой, в него не попадают и не перебираются
+                    "SELECT id, message FROM messages WHERE id > $1 AND url_hash IS NULL "
+                    "AND message ~* '^\\s*https?://\\S+\\s*$' ORDER BY id LIMIT $2",
+                    last_id, URL_HASH_BACKFILL_BATCH
+                )
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                pairs = [(row['id'], url_hash(row['message'])) for row in rows]
+                pairs = [(record_id, hash_value) for record_id, hash_value in pairs if hash_value is not None]
+                if pairs:
+                    await connection.execute(
+                        'UPDATE messages m SET url_hash = u.url_hash '
+                        'FROM unnest($1::bigint[], $2::bigint[]) AS u(id, url_hash) WHERE m.id = u.id',
+                        [record_id for record_id, _ in pairs], [hash_value for _, hash_value in pairs]
+                    )
+                    updated += len(pairs)
+    except Exception as e:
+        logging.error(f"Не удалось заполнить хеши ссылок: {e}")
+        return
+    if updated:
+        logging.info(f"Заполнены хеши ссылок для {updated} записей.")
+
+def _tag_cache_key(user_id: int) -> str:
+    return f"tag_counts:{user_id}"
+
+def _tag_cache_version_key(user_id: int) -> str:
+    return f"tag_counts_version:{user_id}"
+
+async def _get_cached_tags(user_id: int):
+    """Возвращает список (тег, количество) из кеша или None, если кеша нет."""
+    if cache is None:
+        return None
+    try:
+        cached = await cache.hgetall(_tag_cache_key(user_id))
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать кеш тегов для пользователя {user_id}: {e}")
+        return None
+    if not cached:
+        return None
+    tags = [(tag.decode(), int(count)) for tag, count in cached.items() if tag.decode() != _TAG_CACHE_MARKER]
+    return sorted(tag for tag in tags if tag[1] > 0)
+
+async def _get_tag_cache_version(user_id: int):
+    """Возвращает текущую версию кеша тегов пользователя или None, если кеш недоступен."""
+    if cache is None:
+        return None
+    try:
+        version = await cache.get(_tag_cache_version_key(user_id))
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать версию кеша тегов для пользователя {user_id}: {e}")
+        return None
+    return version.decode() if version is not None else '0'
+
+async def _set_cached_tags(user_id: int, tags: list, version: str):
+    """Записывает карту тегов, если с момента чтения версии version теги не менялись."""
+    if cache is None:
+        return
+    args = [version, TAG_CACHE_TTL, _TAG_CACHE_MARKER, 0]
+    for tag, count in tags:
+        args += [tag, count]
+    try:
+        await cache.eval(_TAG_CACHE_SET_SCRIPT, 2, _tag_cache_key(user_id), _tag_cache_version_key(user_id), *args)
+    except Exception as e:
+        logging.warning(f"Не удалось записать кеш тегов для пользователя {user_id}: {e}")
+
+async def _incr_cached_tag(user_id: int, tag: str, delta: int):
+    """Обновляет счетчик тега в кеше, не создавая кеш, если его еще нет."""
+    if cache is None:
+        return
+    try:
+        await cache.eval(
+            _TAG_CACHE_INCR_SCRIPT, 2, _tag_cache_key(user_id), _tag_cache_version_key(user_id),
+            tag, delta, TAG_CACHE_TTL
+        )
+    except Exception as e:
+        logging.warning(f"Не удалось обновить кеш тегов для пользователя {user_id}: {e}")
+        await invalidate_tag_cache(user_id)
+
+async def invalidate_tag_cache(user_id: int):
+    """Сбрасывает кеш тегов пользователя. Следующий get_tags перечитает их из базы."""
+    if cache is None:
+        return
+    try:
+        await cache.eval(
+            _TAG_CACHE_INVALIDATE_SCRIPT, 2, _tag_cache_key(user_id), _tag_cache_version_key(user_id), TAG_CACHE_TTL
+        )
+    except Exception as e:
+        logging.warning(f"Не удалось сбросить кеш тегов для пользователя {user_id}: {e}")
+
+async def invalidate_all_tag_caches():
+    """Сбрасывает кеш тегов всех пользователей, например после восстановления базы из бекапа."""
+    if cache is None:
+        return
+    try:
+        keys = [key async for key in cache.scan_iter(match=_tag_cache_key('*'))]
+        keys += [key async for key in cache.scan_iter(match=_tag_cache_version_key('*'))]
+        user_ids = {int(key.decode().rsplit(':', 1)[1]) for key in keys}
+        async with cache.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.eval(
+                    _TAG_CACHE_INVALIDATE_SCRIPT, 2, _tag_cache_key(user_id), _tag_cache_version_key(user_id),
+                    TAG_CACHE_TTL
+                )
+            await pipe.execute()
+    except Exception as e:
+        logging.warning(f"Не удалось сбросить кеш тегов: {e}")
+
+async def reload_pool():
+    """
+    Обновляет соединения пула после замены таблиц: свободные соединения пересоздаются при следующем
+    acquire(), занятые - после возврата в пул, поэтому кешированные подготовленные запросы
+    не ссылаются на удаленные таблицы. Также сбрасывает кеш тегов всех пользователей
+    и заполняет хеши ссылок, которых может не быть в старых бекапах.
+    """
+    await pool.expire_connections()
+    await invalidate_all_tag_caches()
+    await backfill_url_hashes()
+    logging.info("Соединения пула PostgreSQL обновлены.")
 
-async def get_messages_by_tag(user_id: int, tag: str):
+@timed_query
+async def get_tags(user_id: int):
+    """Возвращает список пар (тег, количество записей), отсортированный по тегу."""
+    cached = await _get_cached_tags(user_id)
+    if cached is not None:
+        return cached
+    # Версия читается до запроса к базе, чтобы не закешировать снимок, устаревший за время запроса
+    version = await _get_tag_cache_version(user_id)
     try:
-        async with pool.acquire() as connection:
-            rows = await connection.fetch("SELECT id, message, name, timestamp FROM messages WHERE user_id = $1 AND tag = $2 ORDER BY timestamp DESC", user_id, tag)
-            return rows
+        async with TimedAcquire(pool) as connection:
+            rows = await connection.fetch('SELECT tag, count FROM user_tag_counts WHERE user_id = $1 ORDER BY tag', user_id)
     except Exception as e:
-        logging.error(f"Не удалось получить сообщения по тегу '{tag}' для пользователя {user_id}: {e}")
+        logging.error(f"Не удалось получить теги для пользователя {user_id}: {e}")
         return []
+    tags = [(row['tag'], row['count']) for row in rows]
+    if version is not None:
+        await _set_cached_tags(user_id, tags, version)
+    return tags
 
+@timed_query
 async def delete_messages(user_id: int):
     try:
-        async with pool.acquire() as connection:
+        async with TimedAcquire(pool) as connection:
             await connection.execute('DELETE FROM messages WHERE user_id = $1', user_id)
+        await invalidate_tag_cache(user_id)
         logging.info(f"Все сообщения удалены для пользователя {user_id}.")
         return True
     except Exception as e:
         logging.error(f"Не удалось удалить все сообщения для пользователя {user_id}: {e}")
         return False
 
+@timed_query
 async def delete_message_by_id(user_id: int, message_id: int):
     try:
-        async with pool.acquire() as connection:
+        async with TimedAcquire(pool) as connection:
             await connection.execute('DELETE FROM messages WHERE user_id = $1 AND id = $2', user_id, message_id)
+        await invalidate_tag_cache(user_id)
         return True
     except Exception as e:
         logging.error(f"Не удалось удалить сообщение по id {message_id} для пользователя {user_id}: {e}")
         return False
 
-async def update_record_field(record_id: int, field: str, value: str):
+@timed_query
+async def update_record_field(user_id: int, record_id: int, field: str, value: str):
+    """Изменяет поле записи пользователя. Возвращает False, если запись не найдена или при ошибке."""
     allowed_fields = ["name", "message", "tag"]
     if field not in allowed_fields:
         logging.error(f"Попытка обновить неразрешенное поле: {field}")
         return False
     try:
-        async with pool.acquire() as connection:
-            query = f"UPDATE messages SET {field} = $1 WHERE id = $2"
-            await connection.execute(query, value, record_id)
+        async with TimedAcquire(pool) as connection:
+            if field == "message":
+                # Хеш канонической формы ссылки меняется вместе с текстом записи
+                status = await connection.execute(
+                    "UPDATE messages SET message = $1, url_hash = $4 WHERE id = $2 AND user_id = $3",
+                    value, record_id, user_id, url_hash(value)
+                )
+            else:
+                query = f"UPDATE messages SET {field} = $1 WHERE id = $2 AND user_id = $3"
+                status = await connection.execute(query, value, record_id, user_id)
+        if status == 'UPDATE 0':
+            logging.warning(f"Запись {record_id} пользователя {user_id} для изменения не найдена.")
+            return False
+        if field == "tag":
+            await invalidate_tag_cache(user_id)
         logging.info(f"Поле '{field}' записи {record_id} было обновлено.")
         return True
     except Exception as e:
         logging.error(f"Не удалось обновить запись {record_id}: {e}")
         return False
 
-# (ИЗМЕНЕНИЕ): Новая функция для получения статистики
+@timed_query
+async def set_record_name_if_empty(user_id: int, record_id: int, name: str):
+    """Записывает название записи пользователя, только если он еще не задал его сам."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            status = await connection.execute(
+                'UPDATE messages SET name = $1 WHERE id = $2 AND user_id = $3 AND name IS NULL',
+                name, record_id, user_id
+            )
+        return status != 'UPDATE 0'
+    except Exception as e:
+        logging.error(f"Не удалось записать название записи {record_id}: {e}")
+        return False
+
+@timed_query
 async def get_stats(user_id: int):
     """
-    Собирает статистику по записям пользователя.
+    Собирает статистику по записям пользователя из счетчиков user_stats и user_tag_counts,
+    которые поддерживаются триггерами на таблице messages.
     Возвращает словарь со статистикой или None в случае ошибки.
     """
     try:
-        async with pool.acquire() as connection:
-            # Общее количество записей
-            total_records_result = await connection.fetchval(
-                'SELECT COUNT(*) FROM messages WHERE user_id = $1',
+        async with TimedAcquire(pool) as connection:
+            row = await connection.fetchrow(
+                "SELECT s.total_records, s.total_tags, t.tag, t.count FROM user_stats s "
+                "LEFT JOIN LATERAL ("
+                "SELECT tag, count FROM user_tag_counts WHERE user_id = s.user_id AND tag != 'no_tag' "
+                "ORDER BY count DESC, tag ASC LIMIT 1"
+                ") t ON TRUE WHERE s.user_id = $1",
                 user_id
             )
+    except Exception as e:
+        logging.error(f"Не удалось получить статистику для пользователя {user_id}: {e}")
+        return None
 
-            # Количество уникальных тегов (исключая 'no_tag')
-            total_tags_result = await connection.fetchval(
-                "SELECT COUNT(DISTINCT tag) FROM messages WHERE user_id = $1 AND tag != 'no_tag'",
-                user_id
+    if row is None:
+        return {"total_records": 0, "total_tags": 0, "popular_tag_info": None}
+    return {
+        "total_records": row['total_records'],
+        "total_tags": row['total_tags'],
+        "popular_tag_info": {"tag": row['tag'], "count": row['count']} if row['tag'] else None
+    }
+
+@timed_query
+async def rebuild_stats(user_id: int = None):
+    """
+    Пересчитывает счетчики статистики с нуля по таблице messages
+    для пользователя или для всех пользователей, если user_id не указан.
+    """
+    try:
+        async with TimedAcquire(pool) as connection:
+            async with connection.transaction():
+                await connection.execute('SELECT rebuild_message_stats($1)', user_id)
+        if user_id is not None:
+            await invalidate_tag_cache(user_id)
+        logging.info(f"Счетчики статистики пересчитаны (пользователь: {user_id or 'все'}).")
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось пересчитать статистику (пользователь: {user_id or 'все'}): {e}")
+        return False
+
+@timed_query
+async def get_backup_state():
+    """Возвращает состояние бекапов (last_backup_at, cycles_since_full) или None в случае ошибки."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            return await connection.fetchrow('SELECT last_backup_at, cycles_since_full FROM backup_state')
+    except Exception as e:
+        logging.error(f"Не удалось получить состояние бекапов: {e}")
+        return None
+
+@timed_query
+async def save_backup_state(last_backup_at: datetime | None, cycles_since_full: int):
+    """Сохраняет момент, на который снят последний бекап, и число инкрементов после полного бекапа."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute(
+                'UPDATE backup_state SET last_backup_at = $1, cycles_since_full = $2',
+                last_backup_at, cycles_since_full
             )
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось сохранить состояние бекапов: {e}")
+        return False
 
-            # Самый популярный тег
-            most_popular_tag_result = await connection.fetchrow(
-                "SELECT tag, COUNT(*) as count FROM messages WHERE user_id = $1 AND tag != 'no_tag' "
-                "GROUP BY tag ORDER BY count DESC, tag ASC LIMIT 1",
-                user_id
+@timed_query
+async def prune_tombstones(before: datetime):
+    """Удаляет записи об удалениях, которые уже покрыты полным бекапом."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute('DELETE FROM deleted_messages WHERE deleted_at < $1', before)
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось очистить журнал удалений: {e}")
+        return False
+
+@timed_query
+async def get_links_to_check(after_id: int, limit: int):
+    """
+    Возвращает следующую пачку записей-ссылок (по возрастанию id после after_id), которые пора проверить:
+    еще не проверенные, измененные после проверки или с наступившим сроком повторной проверки.
+    """
+    try:
+        async with TimedAcquire(pool) as connection:
+            return await connection.fetch(
+                'SELECT m.id, m.user_id, m.message, m.url_hash, c.etag, c.last_modified, '
+                'COALESCE(c.ok_streak, 0) AS ok_streak, COALESCE(c.failures, 0) AS failures '
+                'FROM messages m LEFT JOIN link_checks c ON c.message_id = m.id AND c.url_hash = m.url_hash '
+                # Проверяются только записи из одной ссылки, а не заметки, которые с нее начинаются
+                'WHERE m.id > $1 AND m.url_hash IS NOT NULL AND m.message ~* \'^\\s*https?://\\S+\\s*$\' '
+                'AND (c.message_id IS NULL OR c.next_check_at <= now()) '
+                'ORDER BY m.id LIMIT $2',
+                after_id, limit
             )
+    except Exception as e:
+        logging.error(f"Не удалось получить ссылки для проверки: {e}")
+        return []
 
-            return {
-                "total_records": total_records_result or 0,
-                "total_tags": total_tags_result or 0,
-                "popular_tag_info": most_popular_tag_result # Может быть None
-            }
+@timed_query
+async def save_link_checks(results):
+    """
+    Сохраняет результаты проверки ссылок одним запросом. results - список кортежей
+    (message_id, url_hash, status, recheck_after_seconds, ok_streak, failures, etag, last_modified, broken).
+    Момент, с которого ссылка нерабочая, и отметка об уведомлении сохраняются, пока она остается нерабочей.
+    """
+    if not results:
+        return True
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute(
+                'INSERT INTO link_checks AS c (message_id, url_hash, status, checked_at, next_check_at, '
+                'ok_streak, failures, etag, last_modified, broken_since) '
+                'SELECT message_id, url_hash, status, now(), now() + recheck_after * interval \'1 second\', '
+                'ok_streak, failures, etag, last_modified, CASE WHEN broken THEN now() END '
+                'FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::int[], $5::int[], $6::int[], '
+                '$7::text[], $8::text[], $9::bool[]) '
+                'AS u(message_id, url_hash, status, recheck_after, ok_streak, failures, etag, last_modified, broken) '
+                'ON CONFLICT (message_id) DO UPDATE SET '
+                'status = EXCLUDED.status, checked_at = EXCLUDED.checked_at, next_check_at = EXCLUDED.next_check_at, '
+                'ok_streak = EXCLUDED.ok_streak, failures = EXCLUDED.failures, '
+                'etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified, '
+                'broken_since = CASE WHEN EXCLUDED.broken_since IS NULL OR c.url_hash <> EXCLUDED.url_hash '
+                'THEN EXCLUDED.broken_since ELSE COALESCE(c.broken_since, EXCLUDED.broken_since) END, '
+                'reported = CASE WHEN EXCLUDED.broken_since IS NULL OR c.url_hash <> EXCLUDED.url_hash '
+                'OR c.broken_since IS NULL THEN FALSE ELSE c.reported END, '
+                'url_hash = EXCLUDED.url_hash',
+                *(list(column) for column in zip(*results))
+            )
+        return True
     except Exception as e:
-        logging.error(f"Не удалось получить статистику для пользователя {user_id}: {e}")
-        return None
\ No newline at end of file
+        logging.error(f"Не удалось сохранить результаты проверки {len(results)} ссылок: {e}")
+        return False
+
+@timed_query
+async def get_unreported_broken_links():
+    """Возвращает нерабочие ссылки, о которых пользователям еще не сообщалось, сгруппированные по user_id."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            return await connection.fetch(
+                'SELECT m.id, m.user_id, m.message, m.name, c.status '
+                'FROM link_checks c JOIN messages m ON m.id = c.message_id AND m.url_hash = c.url_hash '
+                'WHERE c.broken_since IS NOT NULL AND NOT c.reported ORDER BY m.user_id, m.id'
+            )
+    except Exception as e:
+        logging.error(f"Не удалось получить список нерабочих ссылок: {e}")
+        return []
+
+@timed_query
+async def mark_broken_links_reported(message_ids: list[int]):
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute(
+                'UPDATE link_checks SET reported = TRUE WHERE message_id = ANY($1::bigint[])', message_ids
+            )
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось отметить нерабочие ссылки как отправленные: {e}")
+        return False
+
+@timed_query
+async def prune_link_checks():
+    """Удаляет результаты проверок удаленных записей."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute(
+                'DELETE FROM link_checks c WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.id = c.message_id)'
+            )
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось удалить устаревшие результаты проверки ссылок: {e}")
+        return False
+
+@timed_query
+async def get_allowed_users():
+    """Возвращает пользователей бота (user_id, max_records, added_at) или None в случае ошибки."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            return await connection.fetch('SELECT user_id, max_records, added_at FROM bot_users ORDER BY added_at')
+    except Exception as e:
+        logging.error(f"Не удалось получить список пользователей бота: {e}")
+        return None
+
+@timed_query
+async def add_allowed_user(user_id: int, max_records: int = None):
+    """Добавляет пользователя бота или меняет его лимит записей (None - лимит по умолчанию)."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            await connection.execute(
+                'INSERT INTO bot_users (user_id, max_records) VALUES ($1, $2) '
+                'ON CONFLICT (user_id) DO UPDATE SET max_records = EXCLUDED.max_records',
+                user_id, max_records
+            )
+        logging.info(f"Пользователь {user_id} добавлен в список доступа (лимит записей: {max_records}).")
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось добавить пользователя {user_id}: {e}")
+        return False
+
+@timed_query
+async def remove_allowed_user(user_id: int):
+    """Удаляет пользователя из списка доступа. Его записи остаются в базе."""
+    try:
+        async with TimedAcquire(pool) as connection:
+            status = await connection.execute('DELETE FROM bot_users WHERE user_id = $1', user_id)
+        if status != 'DELETE 0':
+            logging.info(f"Пользователь {user_id} удален из списка доступа.")
+        return status != 'DELETE 0'
+    except Exception as e:
+        logging.error(f"Не удалось удалить пользователя {user_id}: {e}")
+        return False
@@ -0,0 +1,46 @@
+import html
+
+# Максимальная длина текста одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Ограничения длины полей при выводе записи в списке, чтобы одна запись
+# не занимала все сообщение целиком
+NAME_PREVIEW_LIMIT = 300
+LINK_PREVIEW_LIMIT = 1000
+
+def _shorten(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit] + '...'
+
+def format_record_block(index: int, record) -> str:
+    """Форматирует запись в HTML-блок для вывода в списке под номером index."""
+    formatted_date = record['timestamp'].strftime('%d.%m.%Y')
+    safe_text = html.escape(_shorten(str(record['message']), LINK_PREVIEW_LIMIT))
+    if record['name']:
+        safe_name = html.escape(_shorten(str(record['name']), NAME_PREVIEW_LIMIT))
+    else:
+        safe_name = "<i>(нет названия)</i>"
+    return (
+        f"<b>{index}.</b> <b>Название:</b> {safe_name}\n"
+        f"<b>Ссылка:</b> {safe_text}\n"
+        f"<b>Дата:</b> {formatted_date}"
+    )
+
+def pack_records(header: str, records: list, from_end: bool = False) -> tuple[str, list]:
+    """
+    Упаковывает записи в один текст сообщения, не превышающий MESSAGE_LIMIT.
+    Возвращает (текст, вошедшие записи). Если все записи не помещаются, при from_end=False
+    отбрасываются последние записи, при from_end=True - первые.
+    """
+    blocks = []
+    length = len(header)
+    candidates = list(reversed(records)) if from_end else list(records)
+    for record in candidates:
+        # Нумерация уточняется после отбора, пока учитываем максимально длинный номер
+        block = format_record_block(len(records), record)
+        if blocks and length + len("\n\n") + len(block) > MESSAGE_LIMIT:
+            break
+        blocks.append(record)
+        length += len("\n\n") + len(block)
+
+    included = list(reversed(blocks)) if from_end else blocks
+    text = "\n\n".join([header] + [format_record_block(i, r) for i, r in enumerate(included, start=1)])
+    return text, included
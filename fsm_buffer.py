@@ -0,0 +1,126 @@
+import time
+from typing import Any, Awaitable, Callable, Mapping
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import TelegramObject
+
+from metrics import REDIS_FSM_SECONDS
+
+
+class BufferedFSMContext(FSMContext):
+    """
+    FSMContext, который читает состояние и данные из RedisStorage одним запросом MGET,
+    держит изменения в памяти и записывает их обратно одной транзакцией в flush().
+    Хранит значения в тех же ключах и формате, что и RedisStorage, поэтому совместим с ним.
+    """
+
+    def __init__(self, storage: RedisStorage, key: StorageKey):
+        super().__init__(storage=storage, key=key)
+        self._state: str | None = None
+        self._data: dict[str, Any] = {}
+        self._state_changed = False
+        self._data_changed = False
+
+    def _redis_key(self, part: str) -> str:
+        return self.storage.key_builder.build(self.key, part)
+
+    async def load(self):
+        started = time.perf_counter()
+        state, data = await self.storage.redis.mget(self._redis_key("state"), self._redis_key("data"))
+        REDIS_FSM_SECONDS.labels("load").observe(time.perf_counter() - started)
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        self._state = state
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        self._data = self.storage.json_loads(data) if data else {}
+
+    async def flush(self):
+        """Записывает накопленные изменения состояния и данных одной транзакцией."""
+        if not self._state_changed and not self._data_changed:
+            return
+        started = time.perf_counter()
+        async with self.storage.redis.pipeline(transaction=True) as pipe:
+            if self._state_changed:
+                if self._state is None:
+                    pipe.delete(self._redis_key("state"))
+                else:
+                    pipe.set(self._redis_key("state"), self._state, ex=self.storage.state_ttl)
+            if self._data_changed:
+                if not self._data:
+                    pipe.delete(self._redis_key("data"))
+                else:
+                    pipe.set(self._redis_key("data"), self.storage.json_dumps(self._data), ex=self.storage.data_ttl)
+            await pipe.execute()
+        REDIS_FSM_SECONDS.labels("flush").observe(time.perf_counter() - started)
+        self._state_changed = self._data_changed = False
+
+    @property
+    def raw_state(self) -> str | None:
+        return self._state
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def get_state(self) -> str | None:
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self._data_changed = True
+
+    async def get_data(self) -> dict[str, Any]:
+        return self._data.copy()
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    async def update_data(self, data: Mapping[str, Any] | None = None, **kwargs: Any) -> dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        self._data.update(kwargs)
+        self._data_changed = True
+        return self._data.copy()
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+
+class BufferedFSMMiddleware(BaseMiddleware):
+    """
+    Замена стандартного FSM middleware для RedisStorage: передает в обработчик BufferedFSMContext,
+    поэтому шаг диалога стоит одного чтения из Redis и не больше одной записи,
+    сколько бы раз обработчик ни обращался к состоянию.
+    """
+
+    def __init__(self, fsm: FSMContextMiddleware):
+        self._fsm = fsm
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        bot = data.get("bot")
+        context = self._fsm.resolve_event_context(bot, data) if bot else None
+        data["fsm_storage"] = self._fsm.storage
+        if context is None:
+            return await handler(event, data)
+
+        async with self._fsm.events_isolation.lock(key=context.key):
+            state = BufferedFSMContext(self._fsm.storage, context.key)
+            await state.load()
+            data["state"] = state
+            data["raw_state"] = state.raw_state
+            try:
+                return await handler(event, data)
+            finally:
+                await state.flush()
@@ -1,12 +1,14 @@
 import os.path
-import io
+import functools
 import logging
+import threading
+from datetime import datetime, timedelta, timezone
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaIoBaseDownload, MediaUpload
 
 # (ИЗМЕНЕНИЕ): Указываем пути к файлам-секретам внутри контейнера
 CREDENTIALS_PATH = '/run/secrets/credentials'
@@ -15,8 +17,77 @@ TOKEN_PATH = '/run/secrets/token'
 # Области доступа. Если меняете их, удалите файл token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
-def get_drive_service():
-    """Аутентифицируется и возвращает сервис для работы с Google Drive API."""
+# Токен обновляется заранее, если до истечения его срока осталось меньше этого времени
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Окончания имен полных и инкрементальных бекапов в папке на Google Drive
+FULL_BACKUP_SUFFIXES = ('.sql.gz', '.sql', '.dump', '.dir.tar', '.db')
+INCREMENTAL_SUFFIX = '.ndjson.gz'
+
+# Максимальное число запросов в одном batch-запросе к Drive API
+DELETE_BATCH_SIZE = 100
+
+# Размер части при resumable-загрузке. Должен быть кратен 256 КБ.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Размер части при потоковом скачивании бекапа
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class StreamingMediaUpload(MediaUpload):
+    """
+    Resumable-загрузка из потока заранее неизвестной длины (например, из stdout pg_dump).
+    В памяти держится не больше двух частей: текущая (на случай повторной отправки)
+    и следующая, прочитанная заранее.
+    """
+
+    def __init__(self, stream, mimetype, chunksize=UPLOAD_CHUNK_SIZE):
+        super().__init__()
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._next_begin = 0
+        self._eof = False
+
+    def _fill(self, end):
+        """Дочитывает поток, пока буфер не покроет смещение end или поток не закончится."""
+        while not self._eof and self._buffer_start + len(self._buffer) < end:
+            data = self._stream.read(end - self._buffer_start - len(self._buffer))
+            if not data:
+                self._eof = True
+            else:
+                self._buffer += data
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        # Заранее читаем следующую часть: если поток на ней заканчивается, сообщаем итоговый
+        # размер. Иначе поток, кончающийся ровно на границе части, завершался бы пустым запросом.
+        self._fill(self._next_begin + self._chunksize + 1)
+        return self._buffer_start + len(self._buffer) if self._eof else None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise ValueError(f"Часть потока со смещения {begin} уже отброшена и не может быть отправлена повторно.")
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        self._next_begin = begin + length
+        return bytes(self._buffer[:length])
+
+def _load_credentials():
+    """Загружает учетные данные из token.json и при необходимости обновляет токен."""
     creds = None
     # Файл token.json хранит токены доступа и обновления пользователя.
     if os.path.exists(TOKEN_PATH):
@@ -61,12 +132,101 @@ def get_drive_service():
         # with open(TOKEN_PATH, 'w') as token:
         #     token.write(creds.to_json())
 
-    try:
-        service = build('drive', 'v3', credentials=creds)
-        return service
-    except HttpError as error:
-        logging.error(f'Произошла ошибка при создании сервиса Google Drive: {error}')
-        return None
+    return creds
+
+
+class DriveClient:
+    """
+    Держит на весь процесс один авторизованный клиент Google Drive API вместе с его HTTP-транспортом
+    и кеширует ID папки бекапов. Токен обновляется заранее, до истечения срока действия.
+    Транспорт httplib2 не потокобезопасен, поэтому обращения к API выполняются под lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._creds = None
+        self._service = None
+        self._folder_id = None
+
+    def _ensure_fresh_token(self):
+        expiry = self._creds.expiry
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if self._creds.valid and (expiry is None or expiry - now > TOKEN_REFRESH_MARGIN):
+            return True
+        if not self._creds.refresh_token:
+            return self._creds.valid
+        try:
+            self._creds.refresh(Request())
+            logging.info("Токен доступа Google Drive обновлен.")
+            return True
+        except Exception as e:
+            logging.error(f"Не удалось обновить токен. Возможно, его нужно пересоздать вручную. Ошибка: {e}")
+            return False
+
+    def get_service(self):
+        """Возвращает сервис Google Drive API, создавая его при первом обращении, или None."""
+        with self.lock:
+            if self._creds is None:
+                self._creds = _load_credentials()
+                if self._creds is None:
+                    return None
+            if not self._ensure_fresh_token():
+                self.reset()
+                return None
+            if self._service is None:
+                try:
+                    # Описание API берется из встроенного в библиотеку документа, без запроса к серверу
+                    self._service = build('drive', 'v3', credentials=self._creds, cache_discovery=False)
+                except HttpError as error:
+                    logging.error(f'Произошла ошибка при создании сервиса Google Drive: {error}')
+                    return None
+            return self._service
+
+    def get_folder_id(self):
+        """Возвращает ID папки бекапов, обращаясь к API только при пустом кеше."""
+        with self.lock:
+            if self._folder_id is None:
+                service = self.get_service()
+                if service:
+                    self._folder_id = find_or_create_backup_folder(service)
+            return self._folder_id
+
+    def invalidate_folder(self):
+        """Сбрасывает кешированный ID папки (например, если папку удалили на Drive)."""
+        with self.lock:
+            self._folder_id = None
+
+    def handle_http_error(self, error):
+        """Сбрасывает кеш по ошибке API: 404 - папку удалили, 401 - токен отозван."""
+        status = getattr(error.resp, 'status', None)
+        if status == 404:
+            self.invalidate_folder()
+        elif status == 401:
+            self.reset()
+
+    def reset(self):
+        """Сбрасывает учетные данные, сервис и кеш папки. Следующее обращение создаст их заново."""
+        with self.lock:
+            self._creds = None
+            self._service = None
+            self._folder_id = None
+
+
+drive_client = DriveClient()
+
+
+def _serialized(func):
+    """Выполняет функцию под блокировкой клиента Drive, чтобы потоки не делили транспорт одновременно."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with drive_client.lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def get_drive_service():
+    """Возвращает общий для процесса сервис для работы с Google Drive API."""
+    return drive_client.get_service()
 
 def find_or_create_backup_folder(service):
     """Находит или создает папку для бекапов и возвращает ее ID."""
@@ -93,14 +253,18 @@ def find_or_create_backup_folder(service):
         logging.error(f"Ошибка при поиске или создании папки для бекапов: {error}")
         return None
 
-def upload_database_backup(file_path, file_name):
-    """Загружает файл на Google Drive и возвращает ссылку на него или None."""
+@_serialized
+def upload_backup_stream(stream, file_name, mimetype):
+    """
+    Загружает на Google Drive данные из потока частями по мере их чтения
+    и возвращает ссылку на файл или None.
+    """
     service = get_drive_service()
     if not service:
         return None
 
     try:
-        folder_id = find_or_create_backup_folder(service)
+        folder_id = drive_client.get_folder_id()
         if not folder_id:
             return None
 
@@ -108,63 +272,201 @@ def upload_database_backup(file_path, file_name):
             'name': file_name,
             'parents': [folder_id]
         }
-        # Указываем правильный mimetype для SQL/текстовых файлов
-        media = MediaFileUpload(file_path, mimetype='text/plain', resumable=True)
-        
-        file = service.files().create(
+        media = StreamingMediaUpload(stream, mimetype)
+        request = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink'
-        ).execute()
-        
+        )
+
+        response = None
+        while response is None:
+            status, response = request.next_chunk(num_retries=3)
+            if status:
+                logging.info(f"Загружено {status.resumable_progress} байт файла '{file_name}'.")
+
         logging.info(f"Файл '{file_name}' успешно загружен.")
-        return file.get('webViewLink')
+        return response.get('webViewLink')
 
     except HttpError as error:
         logging.error(f'Произошла ошибка во время загрузки файла: {error}')
+        drive_client.handle_http_error(error)
         return None
 
-def download_latest_backup(destination_path):
-    """Находит последний бекап, скачивает его и возвращает True в случае успеха."""
+def list_backup_files(service, folder_id, created_after=None):
+    """Постранично перечисляет файлы в папке бекапов от старых к новым."""
+    query = f"'{folder_id}' in parents and trashed=false"
+    if created_after:
+        query += f" and createdTime > '{created_after}'"
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=query,
+            orderBy='createdTime',
+            pageSize=1000,
+            pageToken=page_token,
+            fields='nextPageToken, files(id, name, createdTime)'
+        ).execute()
+        yield from response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+def _parse_created_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def select_backups_to_keep(files, keep_last, keep_daily, keep_weekly, keep_monthly):
+    """
+    Отбирает полные бекапы по схеме "дед-отец-сын": keep_last последних, а также самый новый
+    бекап за каждый из keep_daily последних дней, keep_weekly недель и keep_monthly месяцев.
+    files - список файлов от новых к старым. Возвращает множество ID сохраняемых файлов.
+    Самый новый бекап сохраняется всегда.
+    """
+    keep = {f['id'] for f in files[:max(keep_last, 1)]}
+    periods = (
+        (keep_daily, lambda created: created.date()),
+        (keep_weekly, lambda created: created.isocalendar()[:2]),
+        (keep_monthly, lambda created: (created.year, created.month)),
+    )
+    for limit, period_of in periods:
+        seen = set()
+        for f in files:
+            if len(seen) >= limit:
+                break
+            period = period_of(_parse_created_time(f['createdTime']))
+            if period not in seen:
+                seen.add(period)
+                keep.add(f['id'])
+    return keep
+
+def _delete_files(service, files):
+    """Удаляет файлы пачками batch-запросов. Возвращает число удаленных файлов."""
+    deleted = 0
+
+    def callback(request_id, response, exception):
+        nonlocal deleted
+        if exception is not None:
+            logging.error(f"Не удалось удалить файл {request_id} с Google Drive: {exception}")
+        else:
+            deleted += 1
+
+    for start in range(0, len(files), DELETE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for f in files[start:start + DELETE_BATCH_SIZE]:
+            batch.add(service.files().delete(fileId=f['id']), request_id=f['id'])
+        batch.execute()
+    return deleted
+
+@_serialized
+def prune_backups(keep_last, keep_daily, keep_weekly, keep_monthly):
+    """
+    Применяет политику хранения к папке бекапов: удаляет полные бекапы, не отобранные
+    select_backups_to_keep, и инкрементальные бекапы, созданные до последнего полного
+    (при восстановлении они уже не нужны). Возвращает число удаленных файлов или None при ошибке.
+    """
     service = get_drive_service()
     if not service:
-        return False
+        return None
 
     try:
-        folder_id = find_or_create_backup_folder(service)
+        folder_id = drive_client.get_folder_id()
         if not folder_id:
-            return False
+            return None
 
-        # Ищем последний файл .sql или .db в папке, сортируя по дате создания
-        response = service.files().list(
-            q=f"'{folder_id}' in parents and (name contains '.db' or name contains '.sql') and trashed=false",
-            orderBy='createdTime desc',
-            pageSize=1,
-            fields='files(id, name)'
-        ).execute()
+        full_backups = []
+        incrementals = []
+        for f in list_backup_files(service, folder_id):
+            if f['name'].endswith(INCREMENTAL_SUFFIX):
+                incrementals.append(f)
+            elif f['name'].endswith(FULL_BACKUP_SUFFIXES):
+                full_backups.append(f)
+        if not full_backups:
+            return 0
 
-        files = response.get('files', [])
-        if not files:
-            logging.warning("В папке на Google Drive не найдено файлов для восстановления.")
-            return False
+        full_backups.reverse()
+        keep = select_backups_to_keep(full_backups, keep_last, keep_daily, keep_weekly, keep_monthly)
+        latest_full_time = _parse_created_time(full_backups[0]['createdTime'])
+        to_delete = [f for f in full_backups if f['id'] not in keep]
+        to_delete += [f for f in incrementals if _parse_created_time(f['createdTime']) < latest_full_time]
+        if not to_delete:
+            return 0
+
+        deleted = _delete_files(service, to_delete)
+        logging.info(f"Очистка Google Drive: удалено {deleted} из {len(to_delete)} устаревших бекапов.")
+        return deleted
+
+    except HttpError as error:
+        logging.error(f'Произошла ошибка при очистке старых бекапов: {error}')
+        drive_client.handle_http_error(error)
+        return None
 
-        latest_file = files[0]
-        file_id = latest_file.get('id')
-        file_name = latest_file.get('name')
-        logging.info(f"Найден последний бекап: {file_name} (ID: {file_id})")
+def _find_backup_chain(service, folder_id):
+    """Возвращает (последний полный бекап, инкрементальные бекапы после него по порядку) или None."""
+    # Ищем последний полный бекап любого формата в папке, сортируя по дате создания
+    response = service.files().list(
+        q=f"'{folder_id}' in parents and (name contains '.db' or name contains '.sql' "
+          f"or name contains '.dump' or name contains '.tar') and trashed=false",
+        orderBy='createdTime desc',
+        pageSize=1,
+        fields='files(id, name, createdTime, size)'
+    ).execute()
 
+    files = response.get('files', [])
+    if not files:
+        logging.warning("В папке на Google Drive не найдено файлов для восстановления.")
+        return None
+
+    latest_file = files[0]
+    logging.info(f"Найден последний бекап: {latest_file.get('name')} (ID: {latest_file.get('id')})")
+    delta_files = [
+        f for f in list_backup_files(service, folder_id, created_after=latest_file.get('createdTime'))
+        if f['name'].endswith(INCREMENTAL_SUFFIX)
+    ]
+    return latest_file, delta_files
+
+@_serialized
+def find_backup_chain():
+    """
+    Находит последний полный бекап и все инкрементальные бекапы, созданные после него.
+    Возвращает (файл полного бекапа, список файлов инкрементов) - словари с id, name, createdTime - или None.
+    """
+    service = get_drive_service()
+    if not service:
+        return None
+
+    try:
+        folder_id = drive_client.get_folder_id()
+        if not folder_id:
+            return None
+        return _find_backup_chain(service, folder_id)
+
+    except HttpError as error:
+        logging.error(f'Произошла ошибка при поиске резервной копии: {error}')
+        drive_client.handle_http_error(error)
+        return None
+
+@_serialized
+def download_file_stream(file_id, sink, on_progress=None, chunksize=DOWNLOAD_CHUNK_SIZE):
+    """
+    Скачивает файл с Google Drive крупными частями, передавая каждую часть в sink.write
+    сразу по получении. on_progress(скачано байт, размер файла) вызывается после каждой части.
+    Возвращает True при успехе и False при ошибке API.
+    """
+    service = get_drive_service()
+    if not service:
+        return False
+
+    try:
         request = service.files().get_media(fileId=file_id)
-        fh = io.FileIO(destination_path, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        
+        downloader = MediaIoBaseDownload(sink, request, chunksize=chunksize)
         done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            logging.info(f"Скачивание {int(status.progress() * 100)}%.")
-        
-        logging.info(f"Файл '{file_name}' успешно скачан в '{destination_path}'.")
+        while not done:
+            status, done = downloader.next_chunk(num_retries=3)
+            if on_progress:
+                on_progress(status.resumable_progress, status.total_size)
         return True
 
     except HttpError as error:
         logging.error(f'Произошла ошибка во время скачивания файла: {error}')
+        drive_client.handle_http_error(error)
         return False
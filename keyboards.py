@@ -1,7 +1,14 @@
+import html
+from datetime import datetime, timedelta, timezone
+
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, 
     InlineKeyboardButton
 )
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+# Точка отсчета для кодирования курсора пагинации в callback_data
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 def get_main_keyboard() -> ReplyKeyboardMarkup:
     """Возвращает основную клавиатуру."""
@@ -14,12 +21,15 @@ def get_main_keyboard() -> ReplyKeyboardMarkup:
     ]
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
-def get_extra_keyboard() -> ReplyKeyboardMarkup:
-    """Возвращает клавиатуру с дополнительными действиями."""
-    kb = [
-        [KeyboardButton(text="📊 Статистика")],
-        [KeyboardButton(text="📤 Создать резервную копию")],
-        [KeyboardButton(text="📥 Восстановить из бекапа")],
+def get_extra_keyboard(is_admin: bool = True) -> ReplyKeyboardMarkup:
+    """Возвращает клавиатуру с дополнительными действиями. Резервное копирование доступно только владельцу."""
+    kb = [[KeyboardButton(text="📊 Статистика")]]
+    if is_admin:
+        kb += [
+            [KeyboardButton(text="📤 Создать резервную копию")],
+            [KeyboardButton(text="📥 Восстановить из бекапа")]
+        ]
+    kb += [
         [KeyboardButton(text="🗑 Удалить всё")],
         [KeyboardButton(text="🔙 Назад")]
     ]
@@ -74,3 +84,63 @@ def get_delete_confirmation_keyboard(record_id: int) -> InlineKeyboardMarkup:
         ]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+def encode_page_cursor(record) -> str:
+    """Кодирует курсор (timestamp, id) записи в компактную строку для callback_data."""
+    micros = (record['timestamp'] - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{record['id']}"
+
+def decode_page_cursor(micros: str, record_id: str) -> tuple[datetime, int]:
+    """Восстанавливает курсор (timestamp, id) из частей callback_data."""
+    return _EPOCH + timedelta(microseconds=int(micros)), int(record_id)
+
+def get_records_page_keyboard(records: list, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """Возвращает inline-клавиатуру со страницей записей, сгруппированных по тегам, и кнопками навигации."""
+    grouped_records = {}
+    for record in records:
+        grouped_records.setdefault(record['tag'], []).append(record)
+
+    builder = InlineKeyboardBuilder()
+    for tag, recs in sorted(grouped_records.items()):
+        display_tag = "Без тега" if tag == "no_tag" else html.escape(tag)
+        builder.row(InlineKeyboardButton(text=f"📌 {display_tag}", callback_data="ignore"))
+        for r in recs:
+            link_text_content = r['name'] if r['name'] else r['message']
+            link_text = (link_text_content[:40] + '...') if len(link_text_content) > 40 else link_text_content
+            builder.row(InlineKeyboardButton(
+                text=f"• {html.escape(link_text)}",
+                callback_data=f"view_record_{r['id']}"
+            ))
+
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(
+            text="◀️ Новее", callback_data=f"records_prev_{encode_page_cursor(records[0])}"
+        ))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(
+            text="Старше ▶️", callback_data=f"records_next_{encode_page_cursor(records[-1])}"
+        ))
+    if nav_buttons:
+        builder.row(*nav_buttons)
+    return builder.as_markup()
+
+def get_records_batch_keyboard(records: list, prev_data: str | None, next_data: str | None) -> InlineKeyboardMarkup:
+    """
+    Возвращает inline-клавиатуру для пачки записей в одном сообщении: пронумерованные кнопки
+    открывают карточку записи, prev_data/next_data задают callback_data кнопок навигации.
+    """
+    builder = InlineKeyboardBuilder()
+    for index, record in enumerate(records, start=1):
+        builder.button(text=str(index), callback_data=f"view_record_{record['id']}")
+    builder.adjust(5)
+
+    nav_buttons = []
+    if prev_data:
+        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=prev_data))
+    if next_data:
+        nav_buttons.append(InlineKeyboardButton(text="Далее ▶️", callback_data=next_data))
+    if nav_buttons:
+        builder.row(*nav_buttons)
+    return builder.as_markup()
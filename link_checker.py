@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from net_guard import BlockedAddressError, PublicOnlyResolver, public_only_trace_config
+
+# Общие ограничения проверки ссылок
+MAX_CONCURRENCY = 16
+MAX_CONNECTIONS_PER_HOST = 2
+# Минимальный промежуток между запросами к одному хосту, в секундах
+HOST_DELAY = 1.0
+REQUEST_TIMEOUT = 15
+USER_AGENT = 'Mozilla/5.0 (compatible; SaveLinkBot/1.0; link checker)'
+# Ответы, после которых HEAD повторяется запросом GET: многие серверы не поддерживают HEAD
+# или отвечают на него иначе, чем на обычный запрос
+HEAD_FALLBACK_MIN_STATUS = 400
+# Статусы, не говорящие ничего о самой ссылке: ограничение частоты запросов и т.п.
+INCONCLUSIVE_STATUSES = {408, 425, 429}
+# Статус, которым отмечается сетевая ошибка (DNS, соединение, таймаут)
+NETWORK_ERROR_STATUS = 0
+# Статус ссылки во внутреннюю сеть: бот ее не проверяет и не сообщает о ней как о нерабочей
+BLOCKED_STATUS = -1
+
+# Интервалы повторной проверки: рабочие ссылки проверяются все реже (7, 14, 28, 56 дней),
+# нерабочие - через 1, 2, 4... дня, но не реже раза в 30 дней
+RECHECK_BASE = 7 * 24 * 3600
+RECHECK_MAX_DOUBLINGS = 3
+RETRY_BASE = 24 * 3600
+RETRY_MAX = 30 * 24 * 3600
+INCONCLUSIVE_RETRY = 24 * 3600
+# Доля интервала, на которую случайно сдвигается следующая проверка, чтобы проверки не шли волнами
+RECHECK_JITTER = 0.1
+# Ссылка считается нерабочей после стольких неудачных проверок подряд
+BROKEN_AFTER_FAILURES = 2
+
+
+@dataclass
+class LinkCheckResult:
+    # HTTP-статус последнего ответа или NETWORK_ERROR_STATUS
+    status: int
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def inconclusive(self) -> bool:
+        return self.status in INCONCLUSIVE_STATUSES or self.status == BLOCKED_STATUS
+
+    @property
+    def ok(self) -> bool:
+        # 401/403 и т.п. означают, что страница существует, но закрыта для бота
+        return NETWORK_ERROR_STATUS < self.status < 500 and self.status not in (404, 410) and not self.inconclusive
+
+
+def next_check_delay(ok_streak: int, failures: int) -> int:
+    """Через сколько секунд проверить ссылку снова с учетом серии успешных или неудачных проверок."""
+    if failures:
+        delay = min(RETRY_BASE * 2 ** (failures - 1), RETRY_MAX)
+    elif ok_streak:
+        delay = RECHECK_BASE * 2 ** min(ok_streak - 1, RECHECK_MAX_DOUBLINGS)
+    else:
+        delay = INCONCLUSIVE_RETRY
+    return int(delay * (1 + random.uniform(0, RECHECK_JITTER)))
+
+
+class LinkChecker:
+    """
+    Проверка доступности ссылок: запрос HEAD с повтором через GET, условные запросы по ETag
+    и Last-Modified (ответ 304 считается успешным). Один пул соединений на все проверки,
+    общий лимит одновременных запросов, лимит соединений на хост и пауза между запросами к одному хосту.
+    Как и в TitleFetcher, запросы во внутреннюю сеть запрещены, в том числе после перенаправлений;
+    allow_private_addresses=True снимает запрет для проверки на локальном HTTP-сервере.
+    session_factory позволяет подменить клиент целиком.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, per_host=MAX_CONNECTIONS_PER_HOST,
+                 host_delay=HOST_DELAY, timeout=REQUEST_TIMEOUT, session_factory=None,
+                 allow_private_addresses=False):
+        self._allow_private_addresses = allow_private_addresses
+        self._max_concurrency = max_concurrency
+        self._per_host = per_host
+        self._host_delay = host_delay
+        self._timeout = timeout
+        self._session_factory = session_factory
+        self._session: aiohttp.ClientSession | None = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._host_locks: dict[str, asyncio.Lock] = {}
+        self._host_next_request: dict[str, float] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            if self._session_factory:
+                self._session = self._session_factory()
+            else:
+                guarded = not self._allow_private_addresses
+                connector = aiohttp.TCPConnector(
+                    limit=self._max_concurrency, limit_per_host=self._per_host, ttl_dns_cache=300,
+                    resolver=PublicOnlyResolver() if guarded else None
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self._timeout),
+                    headers={'User-Agent': USER_AGENT},
+                    trace_configs=[public_only_trace_config()] if guarded else None
+                )
+        return self._session
+
+    async def _wait_for_host(self, host: str):
+        """Выдерживает паузу host_delay между началами запросов к одному хосту."""
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            delay = self._host_next_request.get(host, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._host_next_request[host] = time.monotonic() + self._host_delay
+
+    async def _request(self, method: str, url: str, headers: dict) -> LinkCheckResult:
+        host = urlsplit(url).hostname or ''
+        await self._wait_for_host(host)
+        async with self._slots:
+            # Тело ответа не читается: для проверки достаточно статуса и заголовков
+            async with self._get_session().request(method, url, headers=headers, allow_redirects=True) as response:
+                return LinkCheckResult(
+                    response.status, response.headers.get('ETag'), response.headers.get('Last-Modified')
+                )
+
+    async def check(self, url: str, etag: str | None = None, last_modified: str | None = None) -> LinkCheckResult:
+        """Проверяет ссылку. Сетевые ошибки не выбрасываются, а возвращаются как NETWORK_ERROR_STATUS."""
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        result = None
+        try:
+            result = await self._request('HEAD', url, headers)
+        except BlockedAddressError as e:
+            logging.info(f"Ссылка {url} не проверяется: {e}")
+            return LinkCheckResult(BLOCKED_STATUS, etag, last_modified)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.debug(f"HEAD-запрос к {url} не удался: {e!r}")
+        if result is not None and result.status < HEAD_FALLBACK_MIN_STATUS:
+            return self._keep_validators(result, etag, last_modified)
+        try:
+            result = await self._request('GET', url, headers)
+        except BlockedAddressError as e:
+            logging.info(f"Ссылка {url} не проверяется: {e}")
+            return LinkCheckResult(BLOCKED_STATUS, etag, last_modified)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.info(f"Ссылка {url} недоступна: {e!r}")
+            return LinkCheckResult(NETWORK_ERROR_STATUS, etag, last_modified)
+        return self._keep_validators(result, etag, last_modified)
+
+    @staticmethod
+    def _keep_validators(result: LinkCheckResult, etag, last_modified) -> LinkCheckResult:
+        # Ответ 304 может не содержать валидаторов - тогда остаются прежние
+        if result.status == 304:
+            result.etag = result.etag or etag
+            result.last_modified = result.last_modified or last_modified
+        return result
+
+    async def close(self):
+        """Закрывает пул соединений."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def update_check_state(result: LinkCheckResult, ok_streak: int, failures: int) -> tuple[int, int, int, bool]:
+    """
+    Обновляет серии успешных и неудачных проверок по результату новой проверки.
+    Возвращает (ok_streak, failures, через сколько секунд проверить снова, считается ли ссылка нерабочей).
+    Неопределенный ответ (например, 429) не меняет серий, ссылка проверяется снова через INCONCLUSIVE_RETRY.
+    """
+    if result.inconclusive:
+        delay = next_check_delay(0, 0)
+    else:
+        if result.ok:
+            ok_streak, failures = ok_streak + 1, 0
+        else:
+            ok_streak, failures = 0, failures + 1
+        delay = next_check_delay(ok_streak, failures)
+    return ok_streak, failures, delay, failures >= BROKEN_AFTER_FAILURES
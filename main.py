@@ -1,14 +1,16 @@
 import asyncio
-import re
+import gzip
+import io
+import tempfile
 import logging
 import html
-import os
 from datetime import datetime
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
-    CallbackQuery, LinkPreviewOptions, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
+    CallbackQuery, FSInputFile, LinkPreviewOptions, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
@@ -16,27 +18,52 @@ from aiogram.fsm.storage.redis import RedisStorage
 from redis.asyncio.client import Redis
 
 # Локальные импорты
+from access import AccessMiddleware, RateLimitMiddleware
+from fsm_buffer import BufferedFSMMiddleware
 from config_reader import config
 from database import (
-    init_db, save_message, get_messages, get_tags,
-    get_messages_by_tag, delete_messages, delete_message_by_id,
+    init_db, save_message, get_messages_page, get_tags,
+    delete_messages, delete_message_by_id,
     validate_text, validate_name, validate_tag, get_message_by_id,
-    update_record_field, get_stats
+    update_record_field, get_stats, rebuild_stats, search_messages,
+    get_allowed_users, add_allowed_user, remove_allowed_user, QuotaExceededError,
+    import_messages, iter_messages, save_messages, set_record_name_if_empty, find_record_by_url
 )
 from keyboards import (
     get_main_keyboard, get_extra_keyboard, get_tag_choice_keyboard,
     get_cancel_keyboard, get_skip_keyboard, create_tags_keyboard,
-    get_delete_confirmation_keyboard
+    get_delete_confirmation_keyboard, get_records_page_keyboard, decode_page_cursor,
+    get_records_batch_keyboard
+)
+from formatting import pack_records
+from bookmarks import (
+    ImportStats, detect_import_format, iter_bookmarks, BookmarkExporter, EXPORT_FORMATS, extract_urls
 )
 from states import UserState
-from gdrive_uploader import upload_database_backup, download_latest_backup
+from backup import create_backup, restore_latest_backup, BackupError
 from scheduler import setup_scheduler
+from send_queue import SendQueueMiddleware
+from webhook import run_webhook
+from title_fetcher import TitleFetcher
+from metrics import HandlerMetricsMiddleware, start_metrics_server
+from url_normalizer import is_url
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Константы
-ALLOWED_USER_ID = config.allowed_user_id
+ADMIN_USER_ID = config.allowed_user_id
+RECORDS_PAGE_SIZE = 20
+TAG_PAGE_SIZE = 10
+SEARCH_PAGE_SIZE = 10
+SEARCH_QUERY_MAX_LENGTH = 200
+# Telegram Bot API позволяет боту скачивать файлы размером до 20 МБ
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+# Telegram Bot API позволяет боту отправлять файлы размером до 50 МБ
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024
+# Больше ссылок из одного сообщения не сохраняется (и не помещается в один ответ)
+MAX_LINKS_PER_MESSAGE = 30
+QUOTA_EXCEEDED_TEXT = "❌ Достигнут лимит количества записей. Удалите ненужные записи, чтобы добавить новые."
 
 # Инициализация Redis и хранилища
 redis_client = Redis(host=config.redis_host, port=config.redis_port)
@@ -44,41 +71,130 @@ storage = RedisStorage(redis=redis_client)
 
 # Инициализация бота и диспетчера
 bot = Bot(token=config.bot_token.get_secret_value())
-dp = Dispatcher(storage=storage)
+# FSM подключается вручную, чтобы проверка доступа выполнялась до чтения состояния из Redis
+dp = Dispatcher(storage=storage, disable_fsm=True)
 
 
-def is_url(text: str) -> bool:
-    """Проверяет, является ли текст валидным URL-адресом, который занимает всю строку."""
-    if not isinstance(text, str):
-        return False
-    # Этот паттерн требует наличия схемы http/https и не позволяет иметь лишний текст в строке
-    url_pattern = re.compile(
-        r'^https?://'  # Протокол в начале строки
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # домен...
-        r'localhost|'  # или localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # или IP
-        r'(?::\d+)?'  # порт
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    # Используем fullmatch, чтобы убедиться, что вся строка является URL
-    return bool(re.fullmatch(url_pattern, text.strip()))
-
-
-async def check_access(message: types.Message | types.CallbackQuery) -> bool:
-    """Проверяет, имеет ли пользователь доступ к боту."""
-    if message.from_user.id != ALLOWED_USER_ID:
-        if isinstance(message, types.Message):
-            await message.answer("Извините, у вас нет доступа к этому боту.")
-        else: # CallbackQuery
-            await message.answer("У вас нет доступа к этой функции.", show_alert=True)
-        logging.warning(f"Unauthorized access attempt by user {message.from_user.id}")
+async def load_allowed_user_ids():
+    users = await get_allowed_users()
+    return None if users is None else [row['user_id'] for row in users]
+
+
+# В многопользовательском режиме к владельцу добавляются пользователи из таблицы bot_users
+access = AccessMiddleware(
+    [ADMIN_USER_ID],
+    loader=load_allowed_user_ids if config.multi_user else None,
+    ttl=config.allowlist_ttl
+)
+dp.update.outer_middleware(access)
+if config.user_requests_per_minute:
+    dp.update.outer_middleware(RateLimitMiddleware(redis_client, config.user_requests_per_minute))
+# Состояние FSM читается из Redis один раз на обновление, а изменения записываются одной транзакцией
+dp.update.outer_middleware(BufferedFSMMiddleware(dp.fsm))
+# Время работы каждого обработчика попадает в метрики Prometheus
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+# Все исходящие запросы в чаты проходят через очередь с учетом лимитов Telegram
+send_queue = SendQueueMiddleware()
+bot.session.middleware(send_queue)
+dp.shutdown.register(send_queue.close)
+
+# Названия страниц для ссылок без названия загружаются в фоне и не задерживают сохранение
+title_fetcher = TitleFetcher()
+dp.shutdown.register(title_fetcher.close)
+
+
+def extract_message_urls(message: types.Message) -> list[str]:
+    """
+    Возвращает все ссылки текста сообщения без повторов: из сущностей Telegram (в том числе скрытые
+    за текстом ссылки) и из самого текста, в порядке появления. Подписи к файлам не учитываются.
+    """
+    text = message.text or ""
+    entities = message.entities or []
+    urls = []
+    for entity in sorted(entities, key=lambda entity: entity.offset):
+        if entity.type == "url":
+            url = entity.extract_from(text)
+        elif entity.type == "text_link":
+            url = entity.url
+        else:
+            continue
+        if url and url not in urls:
+            urls.append(url)
+    for url in extract_urls(text):
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def several_links(message: types.Message):
+    """Фильтр сообщений с несколькими ссылками; найденные ссылки передаются обработчику как urls."""
+    urls = extract_message_urls(message)
+    return {"urls": urls} if len(urls) > 1 else False
+
+
+def backfill_title(user_id: int, record_id: int, url: str):
+    """Запускает фоновую загрузку названия страницы для сохраненной записи без названия."""
+    if not config.fetch_titles or not is_url(url):
+        return
+
+    async def save_title(title: str):
+        await set_record_name_if_empty(user_id, record_id, title)
+
+    title_fetcher.schedule(url.strip(), save_title)
+
+
+async def answer_if_already_saved(message: types.Message, url: str) -> bool:
+    """
+    Если ссылка (в канонической форме, под любым тегом) уже сохранена, сообщает об этом
+    с кнопкой открытия записи и возвращает True.
+    """
+    record = await find_record_by_url(message.from_user.id, url)
+    if record is None:
         return False
+    tag_info = "без тега" if record['tag'] == "no_tag" else f"с тегом «{html.escape(record['tag'])}»"
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📄 Открыть запись", callback_data=f"view_record_{record['id']}")]
+    ])
+    await message.answer(
+        f"♻️ Эта ссылка уже сохранена {tag_info}.", parse_mode="HTML", reply_markup=keyboard
+    )
     return True
 
+
 # --- Обработчик URL и стартовая команда ---
 
+# Только обычный текст вне диалогов: команды (/search со ссылками), файлы с подписью
+# и ответы в сценариях создания и редактирования записи обрабатываются своими обработчиками
+@dp.message(StateFilter(None), F.text, ~F.text.startswith("/"), several_links)
+async def handle_several_urls(message: types.Message, urls: list[str]):
+    """Сохраняет все ссылки из сообщения одним запросом и отвечает одним сводным сообщением."""
+    results = await save_messages(message.from_user.id, urls[:MAX_LINKS_PER_MESSAGE])
+    if results is None:
+        await message.answer("❌ Не удалось сохранить ссылки. Попробуйте позже.")
+        return
+    marks = {"saved": "✅", "duplicate": "♻️", "over_quota": "⛔"}
+    for url, status, record_id in results:
+        if status == "saved":
+            backfill_title(message.from_user.id, record_id, url)
+    saved = sum(status == "saved" for _, status, _ in results)
+    lines = [f"Сохранено ссылок: {saved} из {len(results)} (без тега)."]
+    lines += [f"{marks[status]} {html.escape(url if len(url) <= 100 else url[:100] + '...')}" for url, status, _ in results]
+    if any(status == "duplicate" for _, status, _ in results):
+        lines.append("♻️ - такая запись уже существует.")
+    if any(status == "over_quota" for _, status, _ in results):
+        lines.append("⛔ - достигнут лимит количества записей.")
+    if len(urls) > MAX_LINKS_PER_MESSAGE:
+        lines.append(f"Обработаны только первые {MAX_LINKS_PER_MESSAGE} ссылок, остальные пришлите отдельно.")
+    await message.answer("\n".join(lines), parse_mode="HTML", link_preview_options=LinkPreviewOptions(is_disabled=True))
+
+
 @dp.message(lambda message: is_url(message.text))
 async def handle_url(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
+    if await answer_if_already_saved(message, message.text):
+        return
     await state.update_data(temp_url=message.text)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да", callback_data="save_url"), InlineKeyboardButton(text="❌ Нет", callback_data="cancel_url")]
@@ -88,19 +204,125 @@ async def handle_url(message: types.Message, state: FSMContext):
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     await state.clear()
     await message.answer(
         "👋 Привет! Я бот для сохранения заметок. Выберите действие:",
         reply_markup=get_main_keyboard()
     )
 
+# --- Импорт закладок из файла ---
+
+@dp.message(F.document)
+async def import_bookmarks_handler(message: types.Message, state: FSMContext):
+    """Импортирует закладки из присланного файла: HTML-экспорта браузера, CSV, JSON/NDJSON или списка ссылок."""
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer(f"❌ Файл слишком большой: бот может скачать не больше {IMPORT_MAX_FILE_SIZE // 1024 // 1024} МБ.")
+        return
+    await state.clear()
+    status_message = await message.answer("⏳ Импортирую закладки...", reply_markup=get_main_keyboard())
+
+    # Файл скачивается на диск и разбирается по мере загрузки записей в базу: в памяти нет ни файла, ни списка записей
+    with tempfile.TemporaryFile() as import_file:
+        try:
+            await bot.download(document, destination=import_file)
+        except TelegramBadRequest as e:
+            logging.error(f"Не удалось скачать файл для импорта: {e}")
+            await status_message.edit_text("❌ Не удалось скачать файл. Попробуйте еще раз.")
+            return
+        import_file.seek(0)
+        file_format = detect_import_format(document.file_name, import_file.read(64))
+        import_file.seek(0)
+
+        stats = ImportStats()
+        parse_errors = []
+
+        async def records():
+            # Ошибка разбора прерывает COPY и откатывает импорт; ее причина нужна для ответа пользователю
+            try:
+                async for record in iter_bookmarks(import_file, file_format, stats):
+                    yield record
+            except ValueError as e:
+                parse_errors.append(e)
+                raise
+
+        result = await import_messages(message.from_user.id, records())
+    if parse_errors:
+        logging.warning(f"Не удалось разобрать файл '{document.file_name}' ({file_format}): {parse_errors[0]}")
+        await status_message.edit_text("❌ Не удалось разобрать файл. Поддерживаются HTML-экспорт закладок, CSV, JSON и списки ссылок.")
+        return
+    if result is None:
+        await status_message.edit_text("❌ Произошла ошибка при импорте записей. Попробуйте позже.")
+        return
+    if not result['total']:
+        await status_message.edit_text("📭 В файле не найдено ни одной ссылки.")
+        return
+    lines = [
+        "✅ Импорт завершен.",
+        f"Найдено записей: {result['total']}",
+        f"Добавлено: {result['inserted']}",
+        f"Уже были сохранены или повторяются в файле: {result['duplicates']}",
+    ]
+    if stats.skipped:
+        lines.append(f"Пропущено некорректных: {stats.skipped}")
+    if result['over_quota']:
+        lines.append(f"Не добавлено из-за лимита записей: {result['over_quota']}")
+    await status_message.edit_text("\n".join(lines))
+
+# --- Экспорт записей в файл ---
+
+@dp.message(Command("export"))
+async def export_handler(message: types.Message, command: CommandObject):
+    """/export [csv|json|html] [gz] - присылает все записи файлом; gz сжимает его gzip."""
+    args = (command.args or "").lower().split()
+    file_format = next((arg for arg in args if arg in EXPORT_FORMATS), "csv")
+    compress = "gz" in args or "gzip" in args
+    if any(arg not in EXPORT_FORMATS and arg not in ("gz", "gzip") for arg in args):
+        await message.answer("Использование: /export [csv|json|html] [gz]")
+        return
+
+    status_message = await message.answer("⏳ Выгружаю записи...")
+    extension, _ = EXPORT_FORMATS[file_format]
+    file_name = f"savelink_{datetime.now().strftime('%Y-%m-%d')}{extension}" + (".gz" if compress else "")
+    # Записи пишутся во временный файл по мере чтения курсором, поэтому память не зависит от их числа
+    with tempfile.NamedTemporaryFile(suffix=file_name) as export_file:
+        count = 0
+        try:
+            raw = gzip.GzipFile(fileobj=export_file, mode="wb") if compress else export_file
+            out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            exporter = BookmarkExporter(out, file_format)
+            exporter.write_header()
+            async for record in iter_messages(message.from_user.id, by_tag=file_format == "html"):
+                exporter.write_record(record)
+                count += 1
+            exporter.write_footer()
+            # Отсоединяем поток, не закрывая его: закрытие TextIOWrapper закрыло бы и временный файл
+            out.detach()
+            if compress:
+                raw.close()
+            export_file.flush()
+        except Exception as e:
+            logging.error(f"Не удалось выгрузить записи пользователя {message.from_user.id}: {e}")
+            await status_message.edit_text("❌ Произошла ошибка при выгрузке записей. Попробуйте позже.")
+            return
+
+        if not count:
+            await status_message.edit_text("📭 У вас пока нет сохраненных записей.")
+            return
+        if export_file.tell() > EXPORT_MAX_FILE_SIZE:
+            await status_message.edit_text("❌ Файл выгрузки больше 50 МБ. Попробуйте сжать его: /export csv gz")
+            return
+        await message.answer_document(
+            FSInputFile(export_file.name, filename=file_name),
+            caption=f"📦 Выгружено записей: {count}"
+        )
+    await status_message.delete()
+
 # --- FSM для создания новой записи ---
 
 @dp.message(F.text == "✍️ Создать запись")
 async def new_note_handler(message: types.Message, state: FSMContext):
     """Начинает процесс создания новой записи по кнопке."""
-    if not await check_access(message): return
     await state.set_state(UserState.waiting_for_text)
     # (ИЗМЕНЕНИЕ): Сообщение изменено по запросу пользователя
     await message.answer("введи ссылку для вашей новой записи", reply_markup=get_cancel_keyboard())
@@ -116,18 +338,20 @@ async def cancel_action(message: types.Message, state: FSMContext):
 
 @dp.message(UserState.waiting_for_text)
 async def process_text(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     is_valid, error_message = await validate_text(message.text)
     if not is_valid:
         await message.answer(f"❌ Ошибка: {error_message}", reply_markup=get_cancel_keyboard())
         return
+    if is_url(message.text) and await answer_if_already_saved(message, message.text):
+        await state.clear()
+        await message.answer("Выберите действие:", reply_markup=get_main_keyboard())
+        return
     await state.update_data(user_text=message.text.strip())
     await message.answer("Введите название для записи\n(или нажмите «⏩ Пропустить»):", reply_markup=get_skip_keyboard())
     await state.set_state(UserState.waiting_for_name)
 
 @dp.message(UserState.waiting_for_name)
 async def process_name(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text == "⏩ Пропустить":
         await state.update_data(name=None)
     else:
@@ -142,7 +366,6 @@ async def process_name(message: types.Message, state: FSMContext):
 
 @dp.message(UserState.waiting_for_tag_choice)
 async def process_tag_choice(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text.lower() == "да":
         tags = await get_tags(message.from_user.id)
         kb = [[types.KeyboardButton(text="Создать новый тег")]]
@@ -156,11 +379,18 @@ async def process_tag_choice(message: types.Message, state: FSMContext):
         await state.set_state(UserState.waiting_for_tag)
     elif message.text.lower() == "нет":
         data = await state.get_data()
-        save_result = await save_message(
-            message.from_user.id, data.get("user_text"), "no_tag",
-            data.get("name"), datetime.now()
-        )
+        try:
+            save_result = await save_message(
+                message.from_user.id, data.get("user_text"), "no_tag",
+                data.get("name"), datetime.now()
+            )
+        except QuotaExceededError:
+            await message.answer(QUOTA_EXCEEDED_TEXT, reply_markup=get_main_keyboard())
+            await state.clear()
+            return
         if save_result:
+            if data.get("name") is None:
+                backfill_title(message.from_user.id, save_result, data.get("user_text"))
             await message.answer("✅ Сообщение сохранено без тега!", reply_markup=get_main_keyboard())
         else:
             await message.answer("❌ Такая запись уже существует!", reply_markup=get_main_keyboard())
@@ -169,7 +399,6 @@ async def process_tag_choice(message: types.Message, state: FSMContext):
 
 @dp.message(UserState.waiting_for_tag)
 async def process_tag(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     tag_text = message.text.split(" (")[0]
     if tag_text == "Создать новый тег":
         await message.answer("Введите новый тег:", reply_markup=get_cancel_keyboard())
@@ -180,11 +409,18 @@ async def process_tag(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка: {error_message}", reply_markup=get_cancel_keyboard())
         return
     data = await state.get_data()
-    save_result = await save_message(
-        message.from_user.id, data.get("user_text"), tag_text.strip(),
-        data.get("name"), datetime.now()
-    )
+    try:
+        save_result = await save_message(
+            message.from_user.id, data.get("user_text"), tag_text.strip(),
+            data.get("name"), datetime.now()
+        )
+    except QuotaExceededError:
+        await message.answer(QUOTA_EXCEEDED_TEXT, reply_markup=get_main_keyboard())
+        await state.clear()
+        return
     if save_result:
+        if data.get("name") is None:
+            backfill_title(message.from_user.id, save_result, data.get("user_text"))
         action_type = "новым" if data.get("creating_new_tag", False) else "существующим"
         await message.answer(f"✅ Сообщение успешно сохранено с {action_type} тегом!", reply_markup=get_main_keyboard())
     else:
@@ -194,41 +430,36 @@ async def process_tag(message: types.Message, state: FSMContext):
 # --- ОБРАБОТЧИКИ ГЛАВНОГО МЕНЮ ---
 @dp.message(F.text == "📋 Просмотреть записи")
 async def view_records_handler(message: types.Message):
-    if not await check_access(message): return
-    records = await get_messages(message.from_user.id)
+    records, has_next = await get_messages_page(message.from_user.id, RECORDS_PAGE_SIZE)
     if not records:
         await message.answer("📭 У вас пока нет сохраненных записей.", reply_markup=get_main_keyboard())
         return
+    await message.answer("🗂️ Ваши записи:", reply_markup=get_records_page_keyboard(records, False, has_next))
 
-    grouped_records = {}
-    for record in records:
-        tag = record['tag']
-        if tag not in grouped_records:
-            grouped_records[tag] = []
-        grouped_records[tag].append(record)
 
-    builder = InlineKeyboardBuilder()
-    for tag, recs in sorted(grouped_records.items()):
-        display_tag = "Без тега" if tag == "no_tag" else html.escape(tag)
-        builder.row(InlineKeyboardButton(text=f"📌 {display_tag}", callback_data="ignore"))
-        for r in recs:
-            record_id = r['id']
-            record_text = r['message']
-            record_name = r['name']
-            link_text_content = record_name if record_name else record_text
-            link_text = (link_text_content[:40] + '...') if len(link_text_content) > 40 else link_text_content
-            safe_link_text = html.escape(link_text)
-            builder.row(InlineKeyboardButton(
-                text=f"• {safe_link_text}",
-                callback_data=f"view_record_{record_id}"
-            ))
-
-    await message.answer("🗂️ Ваши записи:", reply_markup=builder.as_markup())
+@dp.callback_query(F.data.startswith("records_next_") | F.data.startswith("records_prev_"))
+async def records_page_callback(callback_query: CallbackQuery):
+    try:
+        _, direction, micros, record_id = callback_query.data.split("_")
+        cursor = decode_page_cursor(micros, record_id)
+    except ValueError:
+        await callback_query.answer("❌ Ошибка навигации.", show_alert=True)
+        return
+
+    backward = direction == "prev"
+    records, has_more = await get_messages_page(callback_query.from_user.id, RECORDS_PAGE_SIZE, cursor, backward)
+    if not records:
+        await callback_query.answer("📭 Больше записей нет.", show_alert=True)
+        return
+
+    # При движении назад за курсором гарантированно есть более старые записи, и наоборот
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    await callback_query.message.edit_reply_markup(reply_markup=get_records_page_keyboard(records, has_prev, has_next))
+    await callback_query.answer()
 
 
 @dp.message(F.text == "🔍 Поиск по тегу")
 async def search_by_tag_handler(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     tags = await get_tags(message.from_user.id)
     keyboard = create_tags_keyboard(tags)
     if not keyboard:
@@ -240,53 +471,159 @@ async def search_by_tag_handler(message: types.Message, state: FSMContext):
 
 @dp.message(UserState.waiting_for_tag_selection)
 async def process_tag_selection(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text == "❌ Отменить":
         await message.answer("Поиск отменен.", reply_markup=get_main_keyboard())
         await state.clear()
         return
     raw_tag_text = message.text.split(" (")[0]
     tag_to_search = "no_tag" if raw_tag_text == "Без тега" else raw_tag_text
-    records = await get_messages_by_tag(message.from_user.id, tag_to_search)
+    records, has_next = await get_messages_page(message.from_user.id, TAG_PAGE_SIZE, tag=tag_to_search)
     if not records:
         await message.answer(f"📭 Записи с тегом '{raw_tag_text}' не найдены.", reply_markup=get_main_keyboard())
         await state.clear()
         return
-    await message.answer(f"🔍 Записи с тегом '<b>{html.escape(raw_tag_text)}</b>':", parse_mode="HTML")
-    for record in records:
-        formatted_date = record['timestamp'].strftime('%d.%m.%Y')
-        safe_text = html.escape(str(record['message']))
-        safe_name = html.escape(str(record['name'])) if record['name'] else "<i>(нет названия)</i>"
-        response = (
-            f"<b>Название:</b> {safe_name}\n"
-            f"<b>Ссылка:</b> {safe_text}\n"
-            f"<b>Дата:</b> {formatted_date}"
-        )
-        
-        builder = InlineKeyboardBuilder()
-        builder.button(text="✏️ Редактировать", callback_data=f"edit_record_{record['id']}")
-        builder.button(text="🗑 Удалить", callback_data=f"del_{record['id']}")
-        builder.adjust(2)
-        
-        await message.answer(response, parse_mode="HTML", link_preview_options=LinkPreviewOptions(is_disabled=True), reply_markup=builder.as_markup())
-        
+    await send_tag_page(message, tag_to_search, records, has_next, edit=False)
     await message.answer("Выберите следующее действие:", reply_markup=get_main_keyboard())
     await state.clear()
 
 
+async def send_tag_page(message: types.Message, tag: str, records: list, has_more: bool, edit: bool, backward: bool = False):
+    """
+    Выводит страницу записей с тегом одним сообщением (или редактирует текущее при edit=True).
+    Записи упаковываются в лимит длины сообщения; если поместились не все, остаток уходит
+    на соседнюю страницу.
+    """
+    display_tag = "Без тега" if tag == "no_tag" else tag
+    header = f"🔍 Записи с тегом '<b>{html.escape(display_tag)}</b>':"
+    text, included = pack_records(header, records, from_end=backward)
+    truncated = len(included) < len(records)
+
+    # Кнопки навигации несут id крайней записи страницы: по ней восстанавливаются тег и курсор
+    if backward:
+        has_prev, has_next = has_more or truncated, True
+    else:
+        # Редактируется только страница, открытая навигацией, значит перед ней есть записи
+        has_prev, has_next = edit, has_more or truncated
+    keyboard = get_records_batch_keyboard(
+        included,
+        f"tagpage_prev_{included[0]['id']}" if has_prev else None,
+        f"tagpage_next_{included[-1]['id']}" if has_next else None
+    )
+    link_preview = LinkPreviewOptions(is_disabled=True)
+    if edit:
+        await message.edit_text(text, parse_mode="HTML", link_preview_options=link_preview, reply_markup=keyboard)
+    else:
+        await message.answer(text, parse_mode="HTML", link_preview_options=link_preview, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("tagpage_next_") | F.data.startswith("tagpage_prev_"))
+async def tag_page_callback(callback_query: CallbackQuery):
+    try:
+        _, direction, record_id = callback_query.data.split("_")
+        record_id = int(record_id)
+    except ValueError:
+        await callback_query.answer("❌ Ошибка навигации.", show_alert=True)
+        return
+
+    anchor = await get_message_by_id(callback_query.from_user.id, record_id)
+    if not anchor:
+        await callback_query.answer("Список изменился. Выполните поиск по тегу заново.", show_alert=True)
+        return
+
+    backward = direction == "prev"
+    records, has_more = await get_messages_page(
+        callback_query.from_user.id, TAG_PAGE_SIZE, (anchor['timestamp'], anchor['id']), backward, tag=anchor['tag']
+    )
+    if not records:
+        await callback_query.answer("📭 Больше записей нет.", show_alert=True)
+        return
+
+    await send_tag_page(callback_query.message, anchor['tag'], records, has_more, edit=True, backward=backward)
+    await callback_query.answer()
+
+
+@dp.message(Command("search"))
+async def search_command_handler(message: types.Message, command: CommandObject, state: FSMContext):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Использование: <code>/search запрос</code>\nИщет по ссылкам и названиям записей.", parse_mode="HTML")
+        return
+    if len(query) > SEARCH_QUERY_MAX_LENGTH:
+        await message.answer(f"❌ Ошибка: запрос не должен превышать {SEARCH_QUERY_MAX_LENGTH} символов!")
+        return
+
+    records, has_more = await search_messages(message.from_user.id, query, SEARCH_PAGE_SIZE)
+    if not records:
+        await message.answer(f"📭 По запросу «{html.escape(query)}» ничего не найдено.", parse_mode="HTML")
+        return
+    # Запрос нужен для перелистывания страниц и не помещается в callback_data
+    await state.update_data(search_query=query)
+    await send_search_page(message, query, records, 0, has_more, edit=False)
+
+
+async def send_search_page(message: types.Message, query: str, records: list, offset: int, has_more: bool, edit: bool, backward: bool = False):
+    """Выводит страницу результатов поиска, начинающуюся с offset, одним сообщением."""
+    header = f"🔎 Результаты поиска «<b>{html.escape(query)}</b>»:"
+    text, included = pack_records(header, records, from_end=backward)
+    if backward:
+        # Страница собрана с конца: смещение ее начала зависит от того, сколько записей поместилось
+        offset += len(records) - len(included)
+    end_offset = offset + len(included)
+    has_next = has_more or end_offset < offset + len(records) or backward
+
+    keyboard = get_records_batch_keyboard(
+        included,
+        f"search_prev_{offset}" if offset > 0 else None,
+        f"search_next_{end_offset}" if has_next else None
+    )
+    link_preview = LinkPreviewOptions(is_disabled=True)
+    if edit:
+        await message.edit_text(text, parse_mode="HTML", link_preview_options=link_preview, reply_markup=keyboard)
+    else:
+        await message.answer(text, parse_mode="HTML", link_preview_options=link_preview, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("search_next_") | F.data.startswith("search_prev_"))
+async def search_page_callback(callback_query: CallbackQuery, state: FSMContext):
+    try:
+        _, direction, offset = callback_query.data.split("_")
+        offset = int(offset)
+    except ValueError:
+        await callback_query.answer("❌ Ошибка навигации.", show_alert=True)
+        return
+
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback_query.answer("Результаты поиска устарели. Повторите /search.", show_alert=True)
+        return
+
+    backward = direction == "prev"
+    if backward:
+        start = max(0, offset - SEARCH_PAGE_SIZE)
+        records, _ = await search_messages(callback_query.from_user.id, query, offset - start, start)
+        has_more = False
+    else:
+        start = offset
+        records, has_more = await search_messages(callback_query.from_user.id, query, SEARCH_PAGE_SIZE, start)
+    if not records:
+        await callback_query.answer("📭 Больше результатов нет.", show_alert=True)
+        return
+
+    await send_search_page(callback_query.message, query, records, start, has_more, edit=True, backward=backward)
+    await callback_query.answer()
+
+
 # --- ОБРАБОТЧИКИ ДОПОЛНИТЕЛЬНОГО МЕНЮ ---
 
 @dp.message(F.text == "⚙️ Дополнительно")
 async def extra_menu_handler(message: types.Message):
-    if not await check_access(message): return
     await message.answer(
         "Дополнительные действия:",
-        reply_markup=get_extra_keyboard()
+        reply_markup=get_extra_keyboard(is_admin=message.from_user.id == ADMIN_USER_ID)
     )
 
 @dp.message(F.text == "📊 Статистика")
 async def stats_handler(message: types.Message):
-    if not await check_access(message): return
 
     stats = await get_stats(message.from_user.id)
 
@@ -313,45 +650,29 @@ async def stats_handler(message: types.Message):
     await message.answer(response_text, parse_mode="HTML")
 
 
+@dp.message(Command("rebuild_stats"))
+async def rebuild_stats_handler(message: types.Message):
+    """Пересчитывает счетчики статистики, если они разошлись с данными."""
+    if await rebuild_stats(message.from_user.id):
+        await message.answer("✅ Статистика пересчитана.")
+    else:
+        await message.answer("❌ Не удалось пересчитать статистику. Попробуйте позже.")
+
+
 @dp.message(F.text == "🔙 Назад")
 async def back_to_main_handler(message: types.Message):
-    if not await check_access(message): return
     await message.answer(
         "Главное меню:",
         reply_markup=get_main_keyboard()
     )
 
-@dp.message(F.text == "📤 Создать резервную копию")
-@dp.message(Command("backup"))
+@dp.message(F.text == "📤 Создать резервную копию", F.from_user.id == ADMIN_USER_ID)
+@dp.message(Command("backup"), F.from_user.id == ADMIN_USER_ID)
 async def backup_command_handler(message: types.Message):
-    if not await check_access(message): return
     await message.answer("⏳ Начинаю процесс резервного копирования...", reply_markup=get_main_keyboard())
     
-    backup_file_path = f"manual_backup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.sql"
-
     try:
-        dump_command = [
-            'pg_dump',
-            '--dbname', config.db_dsn,
-            '--file', backup_file_path,
-            '--format', 'plain',
-            '--clean'
-        ]
-
-        process = await asyncio.create_subprocess_exec(
-            *dump_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode != 0:
-            error_message = stderr.decode().strip()
-            logging.error(f"pg_dump завершился с ошибкой: {error_message}")
-            await message.answer(f"❌ Ошибка при создании дампа базы данных: {error_message}")
-            return
-
-        file_link = await asyncio.to_thread(upload_database_backup, backup_file_path, os.path.basename(backup_file_path))
+        file_link = await create_backup("manual_backup")
 
         if file_link:
             await message.answer(
@@ -361,20 +682,18 @@ async def backup_command_handler(message: types.Message):
         else:
             await message.answer("❌ Произошла ошибка во время загрузки резервной копии на Google Drive.")
 
+    except BackupError as e:
+        await message.answer(f"❌ Ошибка при создании дампа базы данных: {e}")
     except FileNotFoundError:
         logging.error("Команда 'pg_dump' не найдена. Убедитесь, что postgresql-client установлен.")
         await message.answer("❌ Ошибка: команда `pg_dump` не найдена. Установите `postgresql-client`.")
     except Exception as e:
         logging.error(f"Manual backup process failed: {e}")
         await message.answer("❌ Произошла критическая ошибка в процессе резервного копирования.")
-    finally:
-        if os.path.exists(backup_file_path):
-            os.remove(backup_file_path)
 
 
-@dp.message(F.text == "📥 Восстановить из бекапа")
+@dp.message(F.text == "📥 Восстановить из бекапа", F.from_user.id == ADMIN_USER_ID)
 async def restore_backup_start_handler(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     confirm_kb = ReplyKeyboardMarkup(
         keyboard=[
             [types.KeyboardButton(text="ДА, Я ПОНИМАЮ РИСКИ")],
@@ -396,55 +715,39 @@ async def restore_backup_start_handler(message: types.Message, state: FSMContext
 
 @dp.message(UserState.waiting_for_restore_confirmation)
 async def process_restore_confirmation(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text == "ДА, Я ПОНИМАЮ РИСКИ":
-        await message.answer("⏳ Начинаю скачивание последней резервной копии...", reply_markup=get_main_keyboard())
-        
-        temp_backup_path = f"restore_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.sql"
-        
+        await message.answer("⏳ Начинаю восстановление из последней резервной копии...", reply_markup=get_main_keyboard())
+        status_message = await message.answer("⏳ Ищу резервную копию на Google Drive...")
+
+        async def report_progress(stage, done, total):
+            text = f"⏳ Восстановление ({stage}): скачано {done / 1024 / 1024:.1f} МБ"
+            if total:
+                text += f" из {total / 1024 / 1024:.1f} МБ ({done * 100 // total}%)"
+            try:
+                await status_message.edit_text(text)
+            except TelegramBadRequest:
+                # Текст не изменился или сообщение уже удалено
+                pass
+
         try:
-            success = await asyncio.to_thread(download_latest_backup, temp_backup_path)
-            
-            if not success:
-                await message.answer("❌ Не удалось найти или скачать резервную копию с Google Drive.")
+            if not await restore_latest_backup(report_progress):
+                await status_message.edit_text("❌ Не удалось найти резервную копию на Google Drive.")
                 return
 
-            await message.answer("✅ Бекап скачан. Начинаю восстановление базы данных...")
-
-            restore_command = [
-                'psql',
-                '--dbname', config.db_dsn,
-                '-f', temp_backup_path
-            ]
-
-            process = await asyncio.create_subprocess_exec(
-                *restore_command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            await status_message.edit_text("✅ Резервная копия скачана и применена.")
+            await message.answer(
+                "✅ База данных успешно восстановлена из резервной копии! Бот уже работает с обновленными данными."
             )
-            stdout, stderr = await process.communicate()
-
-            if process.returncode != 0:
-                error_message = stderr.decode().strip()
-                logging.error(f"psql завершился с ошибкой: {error_message}")
-                await message.answer(f"❌ Ошибка при восстановлении из дампа: {error_message}")
-            else:
-                await message.answer(
-                    "✅ База данных успешно восстановлена из резервной копии!\n\n"
-                    "❗️<b>Важно:</b> Пожалуйста, перезапустите бота (остановите и запустите его заново), "
-                    "чтобы он начал работать с обновленными данными.",
-                    parse_mode="HTML"
-                )
-
-        except FileNotFoundError:
-            logging.error("Команда 'psql' не найдена. Убедитесь, что postgresql-client установлен.")
-            await message.answer("❌ Ошибка: команда `psql` не найдена. Установите `postgresql-client`.")
+
+        except BackupError as e:
+            await message.answer(f"❌ Ошибка при восстановлении из дампа: {e}")
+        except FileNotFoundError as e:
+            logging.error(f"Утилита восстановления не найдена ({e}). Убедитесь, что postgresql-client установлен.")
+            await message.answer("❌ Ошибка: команда `psql`/`pg_restore` не найдена. Установите `postgresql-client`.")
         except Exception as e:
             logging.error(f"Restore process failed: {e}")
             await message.answer("❌ Произошла критическая ошибка в процессе восстановления.")
         finally:
-            if os.path.exists(temp_backup_path):
-                os.remove(temp_backup_path)
             await state.clear()
             
     else:
@@ -452,9 +755,57 @@ async def process_restore_confirmation(message: types.Message, state: FSMContext
         await state.clear()
 
 
+# --- Управление пользователями (многопользовательский режим, только владелец) ---
+
+@dp.message(Command("users"), F.from_user.id == ADMIN_USER_ID)
+async def list_users_handler(message: types.Message):
+    users = await get_allowed_users()
+    if users is None:
+        await message.answer("❌ Не удалось получить список пользователей. Попробуйте позже.")
+        return
+    default_limit = config.user_max_records or "без ограничений"
+    lines = [f"👥 <b>Пользователи бота</b> (лимит записей по умолчанию: {default_limit}):", ""]
+    lines.append(f"• <code>{ADMIN_USER_ID}</code> - владелец")
+    for row in users:
+        limit = row['max_records'] if row['max_records'] is not None else "по умолчанию"
+        lines.append(f"• <code>{row['user_id']}</code> - лимит записей: {limit}")
+    if not config.multi_user:
+        lines += ["", "⚠️ Многопользовательский режим выключен (multi_user), доступ есть только у владельца."]
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@dp.message(Command("adduser"), F.from_user.id == ADMIN_USER_ID)
+async def add_user_handler(message: types.Message, command: CommandObject):
+    """/adduser <id> [лимит записей] - добавляет пользователя или меняет его лимит."""
+    args = (command.args or "").split()
+    if not 1 <= len(args) <= 2 or not all(arg.isdigit() for arg in args):
+        await message.answer("Использование: /adduser <id пользователя> [лимит записей]")
+        return
+    user_id = int(args[0])
+    max_records = int(args[1]) if len(args) == 2 else None
+    if await add_allowed_user(user_id, max_records):
+        access.invalidate()
+        await message.answer(f"✅ Пользователь {user_id} добавлен.")
+    else:
+        await message.answer("❌ Не удалось добавить пользователя. Попробуйте позже.")
+
+
+@dp.message(Command("removeuser"), F.from_user.id == ADMIN_USER_ID)
+async def remove_user_handler(message: types.Message, command: CommandObject):
+    """/removeuser <id> - закрывает пользователю доступ. Его записи сохраняются."""
+    arg = (command.args or "").strip()
+    if not arg.isdigit():
+        await message.answer("Использование: /removeuser <id пользователя>")
+        return
+    if await remove_allowed_user(int(arg)):
+        access.invalidate()
+        await message.answer(f"✅ Пользователь {arg} удален из списка доступа.")
+    else:
+        await message.answer("❌ Пользователь не найден или не удалось его удалить.")
+
+
 @dp.message(F.text == "🗑 Удалить всё")
 async def confirm_deletion_handler(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     keyboard = ReplyKeyboardMarkup(keyboard=[[types.KeyboardButton(text="✅ Да, удалить всё")], [types.KeyboardButton(text="❌ Нет, отменить")]], resize_keyboard=True)
     await message.answer(
         "⚠️ <b>ВНИМАНИЕ!</b>\n\nВы собираетесь удалить ВСЕ сохраненные записи. Это действие нельзя будет отменить.\n\nВы действительно хотите удалить все записи?",
@@ -470,7 +821,6 @@ async def ignore_callback(callback_query: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("view_record_"))
 async def show_record_details_callback(callback_query: CallbackQuery):
-    if not await check_access(callback_query): return
     try:
         record_id = int(callback_query.data.split("_")[2])
     except (IndexError, ValueError):
@@ -502,10 +852,27 @@ async def show_record_details_callback(callback_query: CallbackQuery):
     await callback_query.message.answer(response, parse_mode="HTML", reply_markup=builder.as_markup(), disable_web_page_preview=True)
     await callback_query.answer()
 
+async def get_own_record_id(callback_query: CallbackQuery):
+    """
+    Возвращает id записи из callback_data (edit_<поле>_<id>), если запись принадлежит нажавшему кнопку.
+    Иначе отвечает ошибкой и возвращает None.
+    """
+    try:
+        record_id = int(callback_query.data.split("_")[2])
+    except (IndexError, ValueError):
+        await callback_query.answer("❌ Ошибка ID записи.", show_alert=True)
+        return None
+    if not await get_message_by_id(callback_query.from_user.id, record_id):
+        await callback_query.answer("❌ Запись не найдена.", show_alert=True)
+        return None
+    return record_id
+
 @dp.callback_query(F.data.startswith("edit_record_"))
 async def edit_record_menu_callback(callback_query: CallbackQuery):
-    record_id = int(callback_query.data.split("_")[2])
-    
+    record_id = await get_own_record_id(callback_query)
+    if record_id is None:
+        return
+
     builder = InlineKeyboardBuilder()
     builder.button(text="Изменить название", callback_data=f"edit_name_{record_id}")
     builder.button(text="Изменить ссылку", callback_data=f"edit_link_{record_id}")
@@ -527,7 +894,9 @@ async def close_edit_menu_callback(callback_query: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("edit_name_"))
 async def edit_name_callback(callback_query: CallbackQuery, state: FSMContext):
-    record_id = int(callback_query.data.split("_")[2])
+    record_id = await get_own_record_id(callback_query)
+    if record_id is None:
+        return
     await state.update_data(record_id_to_edit=record_id)
     await state.set_state(UserState.editing_record_name)
     await callback_query.message.edit_text("Введите новое название для записи:")
@@ -535,7 +904,9 @@ async def edit_name_callback(callback_query: CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("edit_link_"))
 async def edit_link_callback(callback_query: CallbackQuery, state: FSMContext):
-    record_id = int(callback_query.data.split("_")[2])
+    record_id = await get_own_record_id(callback_query)
+    if record_id is None:
+        return
     await state.update_data(record_id_to_edit=record_id)
     await state.set_state(UserState.editing_record_link)
     await callback_query.message.edit_text("Введите новую ссылку для записи:")
@@ -543,15 +914,17 @@ async def edit_link_callback(callback_query: CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("edit_tag_"))
 async def edit_tag_callback(callback_query: CallbackQuery, state: FSMContext):
-    record_id = int(callback_query.data.split("_")[2])
+    record_id = await get_own_record_id(callback_query)
+    if record_id is None:
+        return
     await state.update_data(record_id_to_edit=record_id)
     await state.set_state(UserState.editing_record_tag)
     tags = await get_tags(callback_query.from_user.id)
     kb = [[types.KeyboardButton(text="Создать новый тег")]]
     if tags:
-        for tag in tags:
-            if tag['tag'] != "no_tag":
-                kb.append([types.KeyboardButton(text=f"{tag['tag']} ({tag['count']})")])
+        for tag, count in tags:
+            if tag != "no_tag":
+                kb.append([types.KeyboardButton(text=f"{tag} ({count})")])
     kb.append([types.KeyboardButton(text="❌ Отменить")])
     keyboard = types.ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
     await callback_query.message.answer("Выберите новый тег или создайте его:", reply_markup=keyboard)
@@ -568,7 +941,7 @@ async def process_new_name(message: types.Message, state: FSMContext):
     data = await state.get_data()
     record_id = data.get("record_id_to_edit")
     
-    if await update_record_field(record_id, "name", message.text.strip()):
+    if await update_record_field(message.from_user.id, record_id, "name", message.text.strip()):
         await message.answer("✅ Название успешно обновлено!", reply_markup=get_main_keyboard())
     else:
         await message.answer("❌ Не удалось обновить название. Попробуйте позже.", reply_markup=get_main_keyboard())
@@ -584,7 +957,7 @@ async def process_new_link(message: types.Message, state: FSMContext):
     data = await state.get_data()
     record_id = data.get("record_id_to_edit")
     
-    if await update_record_field(record_id, "message", message.text.strip()):
+    if await update_record_field(message.from_user.id, record_id, "message", message.text.strip()):
         await message.answer("✅ Ссылка успешно обновлена!", reply_markup=get_main_keyboard())
     else:
         await message.answer("❌ Не удалось обновить ссылку. Попробуйте позже.", reply_markup=get_main_keyboard())
@@ -605,7 +978,7 @@ async def process_new_tag(message: types.Message, state: FSMContext):
     data = await state.get_data()
     record_id = data.get("record_id_to_edit")
     
-    if await update_record_field(record_id, "tag", tag_text.strip()):
+    if await update_record_field(message.from_user.id, record_id, "tag", tag_text.strip()):
         await message.answer("✅ Тег успешно обновлен!", reply_markup=get_main_keyboard())
     else:
         await message.answer("❌ Не удалось обновить тег. Попробуйте позже.", reply_markup=get_main_keyboard())
@@ -614,7 +987,6 @@ async def process_new_tag(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "save_url")
 async def process_save_url_callback(callback_query: CallbackQuery, state: FSMContext):
-    if not await check_access(callback_query): return
     data = await state.get_data()
     url = data.get("temp_url")
     if url:
@@ -633,7 +1005,6 @@ async def process_cancel_url_callback(callback_query: CallbackQuery):
 
 @dp.callback_query(F.data.startswith('del_'))
 async def process_delete_callback(callback_query: CallbackQuery):
-    if not await check_access(callback_query): return
     record_id = int(callback_query.data.split('_')[1])
     keyboard = get_delete_confirmation_keyboard(record_id)
     await callback_query.message.edit_text(
@@ -644,7 +1015,6 @@ async def process_delete_callback(callback_query: CallbackQuery):
 
 @dp.callback_query(F.data.startswith('confirm_del_'))
 async def confirm_delete_callback(callback_query: CallbackQuery):
-    if not await check_access(callback_query): return
     record_id = int(callback_query.data.split('_')[2])
     if await delete_message_by_id(callback_query.from_user.id, record_id):
         await callback_query.message.delete()
@@ -654,7 +1024,6 @@ async def confirm_delete_callback(callback_query: CallbackQuery):
 
 @dp.callback_query(F.data.startswith('cancel_del_'))
 async def cancel_delete_callback(callback_query: CallbackQuery):
-    if not await check_access(callback_query): return
     original_html_text = callback_query.message.html_text.split("\n\n❓")[0]
     record_id = int(callback_query.data.split('_')[2])
     builder = InlineKeyboardBuilder()
@@ -666,7 +1035,6 @@ async def cancel_delete_callback(callback_query: CallbackQuery):
 
 @dp.message(UserState.waiting_for_deletion_confirmation)
 async def process_deletion_confirmation(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text == "✅ Да, удалить всё":
         keyboard = ReplyKeyboardMarkup(keyboard=[[types.KeyboardButton(text="✅ Подтверждаю удаление")], [types.KeyboardButton(text="❌ Отменить удаление")]], resize_keyboard=True)
         await message.answer(
@@ -680,7 +1048,6 @@ async def process_deletion_confirmation(message: types.Message, state: FSMContex
 
 @dp.message(UserState.waiting_for_final_confirmation)
 async def process_final_deletion(message: types.Message, state: FSMContext):
-    if not await check_access(message): return
     if message.text == "✅ Подтверждаю удаление":
         if await delete_messages(message.from_user.id):
             await message.answer("🗑 Все записи успешно удалены!", reply_markup=get_main_keyboard())
@@ -697,7 +1064,6 @@ async def handle_text_message(message: types.Message, state: FSMContext):
     Обрабатывает текстовые сообщения. Если это не URL и не команда с клавиатуры,
     начинает процесс создания новой заметки.
     """
-    if not await check_access(message): return
 
     # Проверяем, не находимся ли мы уже в каком-то процессе
     current_state = await state.get_state()
@@ -714,12 +1080,24 @@ async def handle_text_message(message: types.Message, state: FSMContext):
 
 
 async def main():
+    metrics_runner = None
     try:
-        await init_db()
-        setup_scheduler(bot, ALLOWED_USER_ID)
-        await dp.start_polling(bot)
+        if config.metrics_port:
+            metrics_runner = await start_metrics_server(config.metrics_host, config.metrics_port)
+        await init_db(redis_client)
+        if config.run_scheduler:
+            setup_scheduler(bot, ADMIN_USER_ID)
+        if config.bot_mode == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            # getUpdates не работает, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logging.critical(f"Критическая ошибка при запуске бота: {e}")
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,148 @@
+import functools
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# Границы корзин гистограмм: от миллисекунд (запросы к базе и Redis) до минут (обработчики с бекапом)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+HANDLER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BACKUP_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HANDLER_SECONDS = Histogram(
+    'savelink_handler_seconds', 'Время работы обработчика aiogram',
+    ['handler', 'event', 'status'], buckets=HANDLER_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    'savelink_db_query_seconds', 'Время выполнения функции database.py, включая ожидание соединения',
+    ['function'], buckets=FAST_BUCKETS
+)
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    'savelink_db_pool_acquire_seconds', 'Время ожидания свободного соединения из пула asyncpg',
+    buckets=FAST_BUCKETS
+)
+DB_POOL_WAITING = Gauge('savelink_db_pool_waiting', 'Число задач, ожидающих соединение из пула asyncpg')
+REDIS_FSM_SECONDS = Histogram(
+    'savelink_redis_fsm_seconds', 'Время чтения и записи состояния FSM в Redis',
+    ['operation'], buckets=FAST_BUCKETS
+)
+BACKUP_STAGE_SECONDS = Histogram(
+    'savelink_backup_stage_seconds', 'Время этапа создания или восстановления бекапа',
+    ['stage'], buckets=BACKUP_BUCKETS
+)
+BACKUP_STAGE_BYTES = Counter(
+    'savelink_backup_stage_bytes', 'Объем данных, прошедших через этап создания или восстановления бекапа',
+    ['stage']
+)
+
+
+def observe_backup_stage(stage: str, seconds: float, size: int | None = None):
+    """Записывает длительность этапа бекапа и, если известен, объем данных."""
+    BACKUP_STAGE_SECONDS.labels(stage).observe(seconds)
+    if size is not None:
+        BACKUP_STAGE_BYTES.labels(stage).inc(size)
+
+
+def timed_query(func):
+    """Декоратор корутины database.py: записывает время ее выполнения в DB_QUERY_SECONDS."""
+    histogram = DB_QUERY_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class TimedAcquire:
+    """Контекстный менеджер вместо pool.acquire(), который измеряет ожидание соединения из пула."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._connection = None
+
+    async def __aenter__(self):
+        DB_POOL_WAITING.inc()
+        started = time.perf_counter()
+        try:
+            self._connection = await self._pool.acquire()
+        finally:
+            DB_POOL_WAITING.dec()
+            DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+        return self._connection
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._connection)
+
+
+class PoolCollector:
+    """Отдает размеры пула asyncpg в момент запроса метрик; get_pool возвращает текущий пул или None."""
+
+    def __init__(self, get_pool):
+        self._get_pool = get_pool
+
+    def collect(self):
+        pool = self._get_pool()
+        if pool is None:
+            return
+        for name, documentation, value in (
+            ('savelink_db_pool_size', 'Число открытых соединений пула asyncpg', pool.get_size()),
+            ('savelink_db_pool_idle', 'Число свободных соединений пула asyncpg', pool.get_idle_size()),
+            ('savelink_db_pool_max_size', 'Максимальный размер пула asyncpg', pool.get_max_size()),
+        ):
+            yield GaugeMetricFamily(name, documentation, value=value)
+
+
+def register_pool_collector(get_pool):
+    REGISTRY.register(PoolCollector(get_pool))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware наблюдателей сообщений и нажатий кнопок: записывает время работы
+    каждого сработавшего обработчика с его именем и результатом (ok или error).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        status = "error"
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+            status = "ok"
+            return result
+        finally:
+            HANDLER_SECONDS.labels(name, type(event).__name__, status).observe(time.perf_counter() - started)
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Запускает HTTP-сервер с эндпоинтом /metrics в формате Prometheus. Сервер отдельный от вебхука,
+    чтобы метрики можно было держать во внутренней сети. Возвращает runner для остановки через cleanup().
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики Prometheus доступны на {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,250 @@
+import logging
+
+# Ключ advisory-блокировки, чтобы несколько экземпляров бота не применяли миграции одновременно
+MIGRATIONS_LOCK_KEY = 7_246_001
+
+# Список миграций схемы: (версия, описание, SQL). Уже примененные миграции не изменяются,
+# любые изменения схемы добавляются новой записью в конец списка.
+MIGRATIONS = [
+    (1, "Создание таблицы messages", '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            message TEXT NOT NULL,
+            name TEXT,
+            tag TEXT DEFAULT 'no_tag',
+            timestamp TIMESTAMPTZ NOT NULL,
+            UNIQUE(user_id, message, tag)
+        )
+    '''),
+    (2, "Индексы для выборок по пользователю и тегу, компактный ключ уникальности", '''
+        CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp
+            ON messages (user_id, timestamp DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_messages_user_tag
+            ON messages (user_id, tag, timestamp DESC, id DESC);
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS message_hash BYTEA
+            GENERATED ALWAYS AS (decode(md5(message), 'hex')) STORED;
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_user_tag_hash
+            ON messages (user_id, tag, message_hash);
+        ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_user_id_message_tag_key;
+    '''),
+    (3, "Материализованные счетчики статистики, поддерживаемые триггерами", '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id BIGINT PRIMARY KEY,
+            total_records INT NOT NULL DEFAULT 0,
+            total_tags INT NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS user_tag_counts (
+            user_id BIGINT NOT NULL,
+            tag TEXT NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (user_id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_tag_counts_popular
+            ON user_tag_counts (user_id, count DESC, tag);
+
+        -- Применяет изменение количества записей с тегом p_tag на p_delta
+        CREATE OR REPLACE FUNCTION apply_message_stats(p_user_id BIGINT, p_tag TEXT, p_delta INT)
+        RETURNS void AS $$
+        DECLARE
+            new_count INT;
+        BEGIN
+            INSERT INTO user_tag_counts (user_id, tag, count) VALUES (p_user_id, p_tag, p_delta)
+            ON CONFLICT (user_id, tag) DO UPDATE SET count = user_tag_counts.count + EXCLUDED.count
+            RETURNING count INTO new_count;
+            IF new_count <= 0 THEN
+                DELETE FROM user_tag_counts WHERE user_id = p_user_id AND tag = p_tag;
+            END IF;
+            INSERT INTO user_stats (user_id, total_records, total_tags)
+            VALUES (
+                p_user_id,
+                p_delta,
+                CASE
+                    WHEN p_tag = 'no_tag' THEN 0
+                    WHEN p_delta > 0 AND new_count = p_delta THEN 1
+                    WHEN p_delta < 0 AND new_count <= 0 THEN -1
+                    ELSE 0
+                END
+            )
+            ON CONFLICT (user_id) DO UPDATE SET
+                total_records = user_stats.total_records + EXCLUDED.total_records,
+                total_tags = user_stats.total_tags + EXCLUDED.total_tags;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION messages_stats_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM apply_message_stats(OLD.user_id, COALESCE(OLD.tag, 'no_tag'), -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM apply_message_stats(NEW.user_id, COALESCE(NEW.tag, 'no_tag'), 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION messages_stats_truncate_trigger() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM user_tag_counts;
+            DELETE FROM user_stats;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Полный пересчет счетчиков для пользователя (или для всех при p_user_id IS NULL)
+        CREATE OR REPLACE FUNCTION rebuild_message_stats(p_user_id BIGINT) RETURNS void AS $$
+        BEGIN
+            LOCK TABLE messages IN SHARE MODE;
+            DELETE FROM user_tag_counts WHERE p_user_id IS NULL OR user_id = p_user_id;
+            DELETE FROM user_stats WHERE p_user_id IS NULL OR user_id = p_user_id;
+            INSERT INTO user_tag_counts (user_id, tag, count)
+                SELECT user_id, COALESCE(tag, 'no_tag'), COUNT(*) FROM messages
+                WHERE p_user_id IS NULL OR user_id = p_user_id
+                GROUP BY user_id, COALESCE(tag, 'no_tag');
+            INSERT INTO user_stats (user_id, total_records, total_tags)
+                SELECT user_id, SUM(count), COUNT(*) FILTER (WHERE tag <> 'no_tag') FROM user_tag_counts
+                WHERE p_user_id IS NULL OR user_id = p_user_id
+                GROUP BY user_id;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS messages_stats ON messages;
+        CREATE TRIGGER messages_stats
+            AFTER INSERT OR DELETE OR UPDATE OF user_id, tag ON messages
+            FOR EACH ROW EXECUTE FUNCTION messages_stats_trigger();
+        DROP TRIGGER IF EXISTS messages_stats_truncate ON messages;
+        CREATE TRIGGER messages_stats_truncate
+            AFTER TRUNCATE ON messages
+            FOR EACH STATEMENT EXECUTE FUNCTION messages_stats_truncate_trigger();
+
+        SELECT rebuild_message_stats(NULL);
+    '''),
+    (4, "Полнотекстовый и нечеткий поиск по ссылкам и названиям", '''
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+                setweight(to_tsvector('simple', message), 'B')
+            ) STORED;
+        CREATE INDEX IF NOT EXISTS idx_messages_search_vector
+            ON messages USING GIN (search_vector);
+        CREATE INDEX IF NOT EXISTS idx_messages_message_trgm
+            ON messages USING GIN (message gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_messages_name_trgm
+            ON messages USING GIN (name gin_trgm_ops);
+    '''),
+    (5, "Отслеживание изменений и удалений для инкрементальных бекапов", '''
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        CREATE INDEX IF NOT EXISTS idx_messages_updated_at ON messages (updated_at);
+
+        CREATE TABLE IF NOT EXISTS deleted_messages (
+            id INT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS idx_deleted_messages_deleted_at ON deleted_messages (deleted_at);
+
+        -- Состояние бекапов: момент, на который снят последний бекап, и число инкрементов после полного
+        CREATE TABLE IF NOT EXISTS backup_state (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            last_backup_at TIMESTAMPTZ,
+            cycles_since_full INT NOT NULL DEFAULT 0
+        );
+        INSERT INTO backup_state (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION messages_touch_trigger() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION messages_tombstone_trigger() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO deleted_messages (id, user_id) VALUES (OLD.id, OLD.user_id)
+            ON CONFLICT (id) DO UPDATE SET deleted_at = now();
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS messages_touch ON messages;
+        CREATE TRIGGER messages_touch
+            BEFORE UPDATE ON messages
+            FOR EACH ROW EXECUTE FUNCTION messages_touch_trigger();
+        DROP TRIGGER IF EXISTS messages_tombstone ON messages;
+        CREATE TRIGGER messages_tombstone
+            AFTER DELETE ON messages
+            FOR EACH ROW EXECUTE FUNCTION messages_tombstone_trigger();
+    '''),
+    (6, "Список пользователей бота с индивидуальными лимитами записей", '''
+        CREATE TABLE IF NOT EXISTS bot_users (
+            user_id BIGINT PRIMARY KEY,
+            -- Лимит числа записей; NULL - действует лимит по умолчанию из настроек
+            max_records INT,
+            added_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    '''),
+    (7, "Хеш канонической формы ссылки для поиска дубликатов независимо от тега", '''
+        -- Заполняется приложением (url_normalizer.url_hash); NULL - запись не является ссылкой
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS url_hash BIGINT;
+        CREATE INDEX IF NOT EXISTS idx_messages_user_url_hash
+            ON messages (user_id, url_hash) WHERE url_hash IS NOT NULL;
+    '''),
+    (8, "Результаты фоновой проверки доступности ссылок", '''
+        -- Отдельная таблица, чтобы проверки не меняли updated_at записей и не попадали в инкрементальные бекапы.
+        -- Внешнего ключа нет: горячее восстановление заменяет таблицу messages целиком. Результат относится
+        -- к записи, только пока совпадает url_hash, поэтому после изменения ссылки она проверяется заново.
+        CREATE TABLE IF NOT EXISTS link_checks (
+            message_id BIGINT PRIMARY KEY,
+            url_hash BIGINT NOT NULL,
+            -- HTTP-статус последней проверки, 0 - сетевая ошибка
+            status INT NOT NULL,
+            checked_at TIMESTAMPTZ NOT NULL,
+            next_check_at TIMESTAMPTZ NOT NULL,
+            ok_streak INT NOT NULL DEFAULT 0,
+            failures INT NOT NULL DEFAULT 0,
+            etag TEXT,
+            last_modified TEXT,
+            -- С какого момента ссылка считается нерабочей и сообщено ли об этом пользователю
+            broken_since TIMESTAMPTZ,
+            reported BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        CREATE INDEX IF NOT EXISTS idx_link_checks_unreported
+            ON link_checks (message_id) WHERE broken_since IS NOT NULL AND NOT reported;
+    '''),
+    (9, "Хеш ссылки только для записей из одной ссылки, индекс записей без хеша", '''
+        -- Заметки, которые лишь начинаются со ссылки, ошибочно получили ее хеш и считались дубликатами
+        UPDATE messages SET url_hash = NULL
+            WHERE url_hash IS NOT NULL AND message !~* '^\\s*https?://\\S+\\s*$';
+        -- Кандидаты для заполнения хеша при запуске: остальные записи не перебираются
+        CREATE INDEX IF NOT EXISTS idx_messages_url_hash_pending
+            ON messages (id) WHERE url_hash IS NULL AND message ~* '^\\s*https?://\\S+\\s*$';
+    '''),
+]
+
+async def run_migrations(connection):
+    """Применяет к базе данных все еще не примененные миграции по порядку версий."""
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    await connection.execute('SELECT pg_advisory_lock($1)', MIGRATIONS_LOCK_KEY)
+    try:
+        applied = {row['version'] for row in await connection.fetch('SELECT version FROM schema_migrations')}
+        for version, description, sql in MIGRATIONS:
+            if version in applied:
+                continue
+            async with connection.transaction():
+                await connection.execute(sql)
+                await connection.execute(
+                    'INSERT INTO schema_migrations (version, description) VALUES ($1, $2)',
+                    version, description
+                )
+            logging.info(f"Применена миграция {version}: {description}")
+    finally:
+        await connection.execute('SELECT pg_advisory_unlock($1)', MIGRATIONS_LOCK_KEY)
@@ -0,0 +1,76 @@
+import ipaddress
+import socket
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+from yarl import URL
+
+
+class BlockedAddressError(aiohttp.ClientConnectionError):
+    """Запрос к адресу во внутренней сети (loopback, частные, link-local и т.п.) запрещен."""
+
+
+def is_public_address(address: str) -> bool:
+    """Проверяет, что IP-адрес маршрутизируется в интернете, а не ведет во внутреннюю сеть."""
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicOnlyResolver(AbstractResolver):
+    """
+    Резолвер для клиента aiohttp, который отбрасывает внутренние адреса хоста. Соединение
+    устанавливается только с проверенными адресами, поэтому подмена DNS-записи между проверкой
+    и запросом не помогает. Если публичных адресов нет, выбрасывает BlockedAddressError.
+    """
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        addresses = [
+            address for address in await self._resolver.resolve(host, port, family)
+            if is_public_address(address['host'])
+        ]
+        if not addresses:
+            raise BlockedAddressError(f"Хост {host} ведет во внутреннюю сеть")
+        return addresses
+
+    async def close(self):
+        await self._resolver.close()
+
+
+def _check_url_host(url: URL):
+    # IP-адреса в URL aiohttp не передает резолверу, поэтому они проверяются отдельно
+    host = (url.host or '').strip('[]')
+    try:
+        ipaddress.ip_address(host.split('%', 1)[0])
+    except ValueError:
+        return
+    if not is_public_address(host):
+        raise BlockedAddressError(f"Адрес {host} ведет во внутреннюю сеть")
+
+
+async def _check_request_host(session, context, params):
+    _check_url_host(params.url)
+
+
+async def _check_redirect_host(session, context, params):
+    # on_request_start вызывается один раз на запрос, поэтому адрес перенаправления
+    # проверяется до того, как aiohttp по нему перейдет
+    location = params.response.headers.get('Location') or params.response.headers.get('URI')
+    if location:
+        _check_url_host(params.response.url.join(URL(location)))
+
+
+def public_only_trace_config() -> aiohttp.TraceConfig:
+    """TraceConfig, который прерывает запросы (и перенаправления) на IP-адреса внутренней сети."""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_check_request_host)
+    trace_config.on_request_redirect.append(_check_redirect_host)
+    return trace_config
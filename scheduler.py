@@ -1,17 +1,73 @@
 import asyncio
+import html
 import logging
-import os
-from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from gdrive_uploader import upload_database_backup
-from config_reader import config # Импортируем конфиг для доступа к DSN
+from backup import create_backup, create_incremental_backup, BackupError
+from config_reader import config
+from database import (
+    get_backup_state, get_links_to_check, save_link_checks, get_unreported_broken_links,
+    mark_broken_links_reported, prune_link_checks
+)
+from gdrive_uploader import prune_backups
+from link_checker import LinkChecker, update_check_state
+from send_queue import send_priority, PRIORITY_BACKGROUND
+
+# Сколько ссылок проверяется одновременно (одна пачка из базы) и сколько максимум за один запуск;
+# оставшиеся ссылки дождутся следующего запуска
+LINK_CHECK_BATCH = 200
+LINK_CHECK_MAX_PER_RUN = 5000
+# Сколько нерабочих ссылок перечисляется в одной сводке
+LINK_DIGEST_MAX_ITEMS = 20
+
+async def apply_retention_policy():
+    """Удаляет с Google Drive бекапы, не попадающие под политику хранения."""
+    if not config.backup_retention:
+        return
+    try:
+        await asyncio.to_thread(
+            prune_backups,
+            config.backup_keep_last,
+            config.backup_keep_daily,
+            config.backup_keep_weekly,
+            config.backup_keep_monthly,
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при очистке старых бекапов на Google Drive: {e}")
+
+async def perform_incremental_backup(bot, user_id: int, since):
+    """
+    Выгружает на Google Drive только записи, измененные после предыдущего бекапа.
+    Такие бекапы выполняются часто, поэтому пользователь получает уведомление только об ошибке.
+    """
+    logging.info("Начинаю инкрементальное резервное копирование...")
+    try:
+        file_link, changes = await create_incremental_backup("auto_backup", since)
+        if changes and not file_link:
+            logging.warning("Инкрементальное резервное копирование не удалось на этапе загрузки.")
+            await bot.send_message(user_id, "❌ Произошла ошибка во время загрузки инкрементальной резервной копии на Google Drive.")
+        elif file_link:
+            await apply_retention_policy()
+    except Exception as e:
+        logging.error(f"Критическая ошибка в процессе инкрементального резервного копирования: {e}")
+        await bot.send_message(user_id, "❌ Произошла критическая ошибка в процессе инкрементального резервного копирования.")
 
 async def perform_auto_backup(bot, user_id: int, is_initial: bool = False):
     """
     Функция, которая будет выполняться по расписанию.
-    Создает дамп PostgreSQL и загружает его на Google Drive.
+    Создает сжатый дамп PostgreSQL и потоково загружает его на Google Drive.
+    В инкрементальном режиме полный дамп делается каждый full_backup_every-й раз,
+    в остальные разы выгружаются только изменения.
     """
+    # Уведомления о бекапе не должны задерживать интерактивные ответы пользователю
+    send_priority.set(PRIORITY_BACKGROUND)
+
+    if config.incremental_backups and not is_initial:
+        state = await get_backup_state()
+        if state and state['last_backup_at'] and state['cycles_since_full'] + 1 < config.full_backup_every:
+            await perform_incremental_backup(bot, user_id, state['last_backup_at'])
+            return
+
     log_prefix = "Первичный" if is_initial else "Плановый"
     message_prefix = "первичного" if is_initial else "планового"
     
@@ -21,35 +77,9 @@ async def perform_auto_backup(bot, user_id: int, is_initial: bool = False):
     except Exception as e:
         logging.error(f"Не удалось отправить уведомление о начале бекапа: {e}")
 
-    # Имя для временного файла бекапа
-    backup_file_path = f"auto_backup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.sql"
-
     try:
-        # Формируем команду для pg_dump, используя DSN из конфига
-        dump_command = [
-            'pg_dump',
-            '--dbname', config.db_dsn,
-            '--file', backup_file_path,
-            '--format', 'plain',
-            '--clean' # Добавляет команды DROP TABLE для чистого восстановления
-        ]
-
-        # Выполняем команду pg_dump
-        process = await asyncio.create_subprocess_exec(
-            *dump_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode != 0:
-            error_message = stderr.decode().strip()
-            logging.error(f"pg_dump завершился с ошибкой: {error_message}")
-            await bot.send_message(user_id, f"❌ Ошибка при создании дампа базы данных: {error_message}")
-            return
-
-        # Загружаем созданный дамп на Google Drive
-        file_link = await asyncio.to_thread(upload_database_backup, backup_file_path, os.path.basename(backup_file_path))
+        # Создаем сжатый дамп и потоково загружаем его на Google Drive
+        file_link = await create_backup("auto_backup")
 
         if file_link:
             await bot.send_message(
@@ -57,6 +87,7 @@ async def perform_auto_backup(bot, user_id: int, is_initial: bool = False):
                 f"✅ Автоматическая резервная копия ({message_prefix}) успешно создана и загружена на Google Drive."
             )
             logging.info(f"{log_prefix} автоматическое резервное копирование успешно завершено.")
+            await apply_retention_policy()
         else:
             await bot.send_message(
                 user_id,
@@ -64,6 +95,8 @@ async def perform_auto_backup(bot, user_id: int, is_initial: bool = False):
             )
             logging.warning(f"{log_prefix} автоматическое резервное копирование не удалось на этапе загрузки.")
 
+    except BackupError as e:
+        await bot.send_message(user_id, f"❌ Ошибка при создании дампа базы данных: {e}")
     except FileNotFoundError:
         logging.error("Команда 'pg_dump' не найдена. Убедитесь, что postgresql-client установлен.")
         await bot.send_message(user_id, "❌ Ошибка: команда `pg_dump` не найдена. Установите `postgresql-client`.")
@@ -73,10 +106,65 @@ async def perform_auto_backup(bot, user_id: int, is_initial: bool = False):
             user_id,
             f"❌ Произошла критическая ошибка в процессе автоматического резервного копирования ({message_prefix})."
         )
-    finally:
-        # Обязательно удаляем временный файл дампа после всех операций
-        if os.path.exists(backup_file_path):
-            os.remove(backup_file_path)
+
+async def send_broken_links_digest(bot):
+    """Отправляет каждому пользователю одну сводку по ссылкам, которые перестали открываться."""
+    rows = await get_unreported_broken_links()
+    by_user = {}
+    for row in rows:
+        by_user.setdefault(row['user_id'], []).append(row)
+    for user_id, links in by_user.items():
+        lines = [f"🔗 Перестали открываться сохраненные ссылки ({len(links)}):"]
+        for link in links[:LINK_DIGEST_MAX_ITEMS]:
+            url = link['message'].strip()
+            title = link['name'] or (url if len(url) <= 100 else url[:100] + '...')
+            status = f"ошибка {link['status']}" if link['status'] else "сайт недоступен"
+            lines.append(f"• <a href=\"{html.escape(url)}\">{html.escape(title)}</a> - {status}")
+        if len(links) > LINK_DIGEST_MAX_ITEMS:
+            lines.append(f"...и еще {len(links) - LINK_DIGEST_MAX_ITEMS}.")
+        try:
+            await bot.send_message(user_id, "\n".join(lines), parse_mode="HTML", disable_web_page_preview=True)
+        except Exception as e:
+            logging.error(f"Не удалось отправить сводку нерабочих ссылок пользователю {user_id}: {e}")
+            continue
+        await mark_broken_links_reported([link['id'] for link in links])
+
+async def perform_link_check(bot):
+    """
+    Проверяет ссылки, срок проверки которых наступил, пачками по возрастанию id и сохраняет результаты,
+    затем отправляет сводку по ставшим нерабочими ссылкам. Рабочие ссылки проверяются все реже,
+    поэтому запуск обходится дешево даже для большой коллекции.
+    """
+    send_priority.set(PRIORITY_BACKGROUND)
+    logging.info("Начинаю проверку сохраненных ссылок...")
+    await prune_link_checks()
+    checked = broken = 0
+    last_id = 0
+    try:
+        async with LinkChecker() as checker:
+            while checked < LINK_CHECK_MAX_PER_RUN:
+                rows = await get_links_to_check(last_id, LINK_CHECK_BATCH)
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                results = await asyncio.gather(*(
+                    checker.check(row['message'].strip(), row['etag'], row['last_modified']) for row in rows
+                ))
+                updates = []
+                for row, result in zip(rows, results):
+                    ok_streak, failures, delay, is_broken = update_check_state(result, row['ok_streak'], row['failures'])
+                    broken += is_broken
+                    updates.append((
+                        row['id'], row['url_hash'], result.status, delay, ok_streak, failures,
+                        result.etag, result.last_modified, is_broken
+                    ))
+                if not await save_link_checks(updates):
+                    break
+                checked += len(rows)
+    except Exception as e:
+        logging.error(f"Ошибка в процессе проверки ссылок: {e}")
+    logging.info(f"Проверка ссылок завершена: проверено {checked}, нерабочих {broken}.")
+    await send_broken_links_digest(bot)
 
 def setup_scheduler(bot, user_id: int):
     """
@@ -93,8 +181,22 @@ def setup_scheduler(bot, user_id: int):
     scheduler.add_job(
         perform_auto_backup,
         trigger='interval',
-        weeks=2,
+        hours=config.backup_interval_hours,
         kwargs={'bot': bot, 'user_id': user_id, 'is_initial': False}
     )
+
+    if config.check_links:
+        scheduler.add_job(
+            perform_link_check,
+            trigger='interval',
+            hours=config.link_check_interval_hours,
+            kwargs={'bot': bot},
+            max_instances=1,
+            coalesce=True
+        )
     scheduler.start()
-    logging.info("Планировщик запущен. Первый бекап будет создан немедленно, последующие - каждые 2 недели.")
\ No newline at end of file
+    mode = "инкрементальный режим" if config.incremental_backups else "полные дампы"
+    logging.info(
+        f"Планировщик запущен. Первый бекап будет создан немедленно, последующие - "
+        f"каждые {config.backup_interval_hours} ч. ({mode})."
+    )
\ No newline at end of file
@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Приоритеты исходящих запросов: меньшее значение обслуживается раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Приоритет запросов текущей задачи. Фоновые задачи (например, плановый бекап)
+# выставляют PRIORITY_BACKGROUND, ответы в обработчиках идут с приоритетом по умолчанию.
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+# Ограничения Telegram Bot API: ~30 сообщений в секунду суммарно,
+# ~1 сообщение в секунду в личный чат (с короткими всплесками) и 20 в минуту в группу
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 5
+
+# Сколько раз повторять запрос после TelegramRetryAfter
+MAX_RETRIES = 3
+# Максимальное число одновременно выполняющихся запросов
+MAX_IN_FLIGHT = 16
+# Порог числа корзин чатов, после которого простаивающие корзины удаляются
+MAX_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    """Асинхронная корзина токенов: не более rate операций в секунду со всплеском до capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = None
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_idle(self) -> bool:
+        """Корзина полна и не заблокирована - ее можно удалить без потери ограничений."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._blocked_until and not self._lock.locked()
+
+    async def acquire(self):
+        """Дожидается и забирает один токен. Ожидающие обслуживаются в порядке очереди."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                self._refill(now)
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def block_for(self, seconds: float):
+        """Запрещает выдачу токенов на seconds секунд (например, по требованию retry_after)."""
+        now = asyncio.get_running_loop().time()
+        self._blocked_until = max(self._blocked_until, now + seconds)
+        self._tokens = 0
+
+
+class SendQueueMiddleware(BaseRequestMiddleware):
+    """
+    Центральная очередь исходящих запросов бота с учетом лимитов Telegram.
+
+    Запросы, адресованные в чат (у метода есть chat_id), сначала ждут токен корзины своего чата,
+    затем попадают в общую приоритетную очередь, которую диспетчер разбирает с темпом глобальной
+    корзины: интерактивные ответы обгоняют фоновые уведомления. При TelegramRetryAfter чат
+    блокируется на указанное время, и запрос автоматически повторяется.
+    Остальные запросы (getUpdates, answerCallbackQuery и т.п.) проходят без очереди.
+    """
+
+    def __init__(self):
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._sequence = itertools.count()
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._dispatcher_task: asyncio.Task | None = None
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                for idle_chat_id in [key for key, value in self._chat_buckets.items() if value.is_idle()]:
+                    del self._chat_buckets[idle_chat_id]
+            # Отрицательные chat_id и @username принадлежат группам и каналам
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher_task is None or self._dispatcher_task.done():
+            self._queue = asyncio.PriorityQueue()
+            self._dispatcher_task = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """Забирает запросы из очереди по приоритету в темпе глобальной корзины."""
+        while True:
+            _, _, make_request, bot, method, future = await self._queue.get()
+            if future.done():
+                continue
+            await self._global_bucket.acquire()
+            await self._in_flight.acquire()
+            asyncio.create_task(self._execute(make_request, bot, method, future))
+
+    async def _execute(self, make_request, bot, method, future: asyncio.Future):
+        try:
+            result = await make_request(bot, method)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._in_flight.release()
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        self._ensure_dispatcher()
+        bucket = self._chat_bucket(chat_id)
+        priority = send_priority.get()
+        for attempt in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((priority, next(self._sequence), make_request, bot, method, future))
+            try:
+                return await future
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logging.warning(
+                    f"Превышен лимит Telegram для чата {chat_id} ({type(method).__name__}), "
+                    f"повтор через {e.retry_after} с."
+                )
+                bucket.block_for(e.retry_after)
+
+    async def close(self):
+        """Останавливает диспетчер очереди."""
+        if self._dispatcher_task is not None:
+            self._dispatcher_task.cancel()
+            self._dispatcher_task = None
@@ -0,0 +1,141 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from net_guard import BlockedAddressError, PublicOnlyResolver, public_only_trace_config
+from title_fetcher import TitleFetcher
+
+PADDING_BYTES = 256 * 1024
+
+
+def make_app(hits):
+    """Локальный сайт-заглушка; hits считает запросы к каждому пути."""
+
+    async def page(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        return web.Response(text=PAGES[request.path], content_type='text/html')
+
+    async def slow(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        await asyncio.sleep(0.2)
+        return web.Response(text='<html><head><title>Slow</title></head></html>', content_type='text/html')
+
+    async def redirect(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        raise web.HTTPFound(f'http://127.0.0.1:{request.url.port}/title')
+
+    app = web.Application()
+    for path in PAGES:
+        app.router.add_get(path, page)
+    app.router.add_get('/slow', slow)
+    app.router.add_get('/redirect', redirect)
+    return app
+
+
+PAGES = {
+    '/title': '<html><head><title>  Plain\n  title </title></head><body>text</body></html>',
+    '/og': (
+        '<html><head><title>Fallback</title>'
+        '<meta property="og:title" content="Open Graph title"></head></html>'
+    ),
+    '/twitter': '<html><head><meta name="twitter:title" content="Twitter title"></head></html>',
+    '/empty': '<html><head><meta charset="utf-8"></head><body>No title</body></html>',
+    # Название после большого комментария: до него парсер дойдет только без ограничения размера
+    '/large': '<html><head><!--' + 'x' * PADDING_BYTES + '--><title>Too far</title></head></html>',
+}
+
+
+def run_with_server(check):
+    """Запускает локальный HTTP-сервер и выполняет корутину check(server, hits)."""
+    async def main():
+        hits = {}
+        async with TestServer(make_app(hits), host='127.0.0.1') as server:
+            await check(server, hits)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('/title', 'Plain title'),
+    ('/og', 'Open Graph title'),
+    ('/twitter', 'Twitter title'),
+    ('/empty', None),
+])
+def test_fetch_title_parses_title_and_meta(path, expected):
+    async def check(server, hits):
+        fetcher = TitleFetcher(allow_private_addresses=True)
+        try:
+            assert await fetcher.fetch_title(str(server.make_url(path))) == expected
+        finally:
+            await fetcher.close()
+
+    run_with_server(check)
+
+
+def test_fetch_title_stops_at_byte_limit():
+    async def check(server, hits):
+        url = str(server.make_url('/large'))
+        limited = TitleFetcher(allow_private_addresses=True, max_bytes=32 * 1024)
+        unlimited = TitleFetcher(allow_private_addresses=True, max_bytes=2 * PADDING_BYTES)
+        try:
+            assert await limited.fetch_title(url) is None
+            assert await unlimited.fetch_title(url) == 'Too far'
+        finally:
+            await limited.close()
+            await unlimited.close()
+
+    run_with_server(check)
+
+
+def test_concurrent_and_repeated_fetches_share_one_request():
+    async def check(server, hits):
+        url = str(server.make_url('/slow'))
+        fetcher = TitleFetcher(allow_private_addresses=True)
+        try:
+            titles = await asyncio.gather(*(fetcher.fetch_title(url) for _ in range(5)))
+            assert titles == ['Slow'] * 5
+            assert await fetcher.fetch_title(url) == 'Slow'
+        finally:
+            await fetcher.close()
+        assert hits['/slow'] == 1
+
+    run_with_server(check)
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', 'localhost'])
+def test_guarded_fetcher_does_not_reach_loopback(host):
+    async def check(server, hits):
+        fetcher = TitleFetcher()
+        try:
+            assert await fetcher.fetch_title(f'http://{host}:{server.port}/title') is None
+        finally:
+            await fetcher.close()
+        assert hits == {}
+
+    run_with_server(check)
+
+
+def test_resolver_rejects_loopback_names():
+    async def main():
+        resolver = PublicOnlyResolver()
+        try:
+            with pytest.raises(BlockedAddressError):
+                await resolver.resolve('localhost', 80)
+        finally:
+            await resolver.close()
+
+    asyncio.run(main())
+
+
+def test_trace_hook_blocks_redirect_to_loopback():
+    async def check(server, hits):
+        # Имя localhost разрешает обычный резолвер, а IP-адрес в перенаправлении ловит проверка перенаправления
+        async with aiohttp.ClientSession(trace_configs=[public_only_trace_config()]) as session:
+            with pytest.raises(BlockedAddressError):
+                await session.get(f'http://localhost:{server.port}/redirect')
+        assert hits == {'/redirect': 1}
+
+    run_with_server(check)
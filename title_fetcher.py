@@ -0,0 +1,192 @@
+import asyncio
+import codecs
+import logging
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+import aiohttp
+
+from net_guard import PublicOnlyResolver, public_only_trace_config
+
+# Общие ограничения фоновой загрузки страниц
+MAX_CONCURRENCY = 8
+MAX_CONNECTIONS_PER_HOST = 2
+REQUEST_TIMEOUT = 10
+# Заголовок страницы ищется только в начале документа
+MAX_RESPONSE_BYTES = 512 * 1024
+READ_CHUNK_SIZE = 16 * 1024
+# Кеш результатов по URL (в том числе неудачных, чтобы не запрашивать их снова)
+CACHE_SIZE = 2048
+CACHE_TTL = 24 * 3600
+# Ограничение длины названия (как в validate_name)
+MAX_TITLE_LENGTH = 1000
+USER_AGENT = 'Mozilla/5.0 (compatible; SaveLinkBot/1.0)'
+
+
+class _TitleParser(HTMLParser):
+    """Собирает <title> и метатеги og:title/twitter:title из заголовка HTML-документа."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.meta_title = None
+        self.finished = False
+        self._in_title = False
+        self._title_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title is None:
+            self._in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            key = (attrs.get('property') or attrs.get('name') or '').lower()
+            if key in ('og:title', 'twitter:title') and attrs.get('content') and self.meta_title is None:
+                self.meta_title = attrs['content']
+        elif tag == 'body':
+            self.finished = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title = ''.join(self._title_parts)
+        elif tag == 'head':
+            self.finished = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+
+    @property
+    def result(self):
+        for value in (self.meta_title, self.title):
+            value = ' '.join((value or '').split())
+            if value:
+                return value[:MAX_TITLE_LENGTH]
+        return None
+
+
+class TitleFetcher:
+    """
+    Фоновая загрузка названий страниц для сохраненных ссылок.
+    Один пул соединений aiohttp на весь процесс, общий лимит одновременных запросов и лимит
+    на хост, таймауты и ограничение размера ответа. Результаты кешируются по URL.
+    Запросы во внутреннюю сеть (loopback, частные и link-local адреса, имена сервисов docker-compose)
+    запрещены, в том числе после перенаправлений. allow_private_addresses=True снимает запрет,
+    чтобы проверять загрузку на локальном HTTP-сервере; session_factory позволяет подменить клиент целиком.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, per_host=MAX_CONNECTIONS_PER_HOST,
+                 timeout=REQUEST_TIMEOUT, max_bytes=MAX_RESPONSE_BYTES, session_factory=None,
+                 allow_private_addresses=False):
+        self._allow_private_addresses = allow_private_addresses
+        self._max_concurrency = max_concurrency
+        self._per_host = per_host
+        self._timeout = timeout
+        self._max_bytes = max_bytes
+        self._session_factory = session_factory
+        self._session: aiohttp.ClientSession | None = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._cache: OrderedDict[str, tuple[float, str | None]] = OrderedDict()
+        self._in_progress: dict[str, asyncio.Future] = {}
+        self._tasks = set()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            if self._session_factory:
+                self._session = self._session_factory()
+            else:
+                guarded = not self._allow_private_addresses
+                connector = aiohttp.TCPConnector(
+                    limit=self._max_concurrency, limit_per_host=self._per_host, ttl_dns_cache=300,
+                    resolver=PublicOnlyResolver() if guarded else None
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self._timeout),
+                    headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'},
+                    trace_configs=[public_only_trace_config()] if guarded else None
+                )
+        return self._session
+
+    def _cached(self, url: str):
+        entry = self._cache.get(url)
+        if entry is None:
+            return False, None
+        stored_at, title = entry
+        if time.monotonic() - stored_at > CACHE_TTL:
+            del self._cache[url]
+            return False, None
+        self._cache.move_to_end(url)
+        return True, title
+
+    def _remember(self, url: str, title: str | None):
+        self._cache[url] = (time.monotonic(), title)
+        self._cache.move_to_end(url)
+        while len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _download_title(self, url: str) -> str | None:
+        async with self._slots:
+            async with self._get_session().get(url, allow_redirects=True) as response:
+                if response.status >= 400 or 'html' not in response.headers.get('Content-Type', 'text/html'):
+                    return None
+                parser = _TitleParser()
+                # Инкрементальный декодер не ломает многобайтовые символы на границах частей
+                decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+                received = 0
+                async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(decoder.decode(chunk))
+                    if parser.finished or received >= self._max_bytes:
+                        break
+                return parser.result
+
+    async def fetch_title(self, url: str) -> str | None:
+        """Возвращает название страницы или None, если его не удалось получить."""
+        found, title = self._cached(url)
+        if found:
+            return title
+        # Одновременные запросы одного URL ждут одну загрузку
+        pending = self._in_progress.get(url)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._in_progress[url] = future
+        title = None
+        try:
+            title = await self._download_title(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, LookupError) as e:
+            logging.info(f"Не удалось получить название страницы {url}: {e!r}")
+        finally:
+            del self._in_progress[url]
+            future.set_result(title)
+        self._remember(url, title)
+        return title
+
+    def schedule(self, url: str, on_title):
+        """
+        Запускает загрузку названия в фоне и не ждет ее. Когда название получено,
+        вызывается корутина on_title(title). Ошибки только записываются в лог.
+        """
+        async def run():
+            try:
+                title = await self.fetch_title(url)
+                if title:
+                    await on_title(title)
+            except Exception as e:
+                logging.error(f"Ошибка фоновой обработки названия для {url}: {e}")
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Отменяет незавершенные загрузки и закрывает пул соединений."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
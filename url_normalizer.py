@@ -0,0 +1,76 @@
+import hashlib
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Параметры запроса, которые добавляют рекламные и аналитические системы; на содержимое страницы не влияют
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'ysclid', 'igshid',
+    'mc_cid', 'mc_eid', '_ga', '_gl', '_hsenc', '_hsmi', 'mkt_tok', 'spm', 'vero_id',
+}
+TRACKING_PREFIXES = ('utm_', 'pk_', 'mtm_')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Ссылка, которая занимает весь текст: схема http/https, домен, localhost или IP, порт и путь без пробелов
+URL_PATTERN = re.compile(
+    r'https?://'  # Протокол в начале строки
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # домен...
+    r'localhost|'  # или localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # или IP
+    r'(?::\d+)?'  # порт
+    r'(?:/?|[/?]\S+)', re.IGNORECASE)
+
+
+def is_url(text: str) -> bool:
+    """Проверяет, является ли текст валидным URL-адресом, который занимает всю строку."""
+    if not isinstance(text, str):
+        return False
+    return URL_PATTERN.fullmatch(text.strip()) is not None
+
+
+def _is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def canonicalize_url(url: str) -> str | None:
+    """
+    Приводит http(s)-ссылку к каноническому виду для поиска дубликатов: схема https, хост в нижнем
+    регистре без порта по умолчанию, без параметров отслеживания, с отсортированными параметрами
+    запроса и без якоря (кроме маршрутов одностраничных приложений вида #/ и #!).
+    Для текста, который не состоит из одной http(s)-ссылки (см. is_url), возвращает None:
+    заметка, которая только начинается со ссылки, не должна считаться этой ссылкой.
+    """
+    if not is_url(url):
+        return None
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+
+    host = parts.hostname.rstrip('.')
+    if ':' in host:
+        host = f'[{host}]'
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        host = f'{host}:{port}'
+    if parts.username:
+        credentials = parts.username + (f':{parts.password}' if parts.password else '')
+        host = f'{credentials}@{host}'
+
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not _is_tracking_param(name)
+    )
+    fragment = parts.fragment if parts.fragment.startswith(('/', '!')) else ''
+    return urlunsplit(('https', host, parts.path or '/', urlencode(query), fragment))
+
+
+def url_hash(url: str) -> int | None:
+    """Возвращает 64-битный хеш канонической формы ссылки (как BIGINT) или None, если это не ссылка."""
+    canonical = canonicalize_url(url)
+    if canonical is None:
+        return None
+    digest = hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
@@ -0,0 +1,100 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import setup_application
+
+from config_reader import config
+
+# Telegram открывает к вебхуку не больше 100 соединений одновременно
+MAX_TELEGRAM_CONNECTIONS = 100
+# Заголовок, в котором Telegram передает секрет, указанный при установке вебхука
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookUpdateHandler:
+    """
+    Обработчик HTTP-запросов Telegram: проверяет секрет, сразу отвечает 200 и передает обновление
+    в диспетчер в фоне. Одновременно обрабатывается не больше max_concurrency обновлений;
+    когда все места заняты, ответ Telegram задерживается, и он сам сбавляет темп отправки.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str | None, max_concurrency: int):
+        self._dispatcher = dispatcher
+        self._bot = bot
+        self._secret_token = secret_token
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    def _is_authorized(self, request: web.Request) -> bool:
+        if not self._secret_token:
+            return True
+        received = request.headers.get(SECRET_TOKEN_HEADER, '')
+        return hmac.compare_digest(received.encode(), self._secret_token.encode())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._is_authorized(request):
+            logging.warning(f"Отклонен запрос к вебхуку с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self._bot})
+        except ValueError as e:
+            logging.warning(f"Не удалось разобрать обновление из вебхука: {e}")
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self._dispatcher.feed_update(self._bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+
+    async def close(self, *args, **kwargs):
+        """Дожидается обработки уже принятых обновлений."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot):
+    """
+    Устанавливает вебхук и обслуживает его встроенным aiohttp-сервером до отмены задачи.
+    Обновления не хранятся в экземпляре бота, поэтому несколько экземпляров могут работать
+    за балансировщиком с одним webhook_url.
+    """
+    if not config.webhook_url:
+        raise ValueError("Для режима webhook нужно указать webhook_url.")
+    secret_token = config.webhook_secret.get_secret_value() if config.webhook_secret else None
+    handler = WebhookUpdateHandler(dispatcher, bot, secret_token, config.webhook_max_concurrency)
+
+    app = web.Application()
+    app.router.add_post(config.webhook_path, handler.handle)
+    # Принятые обновления дообрабатываются до события shutdown диспетчера (закрытия очереди отправки)
+    app.on_shutdown.append(handler.close)
+    setup_application(app, dispatcher, bot=bot)
+
+    await bot.set_webhook(
+        url=config.webhook_url.rstrip('/') + config.webhook_path,
+        secret_token=secret_token,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        max_connections=min(config.webhook_max_concurrency, MAX_TELEGRAM_CONNECTIONS),
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.webhook_host, config.webhook_port)
+    await site.start()
+    logging.info(f"Вебхук слушает {config.webhook_host}:{config.webhook_port}{config.webhook_path}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()